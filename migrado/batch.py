@@ -0,0 +1,111 @@
+"""
+Migrado batch processing
+
+Copyright © 2019 Protojour AS, licensed under MIT.
+See LICENSE.txt for details.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+from contextlib import nullcontext
+from threading import Event, Lock
+import time
+
+from arango.exceptions import ArangoError
+
+
+def process_batches(db_client, query, last_key='', upper_key=None, batch_size=1000,
+        max_transaction_size=None, db=None, cancelled=None, throttle=None, max_retries=3):
+    """
+    Run batch query over successive _key ranges until the collection
+    (or the range up to `upper_key`) is exhausted, yielding (count, last_key)
+    after each batch. Stops early if the `cancelled` event is set.
+
+    With `throttle` (see throttle.RateController), batches are paced and sized by it,
+    and fed back to it. If it is adaptive, a failed batch is retried (up to
+    `max_retries` times in a row) with the smaller batch size it then gives.
+    """
+    retries = 0
+    while not (cancelled and cancelled.is_set()):
+        if throttle:
+            batch_size = throttle.batch_size
+            throttle.acquire(batch_size)
+
+        started = time.monotonic()
+        try:
+            with throttle.slot() if throttle else nullcontext():
+                result = db_client.run_batch(query, last_key, batch_size, max_transaction_size,
+                    upper_key, db)
+        except ArangoError:
+            if not throttle or not throttle.adaptive or retries >= max_retries:
+                raise
+            throttle.record(batch_size, time.monotonic() - started, error=True)
+            retries += 1
+            continue
+
+        retries = 0
+        if throttle:
+            throttle.record(result['count'], time.monotonic() - started)
+        if not result['count']:
+            return
+
+        last_key = result['last_key']
+        yield result['count'], last_key
+
+        if result['count'] < batch_size:
+            return
+
+
+def split_ranges(db_client, collection, parts):
+    """Split the _key space of given collection into (at most) `parts` key ranges"""
+    boundaries = db_client.key_boundaries(collection, parts) if parts > 1 else []
+    starts = [''] + boundaries
+    ends = boundaries + [None]
+    return [
+        {'start': start, 'end': end, 'last_key': start, 'processed': 0, 'done': False}
+        for start, end in zip(starts, ends)
+    ]
+
+
+def process_ranges(db_client, query, ranges, batch_size=1000, workers=1,
+        max_transaction_size=None, on_progress=None, throttle=None):
+    """
+    Process key ranges (see split_ranges) concurrently, with at most `workers` ranges
+    in flight at a time, and at most as many batches as `throttle` allows, if given.
+    Each range is updated in place after every batch, and `on_progress(index, ranges)`
+    is called (serialized) so progress can be checkpointed.
+
+    If any range fails, or on KeyboardInterrupt, remaining workers stop after their
+    current batch, and the error is re-raised.
+    """
+    cancelled = Event()
+    lock = Lock()
+
+    def process_range(index):
+        range_ = ranges[index]
+        if range_['done']:
+            return
+
+        db = db_client.connect()
+        for count, last_key in process_batches(db_client, query, range_['last_key'], range_['end'],
+                batch_size, max_transaction_size, db, cancelled, throttle):
+            with lock:
+                range_['last_key'] = last_key
+                range_['processed'] += count
+                if on_progress:
+                    on_progress(index, ranges)
+
+        if not cancelled.is_set():
+            with lock:
+                range_['done'] = True
+                if on_progress:
+                    on_progress(index, ranges)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_range, index) for index in range(len(ranges))]
+        try:
+            wait(futures, return_when=FIRST_EXCEPTION)
+        finally:
+            cancelled.set()
+
+        for future in futures:
+            future.result()
@@ -5,6 +5,17 @@ Copyright © 2019 Protojour AS, licensed under MIT.
 See LICENSE.txt for details.
 """
 
+CONFLICT = 1200
+DOCUMENT_NOT_FOUND = 1202
+COLLECTION_NOT_FOUND = 1203
+COLLECTION_DUPLICATE_NAME = 1207
+UNIQUE_CONSTRAINT_VIOLATED = 1210
+
+# exit codes for migrado check
+STATE_CURRENT = 0
+STATE_BEHIND = 3
+STATE_AHEAD = 4
+
 MIGRATION_TEMPLATE = \
 '''#!/usr/bin/arangosh --javascript.execute
 // migrado migration v0.6
@@ -21,3 +32,18 @@ function reverse() {
 
 forward() // default action
 '''
+
+PYTHON_MIGRATION_TEMPLATE = \
+'''# migrado migration v0.6
+# declare collections written to with '# write <collection>' lines
+
+
+def forward(db):
+    # add your forward migration here
+    pass
+
+
+def reverse(db):
+    # add your reverse migration here
+    pass
+'''
@@ -5,16 +5,81 @@ Copyright © 2019 Protojour AS, licensed under MIT.
 See LICENSE.txt for details.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+import json
 import subprocess
+import time
 
 from arango import ArangoClient
-from arango.exceptions import TransactionExecuteError
+from arango.http import DefaultHTTPClient
+from arango.exceptions import (
+    AQLQueryExecuteError, ArangoError, ArangoServerError, CollectionCreateError, TransactionExecuteError
+)
+
+from .constants import (
+    CONFLICT, COLLECTION_NOT_FOUND, COLLECTION_DUPLICATE_NAME, UNIQUE_CONSTRAINT_VIOLATED
+)
+from .tracing import Tracer, TracingHTTPClient
+from .transaction import StreamTransaction
+
+
+class ArangoshSession:
+    """Long-lived arangosh process, running migration functions fed over stdin"""
+
+    def __init__(self, command):
+        self.command = command
+        self.process = subprocess.Popen(
+            command, text=True, bufsize=1,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def run(self, script):
+        """Run JavaScript function, returning its error output (empty on success)"""
+        marker = uuid4().hex
+        statement = (
+            f'print("{marker} begin"); '
+            f'try {{ eval("(" + {json.dumps(str(script))} + ")")(); print("{marker} ok") }} '
+            f'catch (error) {{ print(String(error)); print("{marker} error") }}\n'
+        )
+        try:
+            self.process.stdin.write(statement)
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            pass
+
+        output = []
+        for line in self.process.stdout:
+            if f'{marker} begin' in line:
+                output = []
+            elif f'{marker} ok' in line:
+                return ''
+            elif f'{marker} error' in line:
+                return ''.join(output)
+            else:
+                output.append(line)
+
+        # arangosh exited before finishing, return everything it wrote
+        return ''.join(output) or f'arangosh exited with code {self.process.wait()}'
+
+    def close(self):
+        """End arangosh process"""
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (BrokenPipeError, subprocess.TimeoutExpired):
+            self.process.kill()
 
 
 class MigrationClient:
     """Client for reading and writing state, running migrations against ArangoDB"""
 
-    def __init__(self, tls, host, port, username, password, db, coll, timeout=1200):
+    def __init__(self, tls, host, port, username, password, db, coll, timeout=1200, client=None,
+                 retry=True, tracer=None, pool_size=None):
         self.protocol = 'https' if tls else 'http'
         self.host = host
         self.port = port
@@ -23,46 +88,124 @@ class MigrationClient:
         self.db_name = db
         self.coll_name = coll
         self.timeout = timeout
+        self.arangosh_session = None
+        self._db = None
+        self._state_coll = None
+        self._history_coll = None
+        self.tracer = tracer or Tracer(enabled=False)
+
+        if client is None:
+            options = {'request_timeout': timeout}
+            if not retry:
+                # fail on first connection error or timeout, instead of retrying with backoff
+                options['retry_attempts'] = 0
+            if pool_size:
+                # keep a connection per concurrent request, instead of reconnecting
+                # once the pool (10 connections by default) is full
+                options['pool_connections'] = options['pool_maxsize'] = pool_size
+            http_client = (TracingHTTPClient(self.tracer, **options) if self.tracer.enabled
+                else DefaultHTTPClient(**options))
+            client = ArangoClient(f'{self.protocol}://{host}:{port}', http_client=http_client,
+                resolver_max_tries=None if retry else 1)
+
+        self.db_client = client
 
-        self.db_client = ArangoClient(f'{self.protocol}://{host}:{port}', request_timeout=timeout)
+    def connect(self):
+        """Get a new database handle"""
+        return self.db_client.db(self.db_name, self.username, self.password)
 
     @property
     def db(self):
-        """Get database"""
-        return self.db_client.db(self.db_name, self.username, self.password)
+        """Get database (the handle is reused for the life of the client)"""
+        if self._db is None:
+            self._db = self.connect()
+        return self._db
 
     @property
     def state_coll(self):
-        """Get or create state collection"""
-        if not self.db.has_collection(self.coll_name):
-            return self.db.create_collection(self.coll_name)
-        else:
-            return self.db.collection(self.coll_name)
+        """Get or create state collection (creation is attempted at most once)"""
+        return self.ensure_state_coll()
+
+    def ensure_state_coll(self):
+        """Create state collection, if not created (or found) before, and return it"""
+        if self._state_coll is None:
+            self._state_coll = self.ensure_collection(self.coll_name)
+        return self._state_coll
+
+    @property
+    def history_coll_name(self):
+        return f'{self.coll_name}_history'
+
+    @property
+    def history_coll(self):
+        """Get or create migration history collection (creation is attempted at most once)"""
+        if self._history_coll is None:
+            self._history_coll = self.ensure_collection(self.history_coll_name)
+        return self._history_coll
+
+    def ensure_collection(self, name):
+        """Create collection, or get it if it already exists"""
+        try:
+            return self.db.create_collection(name)
+        except CollectionCreateError as e:
+            if e.error_code != COLLECTION_DUPLICATE_NAME:
+                raise
+            return self.db.collection(name)
+
+    def list_databases(self):
+        """List databases on the server (requires access to the _system database)"""
+        return self.db_client.db('_system', self.username, self.password).databases()
+
+    def read_metadata(self, keys=('state', 'schema', 'checkpoint')):
+        """
+        Read state, schema and checkpoint documents (or given keys) from state
+        collection in a single request, returning a dict of the documents found by key
+        """
+        try:
+            cursor = self.db.aql.execute(
+                'RETURN DOCUMENT(@coll, @keys)',
+                bind_vars={'coll': self.coll_name, 'keys': list(keys)}
+            )
+        except AQLQueryExecuteError as e:
+            if e.error_code != COLLECTION_NOT_FOUND:
+                raise
+            return {}
+
+        documents = {document['_key']: document for document in cursor.next()}
+        if documents and self._state_coll is None:
+            self._state_coll = self.db.collection(self.coll_name)
+
+        return documents
 
     def read_state(self):
         """Read state from state collection, or return default initial state"""
-        if self.db.has_collection(self.coll_name) and self.state_coll.has('state'):
-            state = self.state_coll.get('state')
-        else:
-            state = {'migration_id': '0000'}
+        return self.read_state_applied()[0]
 
-        return state.get('migration_id')
+    def read_applied(self):
+        """Read ids of migrations applied ahead of state (see write_state) from state collection"""
+        return self.read_state_applied()[1]
+
+    def read_state_applied(self):
+        """Read state, and ids of migrations applied ahead of it, in a single request"""
+        state = self.read_metadata(['state']).get('state', {'migration_id': '0000'})
+        return state.get('migration_id'), state.get('applied', [])
 
     def read_schema(self):
         """Read schema from state collection"""
-        if self.db.has_collection(self.coll_name) and self.state_coll.has('schema'):
-            state = self.state_coll.get('schema')
-        else:
-            state = {'schema': {}}
-
+        state = self.read_metadata(['schema']).get('schema', {'schema': {}})
         return state.get('schema')
 
-    def write_state(self, migration_id):
-        """Write given state to state collection"""
+    def write_state(self, migration_id, applied=None):
+        """
+        Write given state to state collection, with ids of any migrations applied
+        ahead of it (by parallel runs, see MigrationRunner.run_parallel)
+        """
         state = {
             '_key': 'state',
             'migration_id': migration_id,
         }
+        if applied:
+            state['applied'] = applied
         return self.state_coll.insert(state, overwrite=True, silent=True)
 
     def write_schema(self, schema):
@@ -73,6 +216,135 @@ class MigrationClient:
         }
         return self.state_coll.insert(state, overwrite=True, silent=True)
 
+    def read_checkpoint(self):
+        """Read batch checkpoint from state collection, if any"""
+        return self.read_metadata(['checkpoint']).get('checkpoint')
+
+    def write_checkpoint(self, migration_id, direction, ranges):
+        """Write batch checkpoint (progress of each key range) to state collection"""
+        checkpoint = {
+            '_key': 'checkpoint',
+            'migration_id': migration_id,
+            'direction': direction,
+            'ranges': ranges,
+        }
+        return self.state_coll.insert(checkpoint, overwrite=True, silent=True)
+
+    def clear_checkpoint(self):
+        """Remove batch checkpoint from state collection"""
+        self.state_coll.delete('checkpoint', ignore_missing=True, silent=True)
+
+    def write_history(self, entries):
+        """Append entries (see utils.history_entry) to migration history collection"""
+        return self.history_coll.insert_many(entries, silent=True)
+
+    def read_history(self, limit=10):
+        """
+        Read migration history, summarized by migration id, direction and environment,
+        slowest (by latest duration) first
+        """
+        try:
+            cursor = self.db.aql.execute(
+                '''
+                FOR entry IN @@coll
+                    COLLECT migration_id = entry.migration_id, direction = entry.direction,
+                        environment = entry.environment INTO entries = entry
+                    LET runs = (FOR run IN entries SORT run.started DESC RETURN run)
+                    SORT runs[0].duration DESC
+                    LIMIT @limit
+                    RETURN {
+                        migration_id, direction, environment,
+                        runs: LENGTH(runs),
+                        executors: runs[0].executors,
+                        started: runs[0].started,
+                        duration: runs[0].duration,
+                        previous: runs[1].duration,
+                        max: MAX(runs[*].duration),
+                        documents: runs[0].documents
+                    }
+                ''',
+                bind_vars={'@coll': self.history_coll_name, 'limit': limit}
+            )
+        except AQLQueryExecuteError as e:
+            if e.error_code != COLLECTION_NOT_FOUND:
+                raise
+            return []
+
+        return list(cursor)
+
+    def read_lock(self):
+        """
+        Read state and migration lock in a single request, returning the state
+        migration id, and the lock holder if the lock is held (has not expired)
+        """
+        try:
+            cursor = self.db.aql.execute(
+                '''
+                LET lock = DOCUMENT(@coll, "lock")
+                RETURN {
+                    state: DOCUMENT(@coll, "state").migration_id,
+                    owner: lock.expires > DATE_NOW() ? lock.owner : null
+                }
+                ''',
+                bind_vars={'coll': self.coll_name}
+            )
+        except AQLQueryExecuteError as e:
+            if e.error_code != COLLECTION_NOT_FOUND:
+                raise
+            return '0000', None
+
+        status = cursor.next()
+        return status['state'] or '0000', status['owner']
+
+    def acquire_lock(self, owner, ttl):
+        """
+        Acquire or renew migration lock for `owner` for `ttl` seconds, unless
+        held by another owner, returning the lock holder (None if contended)
+        """
+        try:
+            cursor = self.db.aql.execute(
+                '''
+                UPSERT { _key: "lock" }
+                INSERT { _key: "lock", owner: @owner, expires: DATE_NOW() + @ttl }
+                UPDATE OLD.owner == @owner || OLD.expires <= DATE_NOW()
+                    ? { owner: @owner, expires: DATE_NOW() + @ttl } : {}
+                IN @@coll
+                RETURN NEW.owner
+                ''',
+                bind_vars={'@coll': self.state_coll.name, 'owner': owner, 'ttl': int(ttl * 1000)}
+            )
+        except AQLQueryExecuteError as e:
+            if e.error_code not in (CONFLICT, UNIQUE_CONSTRAINT_VIOLATED):
+                raise
+            return None
+
+        return cursor.next()
+
+    def renew_lock(self, owner, ttl, db=None):
+        """Extend migration lock held by `owner` by `ttl` seconds, returning False if no longer held"""
+        db = db or self.db
+        cursor = db.aql.execute(
+            '''
+            FOR doc IN @@coll
+                FILTER doc._key == "lock" AND doc.owner == @owner
+                UPDATE doc WITH { expires: DATE_NOW() + @ttl } IN @@coll
+                RETURN true
+            ''',
+            bind_vars={'@coll': self.coll_name, 'owner': owner, 'ttl': int(ttl * 1000)}
+        )
+        return bool(list(cursor))
+
+    def release_lock(self, owner):
+        """Remove migration lock, if held by `owner`"""
+        self.db.aql.execute(
+            '''
+            FOR doc IN @@coll
+                FILTER doc._key == "lock" AND doc.owner == @owner
+                REMOVE doc IN @@coll
+            ''',
+            bind_vars={'@coll': self.coll_name, 'owner': owner}
+        )
+
     def infer_schema(self, validation):
         """Infer schema from current database structure"""
         schema = {
@@ -80,58 +352,282 @@ class MigrationClient:
             'edge_collections': {},
         }
 
-        collections = self.db.collections()
-        db_collections = [
-            collection['name'] for collection in collections
-            if (collection['type'] == 'document'
-                and not collection['system']
-                and not collection['name'] == self.coll_name)
-        ]
-        db_edge_collections = [
-            collection['name'] for collection in collections
-            if (collection['type'] == 'edge'
-                and not collection['system'])
-        ]
+        for collection in self.list_collections(validation):
+            name = collection['name']
+            if collection['system']:
+                continue
+            if collection['type'] == 'document' and name in (self.coll_name, self.history_coll_name):
+                continue
 
-        for collection in db_collections:
-            schema['collections'][collection] = None
-            if validation:
-                props = self.db.collection(collection).properties()
-                collection_schema = props.get('schema')
-                if collection_schema:
-                    schema['collections'][collection] = {}
-                    schema['collections'][collection]['schema'] = collection_schema
-
-        for collection in db_edge_collections:
-            schema['edge_collections'][collection] = None
-            if validation:
-                props = self.db.collection(collection).properties()
-                collection_schema = props.get('schema')
-                if collection_schema:
-                    schema['edge_collections'][collection] = {}
-                    schema['edge_collections'][collection]['schema'] = collection_schema
+            key = 'edge_collections' if collection['type'] == 'edge' else 'collections'
+            schema[key][name] = None
+            if validation and collection['schema']:
+                schema[key][name] = {}
+                schema[key][name]['schema'] = collection['schema']
 
         return schema
 
+    def list_collections(self, validation):
+        """
+        List collections with name, type, system flag and (if `validation`) schema.
+        Properties are read in a single server-side call if JavaScript transactions are
+        available, otherwise with bounded concurrent requests.
+        """
+        db = self.db
+        script = '''
+        function (params) {
+            var db = require("@arangodb").db
+            return db._collections().map(function (collection) {
+                return {
+                    name: collection.name(),
+                    type: collection.type() === 3 ? "edge" : "document",
+                    system: collection.name().charAt(0) === "_",
+                    schema: params.validation ? collection.properties().schema || null : null
+                }
+            })
+        }
+        '''
+        try:
+            return db.execute_transaction(script, params={'validation': bool(validation)},
+                allow_implicit=True)
+        except TransactionExecuteError:
+            pass
+
+        collections = [
+            {
+                'name': collection['name'],
+                'type': collection['type'],
+                'system': collection['system'],
+                'schema': None,
+            }
+            for collection in db.collections()
+        ]
+        if validation:
+            def read_schema(collection):
+                if not collection['system']:
+                    collection['schema'] = db.collection(collection['name']).properties().get('schema')
+
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(read_schema, collections))
+
+        return collections
+
+    def list_indexes(self):
+        """
+        List index definitions (as given by the HTTP API, excluding primary and
+        edge indexes) of non-system collections, by collection name
+        """
+        script = '''
+        function () {
+            var db = require("@arangodb").db
+            var indexes = {}
+            db._collections().forEach(function (collection) {
+                if (collection.name().charAt(0) === "_") {
+                    return
+                }
+                indexes[collection.name()] = collection.getIndexes().filter(function (index) {
+                    return index.type !== "primary" && index.type !== "edge"
+                }).map(function (index) {
+                    delete index.id
+                    delete index.selectivityEstimate
+                    delete index.figures
+                    delete index.isNewlyCreated
+                    return index
+                })
+            })
+            return indexes
+        }
+        '''
+        return self.db.execute_transaction(script, allow_implicit=True)
+
+    def is_empty(self):
+        """Check if database has no collections, other than system and migrado collections"""
+        ignored = (self.coll_name, self.history_coll_name)
+        return not any(
+            not collection['system'] and collection['name'] not in ignored
+            for collection in self.db.collections()
+        )
+
     def run_transaction(self, script, write_collections,
             max_transaction_size=None, intermediate_commit_size=None, intermediate_commit_count=None,
-            sync=True):
-        """Execute JavaScript command in transaction against ArangoDB"""
-        try:
-            return self.db.execute_transaction(
-                script,
-                write=write_collections,
-                sync=sync,
-                allow_implicit=True,
-                max_size=max_transaction_size,
-                intermediate_commit_size=intermediate_commit_size,
-                intermediate_commit_count=intermediate_commit_count
+            sync=True, migration_id=None, schema=None, job=False):
+        """
+        Execute JavaScript command in transaction against ArangoDB.
+        If `migration_id` is given, state (and `schema`, if given) is written
+        to the state collection in the same transaction.
+        If `job`, the transaction is submitted as a server-side async job,
+        and polled for its result (see wait_for_job). Errors polling the job are
+        returned like transaction errors, though the transaction may have run.
+        """
+        if migration_id:
+            self.ensure_state_coll()  # collections can not be created inside the transaction
+            script = self.state_transaction(script, migration_id, schema)
+            write_collections = list(write_collections) + [self.coll_name]
+
+        db = self.db.begin_async_execution(return_result=True) if job else self.db
+        with self.tracer.span('transaction', migration_id=migration_id, job=job) as span:
+            try:
+                result = db.execute_transaction(
+                    script,
+                    write=write_collections,
+                    sync=sync,
+                    allow_implicit=True,
+                    max_size=max_transaction_size,
+                    intermediate_commit_size=intermediate_commit_size,
+                    intermediate_commit_count=intermediate_commit_count
+                )
+                return self.wait_for_job(result) if job else result
+            except TransactionExecuteError as e:
+                span['error'] = e.error_message
+                return e
+            except ArangoError as e:
+                # such as a job not found, when polled through another coordinator
+                if not job:
+                    raise
+                span['error'] = str(e)
+                return e
+
+    def run_stream_transaction(self, function, write_collections,
+            max_transaction_size=None, sync=True, migration_id=None):
+        """
+        Run Python migration function, passing a stream transaction (see
+        transaction.StreamTransaction). If `migration_id` is given, state is written
+        to the state collection in the last transaction, as it is committed.
+        Returns the error, if the migration failed (its transaction is aborted).
+        """
+        write_collections = list(write_collections)
+        if migration_id:
+            self.ensure_state_coll()  # collections can not be created inside the transaction
+            write_collections.append(self.coll_name)
+
+        with self.tracer.span('stream_transaction', migration_id=migration_id) as span:
+            transaction = None
+            try:
+                transaction = StreamTransaction(self.db, write_collections, sync, max_transaction_size)
+                function(transaction)
+                if migration_id:
+                    transaction.collection(self.coll_name).insert(
+                        {'_key': 'state', 'migration_id': migration_id}, overwrite=True, silent=True
+                    )
+                transaction.transaction.commit_transaction()
+            except Exception as e:
+                if transaction:
+                    transaction.abort()
+                span['error'] = type(e).__name__
+                return e
+            finally:
+                span['commits'] = transaction.commits if transaction else 0
+
+    def wait_for_job(self, job, poll_interval=0.1, max_poll_interval=10):
+        """
+        Poll async job status with exponential backoff until done, and return its result.
+        Each poll is a short request, so no connection is held open while the job runs.
+        """
+        interval = poll_interval
+        while job.status() == 'pending':
+            time.sleep(interval)
+            interval = min(interval * 2, max_poll_interval)
+        return job.result()
+
+    def state_transaction(self, script, migration_id, schema=None):
+        """Wrap migration function to also write state (and schema) to state collection"""
+        documents = [{
+            '_key': 'state',
+            'migration_id': migration_id,
+        }]
+        if schema:
+            documents.append({
+                '_key': 'schema',
+                'schema': schema,
+            })
+
+        return (
+            'function () {\n'
+            f'    var result = ({script})()\n'
+            f'    var state = require("@arangodb").db._collection({json.dumps(self.coll_name)})\n'
+            f'    state.insert({json.dumps(documents)}, {{ overwrite: true, silent: true }})\n'
+            '    return result\n'
+            '}'
+        )
+
+    def key_boundaries(self, collection, parts):
+        """Find keys splitting given collection into `parts` key ranges of similar size"""
+        db = self.db
+        count = db.collection(collection).count()
+        boundaries = []
+        for part in range(1, parts):
+            cursor = db.aql.execute(
+                'FOR doc IN @@collection SORT doc._key LIMIT @offset, 1 RETURN doc._key',
+                bind_vars={
+                    '@collection': collection,
+                    'offset': count * part // parts,
+                }
             )
-        except TransactionExecuteError as e:
-            return e
+            key = next(cursor, None)
+            if key is not None and key not in boundaries:
+                boundaries.append(key)
+
+        return boundaries
+
+    def run_batch(self, query, last_key, batch_size, max_transaction_size=None,
+            upper_key=None, db=None):
+        """
+        Execute batch query (see utils.batch_query) for documents after given key,
+        and up to `upper_key`, if given
+        """
+        db = db or self.db
+        cursor = db.aql.execute(
+            query,
+            bind_vars={
+                'last_key': last_key,
+                'upper_key': upper_key,
+                'batch_size': batch_size,
+            },
+            max_transaction_size=max_transaction_size
+        )
+        return cursor.next()
+
+    def run_ddl(self, operations):
+        """Execute schema operations (see utils.parse_ddl) through the HTTP API"""
+        db = self.db
+        with self.tracer.span('ddl', operations=len(operations)) as span:
+            try:
+                for operation in operations:
+                    name, options = operation['name'], operation['options']
+                    if operation['operation'] == 'create':
+                        db.create_collection(name, edge=operation['edge'], schema=options.get('schema'))
+                    elif operation['operation'] == 'drop':
+                        db.delete_collection(name, ignore_missing=True)
+                    elif operation['operation'] == 'properties' and 'schema' in options:
+                        db.collection(name).configure(schema=options['schema'])
+            except ArangoServerError as e:
+                span['error'] = e.error_message
+                return e
 
     def run_script(self, script, arangosh):
-        """Execute JavaScript command through 'arangosh'"""
+        """
+        Execute JavaScript command through 'arangosh'.
+        The arangosh process is started on first use, and reused until close().
+        """
+        with self.tracer.span('arangosh') as span:
+            session = self.arangosh_session
+            if not session or session.command[0] != arangosh or not session.alive:
+                if session:
+                    session.close()
+                span['started'] = True
+                try:
+                    session = self.arangosh_session = ArangoshSession(self.arangosh_command(arangosh))
+                except FileNotFoundError as e:
+                    span['error'] = str(e)
+                    return str(e)
+
+            error = session.run(script).replace('\\n', '\n')
+            if error:
+                span['error'] = error
+            return error
+
+    def arangosh_command(self, arangosh):
+        """Build arangosh command line for this database"""
         command = [
             arangosh,
             '--server.endpoint', f'{self.protocol}://{self.host}:{self.port}',
@@ -149,12 +645,91 @@ class MigrationClient:
                 '--server.authentication', 'false',
             ]
         command += [
-            '--javascript.execute-string', f'({script})()'
+            '--quiet', 'true',
+            '--console.colors', 'false',
         ]
+        return command
+
+    def close(self):
+        """End arangosh session, if any"""
+        if self.arangosh_session:
+            self.arangosh_session.close()
+            self.arangosh_session = None
+
+
+# python-arango 7.x collection methods for adding indexes by type,
+# with their keyword arguments for keys of HTTP API index definitions
+INDEX_METHODS = {
+    'hash': ('add_hash_index', {
+        'fields': 'fields', 'unique': 'unique', 'sparse': 'sparse',
+        'deduplicate': 'deduplicate', 'name': 'name', 'inBackground': 'in_background',
+    }),
+    'skiplist': ('add_skiplist_index', {
+        'fields': 'fields', 'unique': 'unique', 'sparse': 'sparse',
+        'deduplicate': 'deduplicate', 'name': 'name', 'inBackground': 'in_background',
+    }),
+    'persistent': ('add_persistent_index', {
+        'fields': 'fields', 'unique': 'unique', 'sparse': 'sparse', 'name': 'name',
+        'inBackground': 'in_background', 'storedValues': 'storedValues', 'cacheEnabled': 'cacheEnabled',
+    }),
+    'geo': ('add_geo_index', {
+        'fields': 'fields', 'geoJson': 'ordered', 'name': 'name',
+        'inBackground': 'in_background', 'legacyPolygons': 'legacyPolygons',
+    }),
+    'fulltext': ('add_fulltext_index', {
+        'fields': 'fields', 'minLength': 'min_length', 'name': 'name', 'inBackground': 'in_background',
+    }),
+    'ttl': ('add_ttl_index', {
+        'fields': 'fields', 'expireAfter': 'expiry_time', 'name': 'name', 'inBackground': 'in_background',
+    }),
+    'inverted': ('add_inverted_index', {
+        key: key for key in (
+            'fields', 'name', 'inBackground', 'parallelism', 'primarySort', 'storedValues',
+            'analyzer', 'features', 'includeAllFields', 'trackListPositions', 'searchField',
+            'primaryKeyCache', 'cache',
+        )
+    }),
+}
+
+
+def add_index(collection, index):
+    """
+    Add index to python-arango `collection` from its HTTP API definition
+    (see MigrationClient.list_indexes), with python-arango 8.x add_index,
+    or the python-arango 7.x method for its type
+    """
+    if hasattr(collection, 'add_index'):
+        return collection.add_index(index)
+
+    if index['type'] not in INDEX_METHODS:
+        raise ValueError(
+            f'Cannot add {index["type"]} index to {collection.name} with this python-arango version'
+        )
+    method, arguments = INDEX_METHODS[index['type']]
+    return getattr(collection, method)(**{
+        arguments[key]: value for key, value in index.items() if key in arguments
+    })
 
-        try:
-            result = subprocess.run(command, text=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-        except FileNotFoundError as e:
-            return str(e)
 
-        return result.stdout.replace('\\n', '\n')
+def collection_options(properties):
+    """
+    Get create_collection keyword arguments for collection `properties` (as given by
+    python-arango), keeping sharding, key generator, sync and computed values.
+    User keys are always allowed, as copied documents keep their keys.
+    """
+    key_options = properties.get('key_options') or {}
+    options = {
+        'sync': properties.get('sync'),
+        'key_generator': key_options.get('key_generator'),
+        'key_increment': key_options.get('key_increment'),
+        'key_offset': key_options.get('key_offset'),
+        'shard_fields': properties.get('shard_fields'),
+        'shard_count': properties.get('shard_count'),
+        'replication_factor': properties.get('replication_factor'),
+        'shard_like': properties.get('shard_like') or None,
+        'sharding_strategy': properties.get('sharding_strategy'),
+        'smart_join_attribute': properties.get('smart_join_attribute'),
+        'write_concern': properties.get('write_concern'),
+        'computedValues': properties.get('computedValues'),
+    }
+    return {key: value for key, value in options.items() if value is not None}
@@ -0,0 +1,94 @@
+"""
+Migrado migration lock
+
+Copyright © 2019 Protojour AS, licensed under MIT.
+See LICENSE.txt for details.
+"""
+
+from threading import Event, Thread
+from uuid import uuid4
+import os
+import socket
+import time
+
+import click
+
+
+class MigrationLock:
+    """
+    Lease on the migration lock document in the state collection.
+
+    The lease expires after `ttl` seconds unless renewed by a heartbeat thread,
+    so a lock left behind by a runner that died is taken over once it expires.
+    If the lease could not be renewed in time, `lost` is set, and the runner
+    should stop before starting another migration.
+    """
+
+    def __init__(self, db_client, ttl=30, poll_interval=0.5, max_poll_interval=5, echo=click.echo):
+        self.db_client = db_client
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.echo = echo
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}'
+        self.stopped = Event()
+        self.lost = Event()
+        self.heartbeat = None
+
+    def wait(self, target, echo=click.echo):
+        """
+        Acquire lock, waiting while another runner holds it. Returns True once
+        acquired, or False if state reached `target` while waiting.
+        """
+        interval = self.poll_interval
+        holder = None
+        while True:
+            state, owner = self.db_client.read_lock()
+            if state == target:
+                return False
+
+            if owner is None or owner == self.owner:
+                owner = self.db_client.acquire_lock(self.owner, self.ttl)
+                if owner == self.owner:
+                    self.start_heartbeat()
+                    return True
+
+            if owner and owner != holder:
+                echo(f'Waiting for migration lock held by {owner} (state is at {state})...')
+                holder = owner
+
+            time.sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
+
+    def start_heartbeat(self):
+        self.stopped.clear()
+        self.lost.clear()
+        self.heartbeat = Thread(target=self.renew, daemon=True)
+        self.heartbeat.start()
+
+    def renew(self):
+        """Renew lease every third of its ttl, until released or lost"""
+        db = self.db_client.connect()
+        renewed = time.monotonic()
+        while not self.stopped.wait(self.ttl / 3):
+            try:
+                if not self.db_client.renew_lock(self.owner, self.ttl, db):
+                    self.echo('Warning! Migration lock is no longer held by this runner.')
+                    self.lost.set()
+                    return
+                renewed = time.monotonic()
+            except Exception as error:
+                # retry on next heartbeat, while the lease is still valid
+                self.echo('Warning! Could not renew migration lock: %s' % error)
+                if time.monotonic() - renewed >= self.ttl:
+                    self.echo('Warning! Migration lock lease has expired.')
+                    self.lost.set()
+                    return
+
+    def release(self):
+        """Stop heartbeat and remove lock"""
+        self.stopped.set()
+        if self.heartbeat:
+            self.heartbeat.join()
+            self.heartbeat = None
+        self.db_client.release_lock(self.owner)
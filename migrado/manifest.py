@@ -0,0 +1,100 @@
+"""
+Migrado migration manifest
+
+Copyright © 2019 Protojour AS, licensed under MIT.
+See LICENSE.txt for details.
+"""
+
+from hashlib import sha256
+import json
+
+from .tracing import Tracer
+from .utils import parse_migration_file
+
+
+# bumped when parsed migrations change shape, so manifests from earlier versions are rebuilt
+VERSION = 3
+
+class Manifest:
+    """
+    Compiled manifest of parsed migrations, stored in the migrations directory
+    and keyed by file name, size, mtime and content hash, so unchanged
+    migration files are never parsed twice
+    """
+
+    def __init__(self, migrations_path, tracer=None):
+        self.path = migrations_path.joinpath('.migrado', 'manifest.json')
+        self.entries = {}
+        self.changed = False
+        self.tracer = tracer or Tracer(enabled=False)
+
+        try:
+            manifest = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            manifest = {}
+        if manifest.get('version') == VERSION:
+            self.entries = manifest.get('migrations', {})
+        else:
+            self.changed = True
+
+    def load(self, migration_path, verify=False):
+        """
+        Get parsed migration (see utils.parse_migration_file) for given migration file.
+        If `verify`, the file is hashed even if its size and mtime are unchanged.
+        """
+        stat = migration_path.stat()
+        entry = self.entries.get(migration_path.name)
+        if (entry and not verify
+                and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns):
+            return entry['migration']
+
+        with self.tracer.span('read', file=migration_path.name, bytes=stat.st_size):
+            data = migration_path.read_bytes()
+            digest = sha256(data).hexdigest()
+        if not entry or entry['sha256'] != digest:
+            with self.tracer.span('parse', file=migration_path.name):
+                entry = {
+                    'sha256': digest,
+                    'migration': parse_migration_file(migration_path.name, data.decode()),
+                }
+
+        entry['size'] = stat.st_size
+        entry['mtime_ns'] = stat.st_mtime_ns
+        self.entries[migration_path.name] = entry
+        self.changed = True
+        return entry['migration']
+
+    def load_all(self, migrations, verify=False):
+        """
+        Get parsed migrations for given migration files, by migration id,
+        and drop entries for files no longer present (see load for `verify`)
+        """
+        parsed = {migration.name[:4]: self.load(migration, verify) for migration in migrations}
+
+        names = {migration.name for migration in migrations}
+        for name in list(self.entries):
+            if name not in names:
+                del self.entries[name]
+                self.changed = True
+
+        return parsed
+
+    def checksums(self):
+        """Get content hash of each migration file, by file name"""
+        return {name: entry['sha256'] for name, entry in sorted(self.entries.items())}
+
+    def save(self):
+        """Write manifest, if changed. Failure to write (e.g. read-only mount) is ignored."""
+        if not self.changed:
+            return False
+
+        try:
+            self.path.parent.mkdir(exist_ok=True)
+            temp_path = self.path.with_suffix('.tmp')
+            temp_path.write_text(json.dumps({'version': VERSION, 'migrations': self.entries}, sort_keys=True))
+            temp_path.replace(self.path)
+        except OSError:
+            return False
+
+        self.changed = False
+        return True
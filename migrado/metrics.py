@@ -0,0 +1,134 @@
+"""
+Migrado run metrics
+
+Copyright © 2019 Protojour AS, licensed under MIT.
+See LICENSE.txt for details.
+"""
+
+from threading import Lock
+import time
+
+
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def format_labels(labels):
+    """Format metric labels, escaped as in the Prometheus text format"""
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels.items()
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class RunMetrics:
+    """
+    Metrics of a migration run, written as a Prometheus/OpenMetrics text file
+    (e.g. for the node-exporter textfile collector, or to push to a Pushgateway)
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time.time()
+        self.ended = None
+        self.success = None
+        self.migrations = []
+        self.retries = {}
+
+    def observe(self, db, entry):
+        """Add applied migration, given its history entry (see utils.history_entry)"""
+        with self.lock:
+            self.migrations.append((db, entry))
+            if len(entry['executors']) > 1:
+                self.retries[db] = self.retries.get(db, 0) + len(entry['executors']) - 1
+
+    def retry(self, db):
+        """Count a migration (or coalesced group) run again after failing"""
+        with self.lock:
+            self.retries[db] = self.retries.get(db, 0) + 1
+
+    def finish(self, success):
+        self.ended = time.time()
+        self.success = success
+
+    def render(self):
+        """Render metrics in the Prometheus text format"""
+        lines = []
+
+        def metric(name, type_, help_, samples):
+            lines.append(f'# HELP {name} {help_}')
+            lines.append(f'# TYPE {name} {type_}')
+            for suffix, labels, value in samples:
+                lines.append(f'{name}{suffix}{format_labels(labels)} {value!r}')
+
+        histograms = {}
+        for db, entry in self.migrations:
+            labels = (db, entry['direction'], entry['executors'][-1])
+            histograms.setdefault(labels, []).append(entry['duration'])
+
+        samples = []
+        for (db, direction, executor), durations in sorted(histograms.items()):
+            labels = {'db': db, 'direction': direction, 'executor': executor}
+            for bucket in DURATION_BUCKETS:
+                count = sum(duration <= bucket for duration in durations)
+                samples.append(('_bucket', {**labels, 'le': f'{bucket:g}'}, count))
+            samples.append(('_bucket', {**labels, 'le': '+Inf'}, len(durations)))
+            samples.append(('_sum', labels, sum(durations)))
+            samples.append(('_count', labels, len(durations)))
+        metric('migrado_migration_duration_seconds', 'histogram',
+            'Duration of applied migrations, by executor', samples)
+
+        # latest entry of each migration, in case it was applied more than once
+        latest = {(db, entry['migration_id'], entry['direction']): entry for db, entry in self.migrations}
+        metric('migrado_migration_last_duration_seconds', 'gauge',
+            'Duration of each applied migration in this run', [
+                ('', {'db': db, 'migration_id': id_, 'direction': direction}, entry['duration'])
+                for (db, id_, direction), entry in latest.items()
+            ])
+
+        counts = {}
+        for db, entry in self.migrations:
+            key = (db, entry['executors'][-1])
+            counts[key] = counts.get(key, 0) + 1
+        metric('migrado_migrations_total', 'counter',
+            'Applied migrations, by executor', [
+                ('', {'db': db, 'executor': executor}, count)
+                for (db, executor), count in sorted(counts.items())
+            ])
+
+        metric('migrado_retries_total', 'counter',
+            'Migrations run again after failing (transaction fallback to arangosh, coalesced groups)', [
+                ('', {'db': db}, count) for db, count in sorted(self.retries.items())
+            ])
+
+        batches = [
+            ({'db': db, 'migration_id': id_, 'direction': direction}, entry)
+            for (db, id_, direction), entry in latest.items() if entry.get('documents') is not None
+        ]
+        metric('migrado_batch_documents_total', 'counter',
+            'Documents processed by batch migrations', [
+                ('', labels, entry['documents']) for labels, entry in batches
+            ])
+        metric('migrado_batch_documents_per_second', 'gauge',
+            'Documents processed per second by batch migrations', [
+                ('', labels, entry['documents'] / entry['duration'] if entry['duration'] else 0.0)
+                for labels, entry in batches
+            ])
+
+        ended = self.ended or time.time()
+        metric('migrado_run_duration_seconds', 'gauge',
+            'Total run time', [('', {}, ended - self.started)])
+        metric('migrado_run_success', 'gauge',
+            'Whether the run succeeded (1) or failed (0)', [('', {}, int(bool(self.success)))])
+        metric('migrado_run_timestamp_seconds', 'gauge',
+            'Time the run ended, as a Unix timestamp', [('', {}, ended)])
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write metrics to file, atomically, so a textfile collector never reads a partial file"""
+        temp_path = path.with_name(path.name + '.tmp')
+        temp_path.write_text(self.render())
+        temp_path.replace(path)
@@ -5,17 +5,32 @@ Copyright © 2019 Protojour AS, licensed under MIT.
 See LICENSE.txt for details.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
 import json
+import time
 
 import click
 import yaml
 
-from .constants import MIGRATION_TEMPLATE
+from arango.exceptions import ArangoError
+
+from .batch import split_ranges, process_ranges
+from .constants import MIGRATION_TEMPLATE, PYTHON_MIGRATION_TEMPLATE, STATE_CURRENT, STATE_BEHIND, STATE_AHEAD
 from .db_client import MigrationClient
+from .lock import MigrationLock
+from .manifest import Manifest
+from .metrics import RunMetrics
+from .runner import MigrationRunner
+from .snapshot import find_snapshot, write_snapshot, restore_snapshot
+from .throttle import RateController
+from .tracing import Tracer
 from .utils import (
     ensure_path, check_migrations, check_db, check_password,
-    select_migrations, parse_write_collections,
-    extract_migration, extract_schema, get_options
+    split_databases, is_pattern, match_databases, select_migrations,
+    find_migrations, find_baseline, classify_migration, extract_query, batch_query,
+    history_entry, get_options, schema_migration
 )
 
 
@@ -66,6 +81,18 @@ pass_option = click.option(
     help=('Specify database password to use for running migrations. If only username is given, ' +
     'Migrado will prompt for password.')
 )
+target_option = click.option(
+    '-t', '--target',
+    help='Specify a four-digit target migration id'
+)
+state_option = click.option(
+    '-s', '--state',
+    help='Override current state migration id'
+)
+max_transaction_size_option = click.option(
+    '--max-transaction-size', type=int,
+    help='Specify RocksDB max transaction size in bytes'
+)
 timeout_option = click.option(
     '--timeout', type=int,
     default=1200, show_default=True,
@@ -76,6 +103,19 @@ validation_option = click.option(
     type=click.Choice(['none', 'new', 'moderate', 'strict']),
     help='Write collection validation rules from YAML schema at given level'
 )
+history_option = click.option(
+    '--history', is_flag=True,
+    help='Record applied migrations and their durations in the migration history collection'
+)
+environment_option = click.option(
+    '-e', '--environment',
+    envvar='MIGRADO_ENV', show_envvar=True,
+    help='Specify environment name to record in migration history (default: host:port)'
+)
+metrics_option = click.option(
+    '--metrics', 'metrics_path', type=click.Path(dir_okay=False),
+    help='Write run metrics to file in Prometheus text format (e.g. for the node-exporter textfile collector)'
+)
 yes_option = click.option(
     '-y', '--no-interaction', is_flag=True,
     help='Do not show interaction queries (assume \'yes\')'
@@ -133,8 +173,6 @@ def init(schema, infer, validation, path,
         return click.echo('Initial migration already exists.')
 
     initial_data = MIGRATION_TEMPLATE
-    forward_data = []
-    reverse_data = []
 
     if infer:
         check_db(db)
@@ -152,33 +190,7 @@ def init(schema, infer, validation, path,
         if not isinstance(schema, dict):
             schema = yaml.safe_load(schema)
 
-        schema = {
-            'collections': schema.get('collections', {}),
-            'edge_collections': schema.get('edge_collections', {})
-        }
-        forward_data.append(f'var schema = {json.dumps(schema)}')
-
-        for name, props in schema.get('collections', {}).items():
-            options = get_options(props, validation)
-            forward_data.append(f'db._create("{name}", {json.dumps(options)})')
-            reverse_data.append(f'db._drop("{name}")')
-
-        for name, props in schema.get('edge_collections', {}).items():
-            options = get_options(props, validation)
-            forward_data.append(f'db._create("{name}", {json.dumps(options)}, "edge")')
-            reverse_data.append(f'db._drop("{name}")')
-
-    if forward_data:
-        initial_data = initial_data.replace(
-            '// add your forward migration here',
-            '\n    '.join(forward_data)
-        )
-
-    if reverse_data:
-        initial_data = initial_data.replace(
-            '// add your reverse migration here',
-            '\n    '.join(reverse_data)
-        )
+        initial_data = schema_migration(schema, validation)
 
     initial_path.write_text(initial_data)
     initial_path.chmod(0o755)
@@ -187,6 +199,15 @@ def init(schema, infer, validation, path,
 
 
 @migrado.command()
+@click.option(
+    '--history', is_flag=True,
+    help='Show the slowest migrations recorded in migration history (see run --history)'
+)
+@click.option(
+    '--limit', type=int,
+    default=10, show_default=True,
+    help='Number of migrations to show with --history'
+)
 @path_option
 @db_option
 @coll_option
@@ -196,12 +217,16 @@ def init(schema, infer, validation, path,
 @user_option
 @pass_option
 @yes_option
-def inspect(path, db, state_coll, tls, host, port, username, password, no_interaction):
+def inspect(history, limit, path, db, state_coll, tls, host, port, username, password, no_interaction):
     """
     Inspect the current state of migrations.
+
+    With --history, also shows the slowest migrations recorded in migration
+    history, by latest duration, with the change from the previous run in the
+    same environment.
     """
     migrations_path = ensure_path(path)
-    migrations = sorted(migrations_path.glob('[0-9]' * 4 + '*.js'))
+    migrations = find_migrations(migrations_path)
     last_migration = migrations[-1]
     last_counter = last_migration.name[:4]
 
@@ -215,6 +240,84 @@ def inspect(path, db, state_coll, tls, host, port, username, password, no_intera
     click.echo(f'Database migration state is at {db_state}.')
     click.echo(f'Latest migration on disk is {last_counter}.')
 
+    if history:
+        echo_history(db_client.read_history(limit))
+
+
+def echo_history(entries, echo=click.echo):
+    """Show migration history summary"""
+    if not entries:
+        return echo('No migration history found.')
+
+    echo('Slowest migrations:')
+    for entry in entries:
+        line = (f'  {entry["migration_id"]} {entry["direction"]} ({entry["environment"]}): '
+            f'{entry["duration"]:.3f}s, {" then ".join(entry["executors"])}')
+        if entry['previous']:
+            change = (entry['duration'] - entry['previous']) / entry['previous']
+            line += f', previously {entry["previous"]:.3f}s ({change:+.0%})'
+        if entry['documents'] is not None:
+            line += f', {entry["documents"]} documents'
+        echo(line + f' (last of {entry["runs"]} at {entry["started"]})')
+
+
+@migrado.command()
+@path_option
+@db_option
+@coll_option
+@tls_option
+@host_option
+@port_option
+@user_option
+@pass_option
+@click.option(
+    '--timeout', type=float,
+    default=5, show_default=True,
+    help='Request timeout in seconds'
+)
+@yes_option
+def check(path, db, state_coll, tls, host, port, username, password, timeout, no_interaction):
+    """
+    Check if the database is at the latest migration.
+
+    Reads migration state in a single request, without retries, and compares it
+    to the latest migration on disk (or in the migration manifest, if there are no
+    migration files). Suitable for readiness checks, as it does not parse migrations
+    or require arangosh.
+
+    Exits with code 0 if the database is current, 3 if it is behind, and 4 if it is
+    ahead of the latest migration.
+    """
+    migrations_path = Path(path)
+    names = [migration.name for migration in find_migrations(migrations_path)]
+    names = names or sorted(Manifest(migrations_path).entries)
+
+    check_migrations(names)
+    check_db(db)
+    password = check_password(username, password, no_interaction)
+
+    latest = names[-1][:4]
+
+    db_client = MigrationClient(tls, host, port, username, password, db, state_coll, timeout, retry=False)
+
+    try:
+        db_state = db_client.read_state()
+    except Exception as error:
+        click.echo('Error! %s' % error)
+        raise click.Abort()
+
+    if db_state == latest:
+        status, code = 'current', STATE_CURRENT
+    elif db_state < latest:
+        status, code = 'behind', STATE_BEHIND
+    else:
+        status, code = 'ahead', STATE_AHEAD
+
+    click.echo(f'Database migration state is at {db_state}, latest migration is {latest} ({status}).')
+
+    if code != STATE_CURRENT:
+        raise click.exceptions.Exit(code)
+
 
 @migrado.command()
 @click.argument('filename', type=click.File('w'), required=False)
@@ -263,6 +366,10 @@ def export(filename, validation, db, state_coll, tls, host, port, username, pass
     type=click.File('r'),
     help='Build schema migration diff from updated YAML schema'
 )
+@click.option(
+    '--python', is_flag=True,
+    help='Make a Python migration template'
+)
 @validation_option
 @path_option
 @db_option
@@ -273,17 +380,22 @@ def export(filename, validation, db, state_coll, tls, host, port, username, pass
 @user_option
 @pass_option
 @yes_option
-def make(name, schema, validation,
+def make(name, schema, python, validation,
         path, db, state_coll, tls, host, port, username, password, no_interaction):
     """
     Make a new migration template or generate schema migration.
 
     Migration will be prefixed by the next available migration id, e.g. 0002.
     Non-schema migrations must be edited manually.
+
+    With --python, a Python migration is made, with forward(db) and reverse(db)
+    functions receiving a stream transaction.
     """
+    if python and schema:
+        raise click.UsageError('Schema migrations can not be made as Python migrations.')
 
     migrations_path = ensure_path(path)
-    migrations = sorted(migrations_path.glob('[0-9]' * 4 + '*.js'))
+    migrations = find_migrations(migrations_path)
 
     check_migrations(migrations)
 
@@ -291,13 +403,14 @@ def make(name, schema, validation,
     last_counter = last_migration.name[:4]
     counter = str(int(last_counter) + 1).zfill(4)
 
-    filename = f'{counter}.js'
+    suffix = '.py' if python else '.js'
+    filename = f'{counter}{suffix}'
     if name:
-        filename = f'{counter}_{name}.js'
+        filename = f'{counter}_{name}{suffix}'
 
     migration_path = migrations_path.joinpath(filename)
 
-    initial_data = MIGRATION_TEMPLATE
+    initial_data = PYTHON_MIGRATION_TEMPLATE if python else MIGRATION_TEMPLATE
     forward_data = []
     reverse_data = []
 
@@ -392,7 +505,8 @@ def make(name, schema, validation,
             )
 
     migration_path.write_text(initial_data)
-    migration_path.chmod(0o755)
+    if not python:
+        migration_path.chmod(0o755)
 
     if schema:
         click.echo(f'Schema migration written to {migration_path}.')
@@ -402,12 +516,88 @@ def make(name, schema, validation,
 
 @migrado.command()
 @click.option(
-    '-t', '--target',
-    help='Specify a four-digit target migration id'
+    '--upto', required=True,
+    help='Specify four-digit id of the last migration to squash'
 )
+@validation_option
+@path_option
+@yes_option
+def squash(upto, validation, path, no_interaction):
+    """
+    Squash migrations into one baseline schema migration.
+
+    Migrations up to and including the given id are replaced by a generated
+    schema migration with the same id, creating the collections of the latest
+    schema declared in them (see 'var schema' in migration scripts). The
+    original migration files are moved to the 'squashed' directory inside the
+    migrations directory.
+
+    Fresh databases start from the baseline. Databases with state at or beyond
+    the given id are unaffected. Databases with state before it can not be
+    migrated until the original migrations have been run against them.
+
+    The effects of data migrations are not part of the baseline, you will be
+    asked to confirm if any migrations up to the given id are not schema migrations.
+    """
+    migrations_path = ensure_path(path)
+    migrations = find_migrations(migrations_path)
+
+    check_migrations(migrations)
+
+    squashed = [migration for migration in migrations if migration.name[:4] <= upto]
+    if not squashed or squashed[-1].name[:4] != upto:
+        raise click.UsageError(f'Migration {upto} not found, please specify a four-digit migration id.')
+
+    manifest = Manifest(migrations_path)
+    parsed_migrations = manifest.load_all(migrations)
+    squashed_ids = [migration.name[:4] for migration in squashed]
+
+    schema = next(
+        (parsed_migrations[id_]['schema'] for id_ in reversed(squashed_ids) if parsed_migrations[id_]['schema']),
+        None
+    )
+    if not schema:
+        click.echo(f'Error! No schema found in migrations up to {upto}.')
+        raise click.Abort()
+
+    data_ids = [
+        id_ for id_ in squashed_ids
+        if classify_migration(parsed_migrations[id_]['forward'], parsed_migrations[id_]['executor'])[0] != 'native'
+    ]
+    if data_ids and not no_interaction:
+        click.confirm(
+            f'Migrations {", ".join(data_ids)} are not schema migrations, and their effects '
+            'will not be part of the baseline. Continue?', abort=True
+        )
+
+    archive_path = ensure_path(migrations_path.joinpath('squashed'))
+    baseline = find_baseline(migrations)
+    for migration in squashed:
+        if migration.name[:4] == baseline:
+            # a previous baseline is generated, and its originals are already archived
+            migration.unlink()
+        else:
+            migration.rename(archive_path.joinpath(migration.name))
+
+    baseline_path = migrations_path.joinpath(f'{upto}_squashed.js')
+    baseline_path.write_text(schema_migration(schema, validation, f'squashed migrations up to {upto}'))
+    baseline_path.chmod(0o755)
+
+    manifest.load_all(find_migrations(migrations_path))
+    manifest.save()
+
+    click.echo(f'Migrations up to {upto} squashed into {baseline_path}, originals moved to {archive_path}.')
+
+
+@migrado.command()
 @click.option(
-    '-s', '--state',
-    help='Override current state migration id'
+    '-w', '--workers', type=int,
+    default=4, show_default=True,
+    help='Number of collections to export concurrently'
+)
+@click.option(
+    '--force', is_flag=True,
+    help='Overwrite an existing snapshot for the current state'
 )
 @path_option
 @db_option
@@ -417,10 +607,102 @@ def make(name, schema, validation,
 @port_option
 @user_option
 @pass_option
+@yes_option
+def snapshot(workers, force, path, db, state_coll, tls, host, port, username, password, no_interaction):
+    """
+    Write a snapshot of the database at its current state.
+
+    Collections (with indexes and validation rules) and their documents are
+    written as gzipped JSON lines to the snapshots directory in the migrations
+    directory, in a subdirectory named by the current migration id.
+
+    When run against an empty database, run restores the latest snapshot up to
+    its target, and applies only the migrations after it.
+    """
+    migrations_path = ensure_path(path)
+    check_db(db)
+    password = check_password(username, password, no_interaction)
+
+    db_client = MigrationClient(tls, host, port, username, password, db, state_coll)
+
+    try:
+        state = db_client.read_state()
+    except Exception as error:
+        click.echo('Error! %s' % error)
+        raise click.Abort()
+
+    if state == '0000':
+        click.echo('Error! No migrations have been applied, nothing to snapshot.')
+        raise click.Abort()
+
+    snapshot_path = migrations_path.joinpath('snapshots', state)
+    if snapshot_path.exists() and not force:
+        click.echo(f'Error! Snapshot {state} already exists, use --force to overwrite it.')
+        raise click.Abort()
+
+    click.echo(f'Writing snapshot at {state}...')
+    try:
+        manifest = write_snapshot(db_client, snapshot_path, state, workers)
+    except Exception as error:
+        click.echo('Error! %s' % error)
+        raise click.Abort()
+
+    count = sum(collection['count'] for collection in manifest['collections'])
+    click.echo(f'Snapshot of {len(manifest["collections"])} collections '
+        f'({count} documents) written to {snapshot_path}.')
+
+
+@migrado.command()
 @click.option(
-    '--max-transaction-size', type=int,
-    help='Specify RocksDB max transaction size in bytes'
+    '--check', is_flag=True,
+    help='Fail if the stored manifest does not match the migration files, without updating it'
 )
+@path_option
+def manifest(check, path):
+    """
+    Compile the migration manifest.
+
+    Migrado keeps parsed migrations in a manifest (.migrado/manifest.json in
+    the migrations directory), keyed by file size, mtime and content hash,
+    so unchanged migration files are not parsed again.
+
+    Updates the manifest, and lists the content hash of each migration file.
+    """
+    migrations_path = ensure_path(path)
+    migrations = find_migrations(migrations_path)
+
+    check_migrations(migrations)
+
+    compiled = Manifest(migrations_path)
+    stored = compiled.checksums()
+    # when checking, every file is hashed, not trusting unchanged sizes and mtimes
+    compiled.load_all(migrations, verify=check)
+    checksums = compiled.checksums()
+
+    for name, checksum in checksums.items():
+        click.echo(f'{checksum}  {name}')
+
+    if check:
+        if stored != checksums:
+            click.echo('Manifest is out of date, run migrado manifest.')
+            raise click.Abort()
+        return
+
+    compiled.save()
+
+
+@migrado.command()
+@target_option
+@state_option
+@path_option
+@db_option
+@coll_option
+@tls_option
+@host_option
+@port_option
+@user_option
+@pass_option
+@max_transaction_size_option
 @click.option(
     '--intermediate-commit-size', type=int,
     help='Specify RocksDB transaction size in bytes before making intermediate commits'
@@ -432,17 +714,68 @@ def make(name, schema, validation,
 @timeout_option
 @click.option(
     '--async', 'async_', is_flag=True,
-    help='Run transactions asynchronously'
+    help='Run transactions without waiting for them to be synced to disk'
+)
+@click.option(
+    '--async-job', is_flag=True,
+    help='Submit transactions as server-side async jobs, and poll for their results'
+)
+@click.option(
+    '--coalesce', is_flag=True,
+    help='Run consecutive transaction migrations together in one transaction'
+)
+@click.option(
+    '--parallel', type=click.IntRange(min=1),
+    help='Run up to this many independent migrations concurrently (see // depends)'
+)
+@click.option(
+    '--transform-workers', type=click.IntRange(min=1),
+    help='Number of worker processes for transform and rewrite migrations  [default: number of CPUs]'
 )
 @click.option(
     '-a', '--arangosh', type=click.Path(),
     default='arangosh', help='Use arangosh from given path'
 )
+@click.option(
+    '--plan', is_flag=True,
+    help='Show pending migrations and how each will be run, without running them'
+)
+@click.option(
+    '--concurrency', type=int,
+    default=8, show_default=True,
+    help='Number of databases to migrate concurrently, when running against several databases'
+)
+@click.option(
+    '--trace', type=click.File('w'),
+    help='Write timed spans (file reads, parsing, HTTP requests, transactions, arangosh) to file'
+)
+@click.option(
+    '--trace-format', type=click.Choice(['jsonl', 'chrome']),
+    default='jsonl', show_default=True,
+    help='Write trace as JSON lines, or in Chrome trace event format (for chrome://tracing or Perfetto)'
+)
+@history_option
+@environment_option
+@metrics_option
+@click.option(
+    '--lock', is_flag=True,
+    help='Hold the migration lock while running, and wait for other runners holding it'
+)
+@click.option(
+    '--lock-ttl', type=int,
+    default=30, show_default=True,
+    help='Migration lock lease in seconds, renewed while running'
+)
+@click.option(
+    '--no-snapshot', is_flag=True,
+    help='Do not restore a snapshot into an empty database, run all migrations instead'
+)
 @yes_option
 def run(target, state,
         path, db, state_coll, tls, host, port, username, password,
         max_transaction_size, intermediate_commit_size, intermediate_commit_count,
-        timeout, async_, arangosh, no_interaction):
+        timeout, async_, async_job, coalesce, parallel, transform_workers, arangosh, plan, concurrency, trace, trace_format,
+        history, environment, metrics_path, lock, lock_ttl, no_snapshot, no_interaction):
     """
     Run all migrations, or migrate to a specific target.
 
@@ -457,9 +790,331 @@ def run(target, state,
 
     State and schemas are written as metadata to the configured database
     (see --db, --state-coll).
+
+    Each migration is routed to an executor before it runs: generated schema
+    migrations run natively through the HTTP API, migrations that create or drop
+    collections or indexes run through arangosh, and other migrations run in a
+    transaction. Add a '// executor native|transaction|arangosh' line to a
+    migration script to choose explicitly. Use --plan to show the routing.
+    Python migrations (NNNN_name.py) run their forward(db) or reverse(db)
+    function with a stream transaction. Transform migrations (Python migrations
+    with a transform(document) function) stream documents through a pool of
+    worker processes (see --transform-workers), and write them back in bulk.
+    Rewrite migrations (Python migrations with a rewrite(document) function)
+    rewrite a collection into a shadow collection, and swap it in.
+
+    With --coalesce, consecutive transaction migrations are run together in one
+    transaction, writing to the union of their declared write collections. If the
+    combined transaction fails, the failing migration is reported, and the
+    migrations are run again one at a time.
+
+    With --parallel, independent migrations are run concurrently. A migration
+    depends on the earlier migrations it lists in '// depends 0001 0002' lines,
+    and on earlier migrations with overlapping '// write' collections. Reads are
+    not tracked, so use '// depends' for migrations reading what another writes.
+    Migrations not run in a transaction, or storing a schema, are run on their
+    own. State is the last migration of the longest applied prefix, and any
+    migrations applied ahead of it are recorded with it, so an interrupted run
+    is resumed (or reversed) without running migrations twice.
+
+    With --async-job, transactions are submitted as server-side async jobs, and
+    polled with backoff until done, so no request is held open while a long
+    migration runs (see --timeout).
+
+    With --history, each applied migration is recorded in the migration history
+    collection (the state collection name with a '_history' suffix), with its
+    direction, executors, start and end time and duration. See inspect --history.
+
+    With --metrics, run metrics (migration durations by executor, retries,
+    batch throughput, total run time and success) are written to the given file
+    in Prometheus text format when the run ends, also if it failed.
+
+    To migrate several databases, give --db as a comma-separated list of
+    database names and/or glob patterns (e.g. 'tenant_*'). Databases are
+    migrated concurrently (see --concurrency), and a summary is shown at the end.
+
+    With --lock, a runner holds a lock document in the state collection while
+    running, renewing its lease (see --lock-ttl) until done. Other runners wait
+    for it, and exit once state reaches the target. A lock left by a runner
+    that died is taken over when its lease expires.
+
+    If the database is empty (state is 0000, and there are no collections) and
+    a snapshot exists (see snapshot), the latest snapshot up to the target is
+    restored with concurrent bulk imports, and only later migrations are run.
+    Use --no-snapshot to run all migrations instead.
+    """
+    migrations_path = ensure_path(path)
+    migrations = find_migrations(migrations_path)
+    migrations_dict = {migration.name[:4]: migration for migration in migrations}
+    migration_ids = [id_ for id_ in migrations_dict]
+
+    check_migrations(migrations)
+    check_db(db)
+
+    target = target or migration_ids[-1]
+    if target not in migration_ids:
+        raise click.UsageError(f'Target {target} not found, please specify a four-digit migration id.')
+
+    if parallel and coalesce:
+        raise click.UsageError('--parallel can not be combined with --coalesce.')
+
+    password = check_password(username, password, no_interaction)
+
+    snapshot_path = None if no_snapshot else find_snapshot(migrations_path, target)
+
+    tracer = Tracer(enabled=trace is not None)
+    metrics = RunMetrics() if metrics_path else None
+    failed = False
+    try:
+        with tracer.span('run', target=target):
+            manifest = Manifest(migrations_path, tracer)
+            runner = MigrationRunner(manifest.load_all(migrations), arangosh,
+                max_transaction_size, intermediate_commit_size, intermediate_commit_count,
+                not async_, coalesce, async_job, (environment or f'{host}:{port}') if history else None,
+                metrics, find_baseline(migrations), parallel, transform_workers
+            )
+            manifest.save()
+
+            db_names = split_databases(db)
+            if len(db_names) > 1 or is_pattern(db):
+                return run_databases(runner, db_names, target, state,
+                    tls, host, port, username, password, state_coll, timeout, plan, concurrency,
+                    lock_ttl if lock else None, tracer, snapshot_path)
+
+            db_client = MigrationClient(tls, host, port, username, password, db, state_coll, timeout,
+                tracer=tracer)
+
+            if plan:
+                try:
+                    state = state or db_client.read_state()
+                except Exception as error:
+                    click.echo('Error! %s' % error)
+                    raise click.Abort()
+                return echo_plan(runner, state, target)
+
+            for _ in run_migrations(runner, db_client, state, target, lock_ttl if lock else None,
+                    snapshot_path):
+                pass
+
+            click.echo('Done.')
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        if trace:
+            write_trace(tracer, trace, trace_format)
+        if metrics:
+            write_metrics(metrics, metrics_path, not failed)
+
+
+def write_trace(tracer, file, format):
+    """Write trace spans to file, and show a summary"""
+    tracer.write(file, format)
+    click.echo(f'Trace written to {file.name}:')
+    for name, (count, duration) in tracer.summary().items():
+        click.echo(f'  {name}: {count} in {duration:.3f}s')
+
+
+def write_metrics(metrics, path, success):
+    """Write run metrics to file"""
+    metrics.finish(success)
+    try:
+        metrics.write(Path(path))
+    except OSError as error:
+        click.echo('Warning! Metrics not written: %s' % error)
+        return
+    click.echo(f'Metrics written to {path}.')
+
+
+def run_migrations(runner, db_client, state, target, lock_ttl=None, snapshot_path=None,
+        echo=click.echo, applied=None):
+    """
+    Run migrations from `state` (or current state) to `target`, yielding migration ids
+    as state is written. Migrations `applied` ahead of a given state are passed on to
+    the runner, which reads them otherwise. If `lock_ttl` is given, the migration lock
+    is held while running, waiting while another runner holds it. If `snapshot_path`
+    is given and the database is empty, the snapshot is restored first.
+    """
+    migration_lock = MigrationLock(db_client, lock_ttl, echo=echo) if lock_ttl else None
+
+    restored = False
+    try:
+        if migration_lock and not migration_lock.wait(target, echo):
+            # another runner migrated to target while we waited
+            echo(f'State is now at {target}.')
+            yield target
+            return
+        if not state:
+            state, applied = db_client.read_state_applied()
+        if snapshot_path and state == '0000' and db_client.is_empty():
+            echo(f'Restoring snapshot {snapshot_path.name}...')
+            with db_client.tracer.span('snapshot', migration_id=snapshot_path.name):
+                count = restore_snapshot(db_client, snapshot_path)
+            state = snapshot_path.name
+            restored = True
+            echo(f'Restored {count} documents. State is now at {state}.')
+    except Exception as error:
+        echo('Error! %s' % error)
+        if migration_lock:
+            migration_lock.release()
+        raise click.Abort()
+
+    if restored:
+        yield state
+
+    try:
+        yield from runner.run(db_client, state, target, echo, migration_lock, applied)
+    finally:
+        if migration_lock:
+            migration_lock.release()
+
+
+def echo_plan(runner, state, target, echo=click.echo):
+    """Show pending migrations and their executors"""
+    runner.check_state(state, echo)
+    direction, plan = runner.plan(state, target)
+    if not plan:
+        return echo(f'State is at {state}, nothing to run.')
+
+    echo(f'Plan for {direction} migration from {state} to {target}:')
+    for id_, executor in plan:
+        echo(f'  {id_}: {executor}')
+
+
+def run_databases(runner, db_names, target, state,
+        tls, host, port, username, password, state_coll, timeout, plan, concurrency,
+        lock_ttl=None, tracer=None, snapshot_path=None):
+    """Run migrations against several databases concurrently, sharing one client"""
+    client = MigrationClient(tls, host, port, username, password, '_system', state_coll, timeout,
+        tracer=tracer, pool_size=max(concurrency * (runner.parallel or 1), 10))
+
+    try:
+        databases = match_databases(db_names, client.list_databases()) if any(
+            is_pattern(name) for name in db_names) else db_names
+    except Exception as error:
+        click.echo('Error! %s' % error)
+        raise click.Abort()
+
+    if not databases:
+        raise click.UsageError(f'No databases found matching {", ".join(db_names)}.')
+
+    click.echo(f'Running migrations against {len(databases)} databases...')
+
+    def run_database(db_name):
+        def echo(message):
+            click.echo(f'[{db_name}] {message}')
+
+        db_client = MigrationClient(tls, host, port, username, password, db_name, state_coll,
+            timeout, client.db_client, tracer=tracer)
+        reached = applied = None
+        try:
+            if state:
+                reached = state
+            else:
+                reached, applied = db_client.read_state_applied()
+            if plan:
+                echo_plan(runner, reached, target, echo)
+                return db_name, reached, 'ok'
+            # with the lock held, state is read again once the lock is acquired
+            start, applied = (state, None) if lock_ttl else (reached, applied)
+            for id_ in run_migrations(runner, db_client, start, target, lock_ttl, snapshot_path, echo,
+                    applied):
+                reached = id_
+        except click.Abort:
+            return db_name, reached, 'failed'
+        except Exception as error:
+            echo('Error! %s' % error)
+            return db_name, reached, 'failed'
+
+        return db_name, reached, 'ok'
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(run_database, databases))
+
+    click.echo('Summary:')
+    for db_name, reached, status in results:
+        if status == 'ok':
+            click.echo(f'  {db_name}: state is at {reached}.')
+        else:
+            click.echo(f'  {db_name}: failed, state is at {reached or "unknown"}.')
+
+    failed = [db_name for db_name, _, status in results if status != 'ok']
+    if failed:
+        click.echo(f'{len(failed)} of {len(results)} databases failed.')
+        raise click.Abort()
+
+    click.echo('Done.')
+
+
+@migrado.command()
+@target_option
+@state_option
+@click.option(
+    '-b', '--batch-size', type=int,
+    default=1000, show_default=True,
+    help='Number of documents to process per batch'
+)
+@click.option(
+    '-w', '--workers', type=int,
+    default=1, show_default=True,
+    help='Number of key ranges to process concurrently'
+)
+@click.option(
+    '--restart', is_flag=True,
+    help='Ignore any stored checkpoint and start from the first document'
+)
+@click.option(
+    '--max-rate', type=click.FloatRange(min=0, min_open=True),
+    help='Process at most this many documents per second'
+)
+@click.option(
+    '--adaptive', is_flag=True,
+    help='Adapt batch size and workers to observed latency and errors'
+)
+@click.option(
+    '--target-latency', type=click.FloatRange(min=0, min_open=True),
+    help='Adapt batch size and workers to keep batches under this many seconds (implies --adaptive)'
+)
+@path_option
+@db_option
+@coll_option
+@tls_option
+@host_option
+@port_option
+@user_option
+@pass_option
+@max_transaction_size_option
+@timeout_option
+@history_option
+@environment_option
+@metrics_option
+@yes_option
+def batch(target, state, batch_size, workers, restart, max_rate, adaptive, target_latency,
+        path, db, state_coll, tls, host, port, username, password,
+        max_transaction_size, timeout, history, environment, metrics_path, no_interaction):
+    """
+    Run data migrations in resumable batches.
+
+    Works like run, but executes the AQL query of each migration
+    (the first db._query() call in forward() or reverse()) over successive
+    _key ranges of at most --batch-size documents, instead of in one transaction.
+
+    With --workers, the _key space is split into key ranges of similar size,
+    which are processed concurrently.
+
+    A checkpoint is stored in the state collection after each batch. If a batch
+    run is interrupted, running it again resumes from the checkpoint.
+
+    To limit load on a live server, --max-rate caps the documents processed per
+    second. With --adaptive, the batch size and number of active workers are
+    adjusted after each batch: grown while batches stay fast, and cut back when
+    batch latency rises (or exceeds --target-latency), or a batch fails, in which
+    case it is retried with a smaller batch size.
+
+    See run for --history and --metrics.
     """
     migrations_path = ensure_path(path)
-    migrations = sorted(migrations_path.glob('[0-9]' * 4 + '*.js'))
+    migrations = find_migrations(migrations_path)
     migrations_dict = {migration.name[:4]: migration for migration in migrations}
     migration_ids = [id_ for id_ in migrations_dict]
 
@@ -476,39 +1131,82 @@ def run(target, state,
 
     try:
         state = state or db_client.read_state()
+        checkpoint = None if restart else db_client.read_checkpoint()
     except Exception as error:
         click.echo('Error! %s' % error)
         raise click.Abort()
 
-    direction, migration_ids = select_migrations(state, target, migration_ids)
+    manifest = Manifest(migrations_path)
+    parsed_migrations = manifest.load_all(migrations)
+    manifest.save()
 
-    for id_ in migration_ids:
-        script = migrations_dict[id_].read_text()
-        write_collections = parse_write_collections(script)
-        migration = extract_migration(script, direction)
+    direction, migration_ids = select_migrations(state, target, migration_ids)
 
-        click.echo(f'Running {direction} migration {id_} in transaction...')
-        error = db_client.run_transaction(migration, write_collections,
-            max_transaction_size, intermediate_commit_size, intermediate_commit_count,
-            not async_
-        )
+    metrics = RunMetrics() if metrics_path else None
+    failed = False
+    def on_progress(id_, throttle, index, ranges):
+        db_client.write_checkpoint(id_, direction, ranges)
+        if ranges[index]['done']:
+            return
+        adjusted = ''
+        if throttle and throttle.adaptive:
+            adjusted = f' (batch size {throttle.batch_size}, {throttle.concurrency} active workers)'
+        if len(ranges) > 1:
+            click.echo(f'Worker {index + 1}: processed {ranges[index]["processed"]} documents{adjusted}.')
+        else:
+            click.echo(f'Processed {ranges[index]["processed"]} documents{adjusted}.')
 
-        if error:
-            click.echo('Error! %s' % error)
+    try:
+        for id_ in migration_ids:
+            migration = parsed_migrations[id_][direction]
+            collection, query = batch_query(extract_query(migration))
 
-            click.echo(f'Running {direction} migration {id_} as schema migration...')
-            error = db_client.run_script(migration, arangosh)
+            if not query:
+                click.echo(f'Error! No batchable query found in {direction} migration {id_}.')
+                raise click.Abort()
 
-            if error:
+            throttle = RateController(batch_size, workers, max_rate, adaptive, target_latency) if (
+                max_rate or adaptive or target_latency) else None
+
+            started = time.time()
+            resumed_from = 0
+            try:
+                if checkpoint and checkpoint['migration_id'] == id_ and checkpoint['direction'] == direction:
+                    ranges = checkpoint['ranges']
+                    resumed_from = sum(range_['processed'] for range_ in ranges)
+                    click.echo(f'Resuming {direction} migration {id_} from checkpoint...')
+                else:
+                    ranges = split_ranges(db_client, collection, workers)
+                    click.echo(f'Running {direction} migration {id_} in batches of {batch_size}...')
+
+                process_ranges(db_client, query, ranges, batch_size, workers,
+                    max_transaction_size, partial(on_progress, id_, throttle), throttle)
+            except ArangoError as error:
                 click.echo('Error! %s' % error)
                 raise click.Abort()
 
-            schema = extract_schema(script)
-            if schema:
-                db_client.write_schema(schema)
-                click.echo('Schema stored in database.')
-
-        db_client.write_state(id_)
-        click.echo(f'State is now at {id_}.')
-
-    click.echo('Done.')
+            if len(ranges) > 1:
+                click.echo(f'Processed {sum(range_["processed"] for range_ in ranges)} documents.')
+
+            db_client.write_state(id_)
+            db_client.clear_checkpoint()
+            click.echo(f'State is now at {id_}.')
+
+            # a resumed migration is recorded from the time it was resumed, with documents processed since
+            entry = history_entry(id_, direction, ['batch'], environment or f'{host}:{port}',
+                started, time.time(), documents=sum(range_['processed'] for range_ in ranges) - resumed_from)
+            if metrics:
+                metrics.observe(db, entry)
+            if history:
+                try:
+                    db_client.write_history([entry])
+                except ArangoError as error:
+                    click.echo('Warning! Migration history not written: %s' % error)
+
+        click.echo('Done.')
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        if metrics:
+            write_metrics(metrics, metrics_path, not failed)
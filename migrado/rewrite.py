@@ -0,0 +1,247 @@
+"""
+Migrado copy-and-swap collection rewrites
+
+Copyright © 2019 Protojour AS, licensed under MIT.
+See LICENSE.txt for details.
+"""
+
+import click
+from arango.exceptions import ArangoServerError
+
+from .constants import DOCUMENT_NOT_FOUND
+from .db_client import add_index, collection_options
+from .transaction import query_batches
+from .transform import run_transform
+from .utils import load_python_migration
+
+
+CHANGED_QUERY = '''
+FOR doc IN @@collection
+    FILTER DOCUMENT(@revs, doc._key).rev != doc._rev
+    RETURN UNSET(doc, "_id")
+'''
+
+REMOVED_QUERY = '''
+FOR rev IN @@revs
+    FILTER DOCUMENT(@collection, rev._key) == null
+    RETURN rev._key
+'''
+
+# after the swap, documents written to the live collection since are left as they are
+CATCH_UP_CHANGED_QUERY = '''
+FOR doc IN @@collection
+    LET rev = DOCUMENT(@revs, doc._key)
+    FILTER rev.rev != doc._rev AND DOCUMENT(@live, doc._key)._rev == rev.written
+    RETURN UNSET(doc, "_id")
+'''
+
+CATCH_UP_REMOVED_QUERY = '''
+FOR rev IN @@revs
+    FILTER DOCUMENT(@collection, rev._key) == null AND DOCUMENT(@live, rev._key)._rev == rev.written
+    RETURN rev._key
+'''
+
+
+def rewrite_names(collection, migration_id):
+    """Get names of the shadow, revisions and original collections of a rewrite"""
+    shadow = f'{collection}_rewrite_{migration_id}'
+    return shadow, f'{shadow}_revs', f'{collection}_original_{migration_id}'
+
+
+def document_errors(keys, results):
+    """
+    Get errors of a multi-document operation (as returned by python-arango) by
+    document key, except for documents not found
+    """
+    return {
+        key: result for key, result in zip(keys, results)
+        if isinstance(result, ArangoServerError) and result.error_code != DOCUMENT_NOT_FOUND
+    }
+
+
+class RewriteWriter:
+    """
+    Writes rewritten documents to the shadow collection, and the revisions they were
+    rewritten from (and were written as) to the revisions collection. Documents
+    rewritten to None are removed from the shadow collection. Revisions are only
+    recorded for documents written, and errors writing any document are raised once
+    the others are recorded, so no document is left out of the shadow collection
+    unnoticed.
+    """
+
+    def __init__(self, db, shadow, revs):
+        self.shadow = db.collection(shadow)
+        self.revs = db.collection(revs)
+
+    def __call__(self, documents, results):
+        failed = {}
+        written = {}
+        if results:
+            inserted = self.shadow.insert_many(
+                [{key: value for key, value in result.items() if key != '_rev'} for result in results],
+                overwrite=True
+            )
+            failed.update(document_errors([result['_key'] for result in results], inserted))
+            written = {
+                result['_key']: metadata['_rev'] for result, metadata in zip(results, inserted)
+                if not isinstance(metadata, ArangoServerError)
+            }
+        keys = {result['_key'] for result in results}
+        dropped = [document['_key'] for document in documents if document['_key'] not in keys]
+        if dropped:
+            failed.update(document_errors(dropped, self.shadow.delete_many(dropped)))
+        self.revs.insert_many(
+            [
+                {
+                    '_key': document['_key'], 'rev': document['_rev'],
+                    'written': written.get(document['_key']),
+                }
+                for document in documents if document['_key'] not in failed
+            ],
+            overwrite=True, silent=True
+        )
+        self.raise_errors(failed)
+
+    def remove(self, keys):
+        """Remove documents removed from the live collection"""
+        failed = document_errors(keys, self.shadow.delete_many(keys))
+        removed = [key for key in keys if key not in failed]
+        if removed:
+            self.revs.delete_many(removed, silent=True)
+        self.raise_errors(failed)
+
+    def raise_errors(self, failed):
+        if failed:
+            key, error = next(iter(failed.items()))
+            raise ValueError(f'{len(failed)} documents could not be written to '
+                f'{self.shadow.name}, such as {key}: {error}')
+
+
+def rewrite_pass(db, function, collection, target, revs, batch_size=1000, catch_up=False):
+    """
+    Rewrite documents of `collection` changed since they were last rewritten into
+    `target` in this process, and remove documents since removed from `collection`.
+    When catching up after the swap, documents of `target` written since they were
+    rewritten are left as they are. Returns the numbers of documents rewritten and removed.
+    """
+    changed_query, removed_query = ((CATCH_UP_CHANGED_QUERY, CATCH_UP_REMOVED_QUERY) if catch_up
+        else (CHANGED_QUERY, REMOVED_QUERY))
+    live = {'live': target} if catch_up else {}
+
+    writer = RewriteWriter(db, target, revs)
+    read = 0
+    for batch in query_batches(db, changed_query, batch_size,
+            {'@collection': collection, 'revs': revs, **live}):
+        writer(batch, [result for result in map(function, batch) if result is not None])
+        read += len(batch)
+    removed = [key for batch in query_batches(db, removed_query, batch_size,
+        {'@revs': revs, 'collection': collection, **live}) for key in batch]
+    if removed:
+        writer.remove(removed)
+    return read, len(removed)
+
+
+def run_rewrite(db, source, name, function_name, collection, migration_id, indexes=(),
+        batch_size=1000, workers=None, ttl=None, throttle=None, max_passes=10, echo=click.echo):
+    """
+    Rewrite every document of `collection` with the rewrite function of a Python
+    migration, without blocking writes to it while the work is done:
+
+    - documents are rewritten into a shadow collection (created with the options of
+      the live collection), recording the revision each was rewritten from, in passes
+      (see run_transform) until few documents have changed since the last pass (or
+      after `max_passes`). The first pass copies all documents, and an interrupted
+      rewrite resumes from where it stopped.
+    - `indexes` (definitions as given by the HTTP API, see MigrationClient.list_indexes)
+      are added to the shadow collection after the first pass.
+    - a final pass rewrites the remaining changes while holding an exclusive lock on
+      the live collection. The live collection is then kept under a new name, so the
+      rewrite can be reversed (see swap_back), and the shadow collection takes its name.
+    - a catch-up pass rewrites documents written to the renamed live collection
+      between the final pass and the swap, except documents written to the rewritten
+      collection since the swap, which keep the newer write. A write landing between
+      the catch-up reading a document and writing it can still be overwritten. The
+      validation rule of the live collection is then set on the rewritten collection.
+
+    Returns the number of documents rewritten.
+    """
+    shadow, revs, original = rewrite_names(collection, migration_id)
+    function = getattr(load_python_migration(source, name), function_name)
+    rewritten = 0
+
+    # revisions left alongside the original collection are from a rewrite
+    # interrupted after the swap, which only needs to catch up
+    if not (db.has_collection(original) and db.has_collection(revs)):
+        live = db.collection(collection)
+        if not db.has_collection(revs):
+            # a shadow collection without revisions is left from a reversed rewrite
+            if db.has_collection(shadow):
+                db.delete_collection(shadow)
+            properties = live.properties()
+            db.create_collection(shadow, edge=properties['edge'],
+                **collection_options(properties))
+            db.create_collection(revs)
+
+        writer = RewriteWriter(db, shadow, revs)
+        bind_vars = {'@collection': collection, 'revs': revs}
+
+        for number in range(1, max_passes + 1):
+            read, _ = run_transform(db, source, name, function_name, collection, CHANGED_QUERY,
+                bind_vars, batch_size, workers, ttl, throttle, writer)
+            removed = [key for batch in query_batches(db, REMOVED_QUERY, batch_size,
+                {'@revs': revs, 'collection': collection}) for key in batch]
+            if removed:
+                writer.remove(removed)
+            rewritten += read
+            echo(f'Pass {number}: rewrote {read} documents, removed {len(removed)}.')
+
+            if number == 1:
+                for index in indexes:
+                    add_index(db.collection(shadow), index)
+
+            if read + len(removed) <= batch_size:
+                break
+
+        transaction = db.begin_transaction(exclusive=[collection], write=[shadow, revs])
+        try:
+            read, removed = rewrite_pass(transaction, function, collection, shadow, revs, batch_size)
+            transaction.commit_transaction()
+        except BaseException:
+            transaction.abort_transaction()
+            raise
+        rewritten += read
+        echo(f'Final pass: rewrote {read} documents, removed {removed}.')
+
+        swap(db, collection, original, shadow)
+
+    read, removed = rewrite_pass(db, function, original, collection, revs, batch_size, catch_up=True)
+    rewritten += read
+    echo(f'Catch-up pass: rewrote {read} documents, removed {removed}.')
+
+    schema = db.collection(original).properties().get('schema')
+    if schema:
+        db.collection(collection).configure(schema=schema)
+    db.delete_collection(revs)
+
+    return rewritten
+
+
+def swap(db, collection, renamed, replacement):
+    """Rename `collection` to `renamed`, and `replacement` to `collection`"""
+    db.collection(collection).rename(renamed)
+    try:
+        db.collection(replacement).rename(collection)
+    except BaseException:
+        db.collection(renamed).rename(collection)
+        raise
+
+
+def swap_back(db, collection, migration_id):
+    """
+    Reverse a rewrite, swapping the original collection back in. The rewritten
+    collection is kept as the shadow collection, and dropped if the rewrite is run again.
+    """
+    shadow, _, original = rewrite_names(collection, migration_id)
+    if not db.has_collection(original):
+        raise ValueError(f'Original collection {original} not found, can not swap back.')
+    swap(db, collection, shadow, original)
@@ -0,0 +1,481 @@
+"""
+Migrado migration runner
+
+Copyright © 2019 Protojour AS, licensed under MIT.
+See LICENSE.txt for details.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import os
+import time
+
+import click
+
+from arango.exceptions import ArangoError, TransactionExecuteError
+
+from .rewrite import run_rewrite, swap_back
+from .throttle import RateController
+from .transform import run_transform
+from .utils import (
+    select_migrations, classify_migration, parse_ddl, coalesce_migrations, history_entry,
+    dependency_graph, applied_state, load_python_migration
+)
+
+
+class MigrationRunner:
+    """
+    Runner for a set of parsed migrations (see utils.parse_migration),
+    by migration id, reusable across databases
+    """
+
+    def __init__(self, migrations, arangosh='arangosh',
+            max_transaction_size=None, intermediate_commit_size=None, intermediate_commit_count=None,
+            sync=True, coalesce=False, job=False, history=None, metrics=None, baseline=None,
+            parallel=None, transform_workers=None):
+        self.migrations = migrations
+        self.arangosh = arangosh
+        self.max_transaction_size = max_transaction_size
+        self.intermediate_commit_size = intermediate_commit_size
+        self.intermediate_commit_count = intermediate_commit_count
+        self.sync = sync
+        self.coalesce = coalesce
+        self.job = job
+        self.history = history
+        self.metrics = metrics
+        self.baseline = baseline
+        self.parallel = parallel
+        self.transform_workers = transform_workers
+        self.modules = {}
+
+    @property
+    def migration_ids(self):
+        return list(self.migrations)
+
+    def plan(self, state, target):
+        """
+        Plan migrations between `state` and `target`, returning the direction
+        and a list of (migration id, executor) pairs
+        """
+        direction, migration_ids = select_migrations(state, target, self.migration_ids)
+        graph = self.graph(direction, migration_ids) if self.parallel else {}
+        plan = []
+        for group in self.group(direction, migration_ids):
+            for id_ in group:
+                executor = self.route(id_, direction)[0]
+                if len(group) > 1:
+                    executor = f'{executor} (coalesced {group[0]}-{group[-1]})'
+                if graph.get(id_):
+                    executor = f'{executor} (after {", ".join(sorted(graph[id_]))})'
+                plan.append((id_, executor))
+
+        return direction, plan
+
+    def group(self, direction, migration_ids):
+        """
+        Group migration ids to run together: consecutive transaction migrations
+        if coalescing, otherwise one migration per group
+        """
+        groups = []
+        for id_ in migration_ids:
+            transaction = self.coalesce and self.route(id_, direction)[0] == 'transaction'
+            if transaction and groups and groups[-1][0]:
+                groups[-1][1].append(id_)
+            else:
+                groups.append((transaction, [id_]))
+
+        return [group for _, group in groups]
+
+    def graph(self, direction, migration_ids):
+        """
+        Build dependency graph of migrations to run in `direction` (see
+        utils.dependency_graph). In reverse, migrations wait for the later
+        migrations depending on them instead.
+        """
+        ordered = sorted(migration_ids)
+        graph = dependency_graph(ordered,
+            {id_: self.migration(id_)['depends'] for id_ in ordered},
+            {id_: self.writes(id_, direction) for id_ in ordered}
+        )
+        if direction == 'reverse':
+            graph = {id_: {later for later in ordered if id_ in graph[later]} for id_ in ordered}
+
+        return graph
+
+    def writes(self, id_, direction):
+        """
+        Get collections written by migration, or None if unknown. Migrations not run
+        in a transaction, and migrations storing a schema, are run on their own.
+        """
+        migration = self.migration(id_)
+        if migration['schema'] or self.route(id_, direction)[0] not in ('transaction', 'python', 'transform'):
+            return None
+        return set(migration['write_collections'])
+
+    def migration(self, id_):
+        """Get parsed migration"""
+        return self.migrations[id_]
+
+    def module(self, id_):
+        """Get loaded Python migration (loaded once, and reused across databases)"""
+        if id_ not in self.modules:
+            self.modules[id_] = load_python_migration(self.migration(id_)['source'], f'migration_{id_}')
+        return self.modules[id_]
+
+    def throttle(self, module):
+        """
+        Get rate controller for a transform or rewrite migration, configured by its
+        rate (documents per second), adaptive and target_latency (seconds) attributes,
+        with two batches in flight per worker process at most
+        """
+        rate = getattr(module, 'rate', None)
+        adaptive = getattr(module, 'adaptive', False)
+        target_latency = getattr(module, 'target_latency', None)
+        if not (rate or adaptive or target_latency):
+            return None
+
+        return RateController(getattr(module, 'batch_size', 1000),
+            (self.transform_workers or os.cpu_count()) * 2, rate, adaptive, target_latency)
+
+    def route(self, id_, direction):
+        """Classify migration, returning executor and whether it was given explicitly"""
+        migration = self.migration(id_)
+        return classify_migration(migration[direction], migration['executor'])
+
+    def run(self, db_client, state, target, echo=click.echo, lock=None, applied=None):
+        """
+        Run migrations between `state` and `target` against the database of `db_client`,
+        yielding each migration id once its state is written. Raises click.Abort on failure,
+        or if the migration `lock` (see lock.MigrationLock) is lost between migrations.
+        Migrations `applied` ahead of state are read from the database unless given.
+        """
+        self.check_state(state, echo)
+        direction, migration_ids = select_migrations(state, target, self.migration_ids)
+
+        try:
+            if applied is None:
+                applied = db_client.read_applied()
+            if self.parallel or applied:
+                yield from self.run_parallel(db_client, direction, migration_ids, state, applied, echo, lock)
+            else:
+                yield from self.run_migrations(db_client, direction, migration_ids, echo, lock)
+        finally:
+            db_client.close()
+
+    def check_state(self, state, echo):
+        """
+        Check that state is not within squashed migrations (see migrado squash),
+        which have been replaced by the baseline migration
+        """
+        if self.baseline and '0000' < state < self.baseline:
+            echo(f'Error! State is at {state}, but migrations up to {self.baseline} have been squashed. '
+                'Run the original migrations against this database first, with '
+                f'--path set to the squashed directory and --target {self.baseline}.')
+            raise click.Abort()
+
+    def check_lock(self, lock, echo):
+        """Abort if the migration lock has been lost, before starting another migration"""
+        if lock and lock.lost.is_set():
+            echo('Error! Migration lock was lost, not starting more migrations.')
+            raise click.Abort()
+
+    def run_migrations(self, db_client, direction, migration_ids, echo, lock=None):
+        for group in self.group(direction, migration_ids):
+            self.check_lock(lock, echo)
+            if len(group) > 1 and self.run_coalesced(db_client, direction, group, echo):
+                yield from group
+                continue
+
+            for id_ in group:
+                self.check_lock(lock, echo)
+                with db_client.tracer.span('migration', migration_id=id_, direction=direction):
+                    self.run_migration(db_client, direction, id_, echo)
+                yield id_
+
+    def run_parallel(self, db_client, direction, migration_ids, state, applied, echo, lock=None):
+        """
+        Run migrations concurrently (at most `parallel` at a time) in dependency order
+        (see graph), yielding each new state. State is the last migration of the longest
+        applied prefix, and migrations applied ahead of it are listed in the state
+        document, so an interrupted run can be resumed or reversed consistently.
+        Once a migration fails or the `lock` is lost, no more are started, and running
+        ones are waited for.
+        """
+        if not direction:
+            return
+
+        done = {id_ for id_ in self.migration_ids if id_ <= state} | set(applied)
+        if direction == 'forward':
+            pending = [id_ for id_ in migration_ids if id_ not in done]
+        else:
+            # migrations applied ahead of state are reversed too
+            pending = sorted((set(migration_ids) | set(applied)) & done, reverse=True)
+
+        graph = self.graph(direction, pending)
+        unfinished = set(pending)
+        running = {}
+        failed = False
+
+        def run_migration(id_):
+            with db_client.tracer.span('migration', migration_id=id_, direction=direction):
+                self.run_migration(db_client, direction, id_, echo, write_state=False)
+
+        with ThreadPoolExecutor(max_workers=self.parallel or 1) as executor:
+            while True:
+                if lock and lock.lost.is_set() and not failed:
+                    echo('Error! Migration lock was lost, not starting more migrations.')
+                    failed = True
+
+                for id_ in list(pending):
+                    if failed or len(running) >= (self.parallel or 1):
+                        break
+                    if not graph[id_] & unfinished:
+                        pending.remove(id_)
+                        future = executor.submit(run_migration, id_)
+                        running[future] = id_
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in sorted(finished, key=running.get):
+                    id_ = running.pop(future)
+                    unfinished.discard(id_)
+                    try:
+                        future.result()
+                    except click.Abort:
+                        failed = True
+                        continue
+                    except Exception as error:
+                        echo('Error! %s' % error)
+                        failed = True
+                        continue
+
+                    if direction == 'forward':
+                        done.add(id_)
+                    else:
+                        done.discard(id_)
+
+                    new_state, ahead = applied_state(self.migration_ids, done)
+                    db_client.write_state(new_state, ahead)
+                    if ahead:
+                        echo(f'State is now at {new_state}, with {", ".join(ahead)} applied ahead.')
+                    else:
+                        echo(f'State is now at {new_state}.')
+                    if new_state != state:
+                        state = new_state
+                        yield state
+
+        if failed:
+            raise click.Abort()
+
+    def run_migration(self, db_client, direction, id_, echo, write_state=True):
+        """
+        Run a single migration with its executor, and write state
+        (unless `write_state` is false, in which case the caller writes it)
+        """
+        migration = self.migration(id_)
+        function = migration[direction]
+        executor, explicit = self.route(id_, direction)
+        executors = []
+        details = {}
+        state_written = False
+        started = time.time()
+
+        if executor == 'native':
+            operations = parse_ddl(function)
+            if operations is None:
+                echo(f'Error! {direction.capitalize()} migration {id_} is not a generated schema migration.')
+                raise click.Abort()
+
+            echo(f'Running {direction} migration {id_} as native schema migration...')
+            executors.append(executor)
+            error = db_client.run_ddl(operations)
+
+            if error:
+                echo('Error! %s' % error)
+                raise click.Abort()
+
+            self.store_schema(db_client, migration, echo)
+
+        if executor == 'transaction':
+            schema = migration['schema']
+
+            echo(f'Running {direction} migration {id_} in transaction...')
+            executors.append(executor)
+            error = db_client.run_transaction(function, migration['write_collections'],
+                self.max_transaction_size, self.intermediate_commit_size, self.intermediate_commit_count,
+                self.sync, id_ if write_state else None, schema, self.job
+            )
+
+            if error:
+                echo('Error! %s' % error)
+                # in parallel runs, falling back to arangosh would run it alongside
+                # other migrations, so the failed transaction fails the run instead.
+                # An async job that could not be polled may have run, and is not run again.
+                if explicit or not write_state or not isinstance(error, TransactionExecuteError):
+                    raise click.Abort()
+                executor = 'arangosh'
+            elif write_state:
+                state_written = True
+                if schema:
+                    echo('Schema stored in database.')
+            else:
+                self.store_schema(db_client, migration, echo)
+
+        if executor == 'python':
+            try:
+                migration_function = getattr(self.module(id_), direction)
+            except Exception as error:
+                echo(f'Error! Python migration {id_} could not be loaded: {type(error).__name__}: {error}')
+                raise click.Abort()
+
+            echo(f'Running {direction} migration {id_} in stream transaction...')
+            executors.append(executor)
+            error = db_client.run_stream_transaction(migration_function, migration['write_collections'],
+                self.max_transaction_size, self.sync, id_ if write_state else None
+            )
+
+            if error:
+                echo(f'Error! {type(error).__name__}: {error}')
+                raise click.Abort()
+            state_written = write_state
+
+        if executor == 'transform':
+            function_name = 'transform' if direction == 'forward' else 'reverse_transform'
+            try:
+                module = self.module(id_)
+                getattr(module, function_name)
+                collection = module.collection
+            except Exception as error:
+                echo(f'Error! Python migration {id_} could not be loaded: {type(error).__name__}: {error}')
+                raise click.Abort()
+
+            echo(f'Running {direction} migration {id_} as transform of {collection}...')
+            executors.append(executor)
+            try:
+                with db_client.tracer.span('transform', migration_id=id_, collection=collection) as span:
+                    read, written = run_transform(db_client.db, migration['source'], f'migration_{id_}',
+                        function_name, collection,
+                        getattr(module, 'query' if direction == 'forward' else 'reverse_query', None),
+                        getattr(module, 'bind_vars', None), getattr(module, 'batch_size', 1000),
+                        self.transform_workers, db_client.timeout, self.throttle(module)
+                    )
+                    span['documents'] = written
+            except Exception as error:
+                echo(f'Error! {type(error).__name__}: {error}')
+                raise click.Abort()
+
+            echo(f'Transformed {read} documents, wrote {written}.')
+            details['documents'] = written
+
+        if executor == 'rewrite':
+            try:
+                module = self.module(id_)
+                collection = module.collection
+                getattr(module, 'rewrite')
+            except Exception as error:
+                echo(f'Error! Python migration {id_} could not be loaded: {type(error).__name__}: {error}')
+                raise click.Abort()
+
+            executors.append(executor)
+            try:
+                with db_client.tracer.span('rewrite', migration_id=id_, collection=collection) as span:
+                    if direction == 'forward':
+                        echo(f'Running forward migration {id_} as rewrite of {collection}...')
+                        details['documents'] = span['documents'] = run_rewrite(db_client.db,
+                            migration['source'], f'migration_{id_}', 'rewrite', collection, id_,
+                            db_client.list_indexes().get(collection, []),
+                            getattr(module, 'batch_size', 1000), self.transform_workers,
+                            db_client.timeout, self.throttle(module), echo=echo
+                        )
+                    else:
+                        echo(f'Running reverse migration {id_}, swapping back original {collection}...')
+                        swap_back(db_client.db, collection, id_)
+            except Exception as error:
+                echo(f'Error! {type(error).__name__}: {error}')
+                raise click.Abort()
+
+        if executor == 'arangosh':
+            echo(f'Running {direction} migration {id_} as schema migration...')
+            executors.append(executor)
+            error = db_client.run_script(function, self.arangosh)
+
+            if error:
+                echo('Error! %s' % error)
+                raise click.Abort()
+
+            self.store_schema(db_client, migration, echo)
+
+        if write_state:
+            if not state_written:
+                db_client.write_state(id_)
+            echo(f'State is now at {id_}.')
+
+        self.record(db_client, [id_], direction, executors, started, echo,
+            script_bytes=len((function or '').encode()), **details)
+
+    def run_coalesced(self, db_client, direction, group, echo):
+        """
+        Run a group of transaction migrations in one transaction, and write state.
+        Returns False if the transaction failed (and was rolled back).
+        """
+        migrations = [self.migration(id_) for id_ in group]
+        functions = [(id_, migration[direction]) for id_, migration in zip(group, migrations)]
+        write_collections = list(dict.fromkeys(
+            collection for migration in migrations for collection in migration['write_collections']
+        ))
+        schema = next((migration['schema'] for migration in reversed(migrations) if migration['schema']), None)
+
+        echo(f'Running {direction} migrations {group[0]}-{group[-1]} in one transaction...')
+        started = time.time()
+        with db_client.tracer.span('migration', migration_id=f'{group[0]}-{group[-1]}', direction=direction):
+            error = db_client.run_transaction(coalesce_migrations(functions), write_collections,
+                self.max_transaction_size, self.intermediate_commit_size, self.intermediate_commit_count,
+                self.sync, group[-1], schema, self.job
+            )
+
+        if error:
+            echo('Error! %s' % error)
+            echo(f'Running {direction} migrations {group[0]}-{group[-1]} one at a time...')
+            if self.metrics:
+                self.metrics.retry(db_client.db_name)
+            return False
+
+        if schema:
+            echo('Schema stored in database.')
+        echo(f'State is now at {group[-1]}.')
+
+        self.record(db_client, group, direction, ['transaction'], started, echo,
+            coalesced=f'{group[0]}-{group[-1]}')
+        return True
+
+    def record(self, db_client, migration_ids, direction, executors, started, echo, **details):
+        """
+        Add applied migrations to run metrics and migration history, if enabled.
+        History is not essential, so failing to write it is only a warning.
+        """
+        if not self.history and not self.metrics:
+            return
+
+        ended = time.time()
+        entries = [
+            history_entry(id_, direction, executors, self.history, started, ended, **details)
+            for id_ in migration_ids
+        ]
+        if self.metrics:
+            for entry in entries:
+                self.metrics.observe(db_client.db_name, entry)
+        if not self.history:
+            return
+
+        try:
+            db_client.write_history(entries)
+        except ArangoError as error:
+            echo('Warning! Migration history not written: %s' % error)
+
+    def store_schema(self, db_client, migration, echo):
+        """Write schema declared in migration script, if any, to the database"""
+        schema = migration['schema']
+        if schema:
+            db_client.write_schema(schema)
+            echo('Schema stored in database.')
@@ -0,0 +1,163 @@
+"""
+Migrado database snapshots
+
+Copyright © 2019 Protojour AS, licensed under MIT.
+See LICENSE.txt for details.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from threading import Event, Semaphore, local
+import gzip
+import json
+import shutil
+
+from .db_client import add_index, collection_options
+
+
+def find_snapshot(migrations_path, target):
+    """Find path of the latest snapshot at or before migration `target`, if any"""
+    paths = sorted(
+        path for path in migrations_path.joinpath('snapshots').glob('[0-9]' * 4)
+        if path.name <= target and path.joinpath('manifest.json').exists()
+    )
+    return paths[-1] if paths else None
+
+
+def write_snapshot(db_client, path, migration_id, workers=4, batch_size=10000):
+    """
+    Write snapshot of the database collections (options such as sharding and key
+    generator, validation rules, indexes, and documents as gzipped JSON lines) to
+    directory at `path`, returning the snapshot manifest. The snapshot is written to
+    a temporary directory first, and replaces any existing snapshot at `path` once
+    complete.
+    """
+    ignored = (db_client.coll_name, db_client.history_coll_name)
+    collections = [
+        collection for collection in db_client.list_collections(validation=True)
+        if not collection['system'] and collection['name'] not in ignored
+    ]
+    indexes = db_client.list_indexes()
+
+    temp_path = path.with_name(path.name + '.tmp')
+    shutil.rmtree(temp_path, ignore_errors=True)
+    temp_path.mkdir(parents=True)
+
+    def export(name):
+        db = db_client.connect()
+        options = collection_options(db.collection(name).properties())
+        cursor = db.aql.execute(
+            'FOR doc IN @@coll RETURN UNSET(doc, "_id", "_rev")',
+            bind_vars={'@coll': name},
+            batch_size=batch_size,
+            stream=True
+        )
+        count = 0
+        with gzip.open(temp_path.joinpath(f'{name}.jsonl.gz'), 'wt') as file:
+            for document in cursor:
+                file.write(json.dumps(document) + '\n')
+                count += 1
+        return count, options
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        exported = list(executor.map(export, [collection['name'] for collection in collections]))
+
+    manifest = {
+        'migration_id': migration_id,
+        'schema': db_client.read_schema() or None,
+        'collections': [
+            {
+                'name': collection['name'],
+                'type': collection['type'],
+                'schema': collection['schema'],
+                'options': options,
+                'indexes': indexes.get(collection['name'], []),
+                'count': count,
+                'file': f'{collection["name"]}.jsonl.gz',
+            }
+            for collection, (count, options) in zip(collections, exported)
+        ],
+    }
+    temp_path.joinpath('manifest.json').write_text(json.dumps(manifest, indent=2))
+
+    shutil.rmtree(path, ignore_errors=True)
+    temp_path.rename(path)
+    return manifest
+
+
+def restore_snapshot(db_client, path, workers=8, batch_size=10000):
+    """
+    Restore snapshot at `path` into an empty database: create collections with their
+    options, import documents with concurrent bulk imports (at most two batches in
+    flight per worker), then add indexes and validation rules, and write state and
+    schema. Returns number of documents imported. If the restore fails, the
+    collections created are dropped, leaving the database empty again.
+    """
+    manifest = json.loads(path.joinpath('manifest.json').read_text())
+    db = db_client.db
+    created = []
+
+    try:
+        for collection in manifest['collections']:
+            db.create_collection(
+                collection['name'], edge=collection['type'] == 'edge', **collection.get('options', {})
+            )
+            created.append(collection['name'])
+
+        imported = import_snapshot(db_client, path, manifest, workers, batch_size)
+
+        # indexes and validation rules are added after importing, which is faster,
+        # and accepts documents written before a validation rule was introduced
+        for collection in manifest['collections']:
+            for index in collection['indexes']:
+                add_index(db.collection(collection['name']), index)
+            if collection['schema']:
+                db.collection(collection['name']).configure(schema=collection['schema'])
+
+        if manifest['schema']:
+            db_client.write_schema(manifest['schema'])
+        db_client.write_state(manifest['migration_id'])
+    except BaseException:
+        for name in created:
+            db.delete_collection(name, ignore_missing=True)
+        raise
+
+    return imported
+
+
+def import_snapshot(db_client, path, manifest, workers=8, batch_size=10000):
+    """
+    Import documents of snapshot at `path` into its collections with concurrent bulk
+    imports (at most two batches in flight per worker), returning number imported
+    """
+    handles = local()
+
+    def import_batch(name, documents):
+        if not hasattr(handles, 'db'):
+            handles.db = db_client.connect()
+        result = handles.db.collection(name).import_bulk(documents, halt_on_error=True)
+        return result['created']
+
+    failed = Event()
+    slots = Semaphore(workers * 2)
+    futures = []
+
+    def on_done(future):
+        slots.release()
+        if future.exception():
+            failed.set()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for collection in manifest['collections']:
+            with gzip.open(path.joinpath(collection['file']), 'rt') as file:
+                documents = (json.loads(line) for line in file)
+                while not failed.is_set():
+                    batch = list(islice(documents, batch_size))
+                    if not batch:
+                        break
+                    slots.acquire()
+                    future = executor.submit(import_batch, collection['name'], batch)
+                    future.add_done_callback(on_done)
+                    futures.append(future)
+
+    return sum(future.result() for future in futures)
@@ -0,0 +1,100 @@
+"""
+Migrado rate control for batched work
+
+Copyright © 2019 Protojour AS, licensed under MIT.
+See LICENSE.txt for details.
+"""
+
+from contextlib import contextmanager
+from threading import Condition
+import time
+
+
+class RateController:
+    """
+    Paces batched work to at most `max_rate` operations (e.g. documents) per second,
+    and, if adaptive, adjusts batch size and concurrency to the latency and failures
+    observed for each batch (additive increase, multiplicative decrease). A batch is
+    slow if it takes longer than `target_latency`, or without a target, if its latency
+    per operation is more than twice the best seen. Batch size grows by a tenth of the
+    initial size after each fast batch, up to `max_batch_size`, and is halved after a
+    slow or failed batch. Concurrency drops by one after a slow or failed batch, and
+    grows by one (up to the initial concurrency) after a run of fast batches.
+    """
+
+    def __init__(self, batch_size=1000, concurrency=1, max_rate=None, adaptive=False,
+            target_latency=None, min_batch_size=1, max_batch_size=None):
+        self.condition = Condition()
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_rate = max_rate
+        self.adaptive = adaptive or target_latency is not None
+        self.target_latency = target_latency
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size or batch_size * 4
+        self.max_concurrency = concurrency
+        self.step = max(1, batch_size // 10)
+        self.best = None
+        self.fast = 0
+        self.errors = 0
+        self.active = 0
+        self.next_time = time.monotonic()
+
+    def acquire(self, count):
+        """Wait until `count` more operations are allowed by the rate cap"""
+        if not self.max_rate:
+            return
+
+        with self.condition:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + count / self.max_rate
+        time.sleep(start - now)
+
+    @contextmanager
+    def slot(self):
+        """Hold one of `concurrency` slots while working, waiting for one if all are taken"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.active < self.concurrency)
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def record(self, count, latency, error=False):
+        """Feed the latency (or failure) of a batch of `count` operations"""
+        if not self.adaptive:
+            return
+
+        with self.condition:
+            if error:
+                self.errors += 1
+                return self.decrease()
+
+            per_operation = latency / max(count, 1)
+            self.best = per_operation if self.best is None else min(self.best, per_operation)
+            if self.target_latency is not None:
+                slow = latency > self.target_latency
+            else:
+                slow = per_operation > 2 * self.best
+
+            if slow:
+                self.decrease()
+            else:
+                self.increase()
+
+    def decrease(self):
+        self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+        self.concurrency = max(1, self.concurrency - 1)
+        self.fast = 0
+
+    def increase(self):
+        self.batch_size = min(self.max_batch_size, self.batch_size + self.step)
+        self.fast += 1
+        if self.fast >= 4 * self.concurrency and self.concurrency < self.max_concurrency:
+            self.concurrency += 1
+            self.fast = 0
+            self.condition.notify_all()
@@ -0,0 +1,104 @@
+"""
+Migrado tracing
+
+Copyright © 2019 Protojour AS, licensed under MIT.
+See LICENSE.txt for details.
+"""
+
+from contextlib import contextmanager
+from threading import Lock, get_ident
+from urllib.parse import urlsplit
+import json
+import os
+import time
+
+from arango.http import DefaultHTTPClient
+
+
+class Tracer:
+    """
+    Records timed spans (name, start, duration and attributes), to be written
+    as JSON lines or in Chrome trace event format. A disabled tracer records nothing.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.spans = []
+        self.lock = Lock()
+        self.origin = time.perf_counter()
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Time the enclosed block. Yields the span attributes, which may be added to."""
+        if not self.enabled:
+            yield attributes
+            return
+
+        start = time.perf_counter()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes['error'] = type(e).__name__
+            raise
+        finally:
+            self.record(name, start, time.perf_counter(), attributes)
+
+    def record(self, name, start, end, attributes):
+        span = {
+            'name': name,
+            'start': round(start - self.origin, 6),
+            'duration': round(end - start, 6),
+            'thread': get_ident(),
+            **attributes,
+        }
+        with self.lock:
+            self.spans.append(span)
+
+    def summary(self):
+        """Get count and total duration of spans, by name"""
+        summary = {}
+        for span in self.spans:
+            count, duration = summary.get(span['name'], (0, 0))
+            summary[span['name']] = (count + 1, duration + span['duration'])
+        return summary
+
+    def write(self, file, format='jsonl'):
+        """Write spans to open file, as JSON lines ('jsonl') or Chrome trace events ('chrome')"""
+        spans = sorted(self.spans, key=lambda span: span['start'])
+        if format == 'chrome':
+            events = [
+                {
+                    'name': span['name'],
+                    'ph': 'X',
+                    'ts': int(span['start'] * 1e6),
+                    'dur': int(span['duration'] * 1e6),
+                    'pid': os.getpid(),
+                    'tid': span['thread'],
+                    'args': {
+                        key: value for key, value in span.items()
+                        if key not in ('name', 'start', 'duration', 'thread')
+                    },
+                }
+                for span in spans
+            ]
+            json.dump({'traceEvents': events}, file)
+        else:
+            for span in spans:
+                file.write(json.dumps(span) + '\n')
+
+
+class TracingHTTPClient(DefaultHTTPClient):
+    """HTTP client recording a span for each request sent to ArangoDB"""
+
+    def __init__(self, tracer, **kwargs):
+        super().__init__(**kwargs)
+        self.tracer = tracer
+
+    def send_request(self, session, method, url, headers=None, params=None, data=None, auth=None):
+        sent = len(data) if isinstance(data, (str, bytes)) else 0
+        with self.tracer.span('http', method=method.upper(), endpoint=urlsplit(url).path,
+                request_bytes=sent) as span:
+            response = super().send_request(session, method, url, headers, params, data, auth)
+            span['status'] = response.status_code
+            span['response_bytes'] = len(response.raw_body or '')
+        return response
@@ -0,0 +1,81 @@
+"""
+Migrado stream transactions for Python migrations
+
+Copyright © 2019 Protojour AS, licensed under MIT.
+See LICENSE.txt for details.
+"""
+
+from arango.exceptions import ArangoError
+
+
+def query_batches(db, query, batch_size=1000, bind_vars=None, **kwargs):
+    """
+    Run AQL query with a streaming cursor, yielding results in lists of at most
+    `batch_size`, so only one batch is held in memory at a time
+    """
+    cursor = db.aql.execute(query, bind_vars=bind_vars, batch_size=batch_size, stream=True, **kwargs)
+    try:
+        while True:
+            batch = list(cursor.batch())
+            cursor.batch().clear()
+            if batch:
+                yield batch
+            if not cursor.has_more():
+                break
+            cursor.fetch()
+    finally:
+        cursor.close(ignore_missing=True)
+
+
+class StreamTransaction:
+    """
+    Database handle passed to the forward(db) and reverse(db) functions of Python
+    migrations: a python-arango stream transaction, with helpers for reading query
+    results in batches and committing periodically. Other attributes (collection,
+    aql, etc.) are those of the current transaction database.
+    """
+
+    def __init__(self, db, write_collections, sync=True, max_size=None):
+        self.database = db
+        self.write_collections = list(write_collections)
+        self.sync = sync
+        self.max_size = max_size
+        self.commits = 0
+        self.transaction = self.begin()
+
+    def __getattr__(self, name):
+        return getattr(self.transaction, name)
+
+    def begin(self):
+        """Begin stream transaction writing to the declared write collections"""
+        return self.database.begin_transaction(
+            write=self.write_collections,
+            sync=self.sync,
+            allow_implicit=True,
+            max_size=self.max_size
+        )
+
+    def batches(self, query, batch_size=1000, bind_vars=None, **kwargs):
+        """
+        Run AQL query, yielding results in lists of at most `batch_size`.
+        The query runs outside the transaction, on a snapshot taken when it starts,
+        so commit() may be called between batches, and writes are not read back.
+        """
+        return query_batches(self.database, query, batch_size, bind_vars, **kwargs)
+
+    def commit(self):
+        """
+        Commit changes so far, and continue in a new transaction. Committed changes
+        are not rolled back if the migration fails later, so a migration committing
+        periodically should be safe to run again.
+        """
+        self.transaction.commit_transaction()
+        self.commits += 1
+        self.transaction = self.begin()
+
+    def abort(self):
+        """Abort the current transaction, if it is still running"""
+        try:
+            self.transaction.abort_transaction()
+        except ArangoError:
+            pass
@@ -0,0 +1,101 @@
+"""
+Migrado transform pipeline
+
+Copyright © 2019 Protojour AS, licensed under MIT.
+See LICENSE.txt for details.
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import time
+
+from .transaction import query_batches
+from .utils import load_python_migration
+
+
+# transform function of the Python migration loaded in a pool worker process
+transform_function = None
+
+
+def init_worker(source, name, function_name):
+    """Load transform function of Python migration in pool worker process"""
+    global transform_function
+    transform_function = getattr(load_python_migration(source, name), function_name)
+
+
+def transform_batch(documents):
+    """Transform batch of documents in pool worker, dropping documents transformed to None"""
+    results = []
+    for document in documents:
+        result = transform_function(document)
+        if result is not None:
+            results.append(result)
+    return results
+
+
+def run_transform(db, source, name, function_name, collection, query=None, bind_vars=None,
+        batch_size=1000, workers=None, ttl=None, throttle=None, write=None):
+    """
+    Stream documents from AQL query (by default, all documents in `collection`) in batches
+    to a process pool running the transform function of a Python migration, and write
+    results back to `collection` with bulk imports, updating existing documents
+    (or with `write(documents, results)`, if given). At most two batches per worker
+    (or as many as `throttle` allows, see throttle.RateController) are in flight, so
+    memory use stays bounded whatever the collection size. With `throttle`, reading
+    is paced by it, and the latency of each write is fed back to it.
+    Returns the number of documents read and written.
+    """
+    if not query:
+        query, bind_vars = 'FOR doc IN @@collection RETURN doc', {'@collection': collection}
+
+    if not write:
+        target = db.collection(collection)
+
+        def write(documents, results):
+            if results:
+                target.import_bulk(results, on_duplicate='update', halt_on_error=True)
+
+    workers = workers or os.cpu_count()
+    pending = deque()
+    read = written = 0
+
+    def in_flight():
+        return throttle.concurrency if throttle else workers * 2
+
+    def write_next():
+        nonlocal written
+        documents, future = pending.popleft()
+        results = future.result()
+        started = time.monotonic()
+        try:
+            write(documents, results)
+        except Exception:
+            if throttle:
+                throttle.record(len(results), time.monotonic() - started, error=True)
+            raise
+        if throttle:
+            throttle.record(len(results), time.monotonic() - started)
+        written += len(results)
+
+    # worker processes are spawned, not forked from a process running client threads
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker, initargs=(source, name, function_name)) as executor:
+        try:
+            for batch in query_batches(db, query, batch_size, bind_vars, ttl=ttl):
+                if throttle:
+                    throttle.acquire(len(batch))
+                read += len(batch)
+                pending.append((batch, executor.submit(transform_batch, batch)))
+                # write results in order, waiting for the oldest batch when the pool is full
+                while pending and (len(pending) >= in_flight() or pending[0][1].done()):
+                    write_next()
+
+            while pending:
+                write_next()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    return read, written
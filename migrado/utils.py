@@ -5,12 +5,20 @@ Copyright © 2019 Protojour AS, licensed under MIT.
 See LICENSE.txt for details.
 """
 
+from datetime import datetime, timezone
+from fnmatch import fnmatchcase
 from pathlib import Path
+from types import ModuleType
+import ast
+import io
 import json
 import re
+import tokenize
 
 import click
 
+from .constants import MIGRATION_TEMPLATE
+
 
 def ensure_path(path):
     """Ensure path given by `path` exists"""
@@ -19,6 +27,21 @@ def ensure_path(path):
     return path
 
 
+def find_migrations(migrations_path):
+    """List migration files (JavaScript or Python) in migrations directory, in migration id order"""
+    return sorted(
+        path for path in migrations_path.glob('[0-9]' * 4 + '*')
+        if path.suffix in ('.js', '.py')
+    )
+
+
+def find_baseline(migrations):
+    """Get id of squashed baseline migration (see migrado squash), if migrations start with one"""
+    if migrations and migrations[0].name.endswith('_squashed.js'):
+        return migrations[0].name[:4]
+    return None
+
+
 def check_migrations(migrations):
     if not migrations:
         raise click.UsageError('No migrations found, run migrado init')
@@ -35,6 +58,32 @@ def check_password(username, password, no_interaction):
     return password
 
 
+def split_databases(db):
+    """Split comma-separated list of database names and patterns"""
+    return [name.strip() for name in db.split(',') if name.strip()]
+
+
+def is_pattern(name):
+    """Check whether database name is a glob pattern"""
+    return any(char in name for char in '*?[')
+
+
+def match_databases(names, databases):
+    """
+    Match database names and glob patterns against a list of existing databases.
+    System databases are only matched by name.
+    """
+    matched = []
+    for name in names:
+        if is_pattern(name):
+            candidates = [db for db in sorted(databases) if not db.startswith('_') and fnmatchcase(db, name)]
+        else:
+            candidates = [name]
+        matched += [db for db in candidates if db not in matched]
+
+    return matched
+
+
 def select_migrations(current, target, migration_ids):
     """
     Select direction and migrations to run,
@@ -54,29 +103,408 @@ def select_migrations(current, target, migration_ids):
     return None, []
 
 
+MIGRATION_TOKEN_REGEX = re.compile(
+    r'(?P<comment>//[^\n]*|/\*.*?(?:\*/|\Z))'
+    r'|(?P<string>"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\'|`(?:[^`\\]|\\.)*`)'
+    r'|(?P<regex>(?:(?<=[(,=:\[!&|?{};])|(?<=\breturn))\s*'
+    r'/(?![/*])(?:[^/\\\[\n]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/[a-z]*)'
+    r'|(?P<function>\bfunction\s+(?P<name>forward|reverse)\b)'
+    r'|(?P<schema>\bvar\s+schema\s*=[ \t]*(?P<value>[^\n]+))'
+    r'|(?P<open>\{)|(?P<close>\})',
+    re.DOTALL
+)
+WRITE_REGEX = re.compile(r'//\s*write\s*([\w-]+)')
+EXECUTOR_REGEX = re.compile(r'//\s*executor\s*(native|transaction|arangosh)\b')
+DEPENDS_REGEX = re.compile(r'//\s*depends((?:[\s,]+\d{4}\b)+)')
+
+
+def parse_migration(script):
+    """
+    Parse migration script in a single pass, returning a dict of its forward and
+    reverse functions, write collections, schema, executor directive and explicit
+    dependencies (// depends 0001 0002). Strings, template literals, regular
+    expression literals and comments are skipped as whole tokens, so braces inside
+    them do not affect function boundaries. Raises ValueError if a forward or
+    reverse function is never closed, or the schema is not valid JSON.
+    """
+    migration = {
+        'forward': None,
+        'reverse': None,
+        'write_collections': [],
+        'schema': None,
+        'executor': None,
+        'depends': [],
+    }
+
+    depth = 0
+    name = start = None
+    for token in MIGRATION_TOKEN_REGEX.finditer(script or ''):
+        kind = token.lastgroup
+        if kind == 'comment':
+            comment = token.group('comment')
+            if comment.startswith('/*'):
+                continue
+            migration['write_collections'] += WRITE_REGEX.findall(comment)
+            executor = EXECUTOR_REGEX.search(comment)
+            if executor and not migration['executor']:
+                migration['executor'] = executor.group(1)
+            depends = DEPENDS_REGEX.search(comment)
+            if depends:
+                migration['depends'] += re.findall(r'\d{4}', depends.group(1))
+        elif kind == 'function':
+            if depth == 0 and name is None and not migration[token.group('name')]:
+                name, start = token.group('name'), token.start()
+        elif kind == 'schema':
+            if migration['schema'] is None:
+                try:
+                    migration['schema'] = json.loads(token.group('value').rstrip().rstrip(';'))
+                except json.JSONDecodeError as error:
+                    raise ValueError(f'Schema is not valid JSON: {error}')
+        elif kind == 'open':
+            depth += 1
+        elif kind == 'close':
+            depth -= 1
+            if depth == 0 and name is not None:
+                migration[name] = script[start:token.end()]
+                name = None
+
+    if name is not None:
+        raise ValueError(f'Function {name} is never closed.')
+
+    return migration
+
+
+def parse_python_migration(script):
+    """
+    Parse Python migration script, returning a dict like parse_migration, with the
+    source of its forward(db) and reverse(db) functions (or, for transform migrations,
+    its transform(document) and reverse_transform(document) functions, and for
+    rewrite migrations, its rewrite(document) function), write
+    collections and dependencies from '# write' and '# depends' comments, and the
+    script source. Transform and rewrite migrations assign the `collection` they
+    write to, which is added to write collections, and have no forward function.
+    A script that does not parse has no functions; its error is shown when it is run.
+    """
+    migration = {
+        'forward': None,
+        'reverse': None,
+        'write_collections': [],
+        'schema': None,
+        'executor': 'python',
+        'depends': [],
+        'source': script,
+    }
+
+    try:
+        tree = ast.parse(script)
+        tokens = list(tokenize.generate_tokens(io.StringIO(script).readline))
+    except (SyntaxError, tokenize.TokenError):
+        return migration
+
+    functions = {
+        node.name: ast.get_source_segment(script, node)
+        for node in tree.body if isinstance(node, ast.FunctionDef)
+    }
+    collection = next((
+        node.value.value for node in tree.body
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant)
+        and isinstance(node.value.value, str)
+        and any(isinstance(target, ast.Name) and target.id == 'collection' for target in node.targets)
+    ), None)
+
+    if collection and 'forward' not in functions and 'rewrite' in functions:
+        # copy-and-swap rewrite migrations (see rewrite.run_rewrite)
+        migration['executor'] = 'rewrite'
+        migration['forward'] = functions['rewrite']
+    elif collection and 'forward' not in functions and 'transform' in functions:
+        # transform migrations (see transform.run_transform)
+        migration['executor'] = 'transform'
+        migration['forward'] = functions['transform']
+        migration['reverse'] = functions.get('reverse_transform')
+    else:
+        migration['forward'] = functions.get('forward')
+        migration['reverse'] = functions.get('reverse')
+
+    for token in tokens:
+        if token.type == tokenize.COMMENT:
+            comment = '//' + token.string[1:]
+            migration['write_collections'] += WRITE_REGEX.findall(comment)
+            depends = DEPENDS_REGEX.search(comment)
+            if depends:
+                migration['depends'] += re.findall(r'\d{4}', depends.group(1))
+
+    if migration['executor'] != 'python' and collection not in migration['write_collections']:
+        migration['write_collections'].append(collection)
+
+    return migration
+
+
+def parse_migration_file(name, script):
+    """Parse JavaScript or Python migration script, by file name"""
+    if name.endswith('.py'):
+        return parse_python_migration(script)
+    try:
+        return parse_migration(script)
+    except ValueError as error:
+        raise click.UsageError(f'Migration {name} could not be parsed: {error}')
+
+
+def load_python_migration(source, name):
+    """Load Python migration script as a module"""
+    module = ModuleType(name)
+    exec(compile(source, name, 'exec'), module.__dict__)
+    return module
+
+
 def parse_write_collections(script):
     """Extract collections intended for writing from migration script"""
-    collections_regex = r'//\s*write\s*([\w-]+)'
-    return re.findall(collections_regex, script)
+    return parse_migration(script)['write_collections']
+
+
+def parse_executor(script):
+    """Extract explicit executor directive (// executor name) from migration script"""
+    return parse_migration(script)['executor']
+
+
+def classify_migration(function, executor=None):
+    """
+    Decide which executor should run given migration function:
+    'native' for generated schema statements (see parse_ddl), 'arangosh' for
+    other functions that create or drop collections, indexes and the like
+    (not allowed in transactions), 'transaction' for everything else.
+    An explicit executor (directive in the script) takes precedence.
+    Returns the executor and whether it was given explicitly.
+    """
+    if executor:
+        return executor, True
+
+    if parse_ddl(function) is not None:
+        return 'native', False
+
+    ddl_regex = (
+        r'\._(create|createDocumentCollection|createEdgeCollection|createView|createDatabase|'
+        r'drop|dropView|dropDatabase)\(|\.(ensure\w*Index|dropIndex|rename|drop)\(|'
+        r'\.properties\(\s*[^\s)]|'
+        r'@arangodb/(general-graph|smart-graph|analyzers)'
+    )
+    if re.search(ddl_regex, function or ''):
+        return 'arangosh', False
+
+    return 'transaction', False
+
+
+def dependency_graph(migration_ids, depends, writes):
+    """
+    Build dependency graph of migrations, given migration ids in order, explicit
+    dependencies and write collections (None if unknown) by migration id.
+    A migration depends on earlier migrations it names explicitly, or writing
+    any of the same collections. Migrations with unknown writes depend on all
+    earlier migrations, and all later migrations depend on them.
+    Returns the set of earlier migration ids each migration depends on.
+    """
+    graph = {}
+    for index, id_ in enumerate(migration_ids):
+        graph[id_] = {
+            earlier for earlier in migration_ids[:index]
+            if earlier in depends[id_] or writes[id_] is None or writes[earlier] is None
+            or writes[id_] & writes[earlier]
+        }
+
+    return graph
+
+
+def applied_state(migration_ids, applied):
+    """
+    Get state (the last migration id of the longest applied prefix of migration ids)
+    and the migration ids applied ahead of it, given the set of applied migration ids
+    """
+    state = '0000'
+    for id_ in migration_ids:
+        if id_ not in applied:
+            break
+        state = id_
+
+    return state, sorted(id_ for id_ in applied if id_ > state)
 
 
 def extract_migration(script, name):
     """Extract given (forward, reverse) migration from script"""
-    functions_regex = (
-        r'.*(?P<forward>function forward.+{.+})'
-        r'.*(?P<reverse>function reverse.+{.+}).*'
+    if name in ('forward', 'reverse'):
+        return parse_migration(script)[name]
+
+
+def extract_query(function):
+    """Extract AQL query from the first db._query() call in a migration function"""
+    query_regex = r'db\._query\(\s*(?P<quote>[`"\'])(?P<query>.*?)(?P=quote)'
+    match = re.search(query_regex, function or '', re.DOTALL)
+    if match:
+        return match.group('query').strip()
+
+
+def batch_query(query):
+    """
+    Rewrite AQL query to process one batch of documents at a time,
+    in _key order after the key given by the @last_key bind variable,
+    and up to the key given by @upper_key (if not null).
+    Returns the collection iterated over and the rewritten query.
+    """
+    loop_regex = r'FOR\s+(?P<var>\w+)\s+IN\s+(?P<coll>[\w-]+)'
+    match = re.match(loop_regex, query or '', re.IGNORECASE)
+    if not match:
+        return None, None
+
+    var, coll = match.group('var'), match.group('coll')
+    body = query[match.end():]
+    batch = (
+        f'LET batch = (\n'
+        f'    FOR {var} IN {coll}\n'
+        f'        FILTER {var}._key > @last_key\n'
+        f'        FILTER @upper_key == null OR {var}._key <= @upper_key\n'
+        f'        SORT {var}._key\n'
+        f'        LIMIT @batch_size\n'
+        f'        RETURN {var}\n'
+        f')\n'
+        f'LET processed = (\n'
+        f'    FOR {var} IN batch{body}\n'
+        f')\n'
+        f'RETURN {{ count: LENGTH(batch), last_key: LAST(batch)._key }}'
+    )
+    return coll, batch
+
+
+def parse_ddl(function):
+    """
+    Parse migration function consisting only of generated schema (DDL) statements,
+    i.e. db._create(), db._drop() and db.<collection>.properties() calls.
+    Returns a list of operations, or None if the function contains anything else.
+    """
+    if not function or '{' not in function:
+        return None
+
+    body = function[function.index('{') + 1:function.rindex('}')]
+    statement_regexes = {
+        'create': r'db\._create\("(?P<name>[\w-]+)", (?P<options>\{.*\})(?:, "(?P<type>document|edge)")?\)',
+        'drop': r'db\._drop\("(?P<name>[\w-]+)"\)',
+        'properties': r'db\.(?P<name>\w+)\.properties\((?P<options>\{.*\})\)',
+    }
+    ignore_regex = r'|//.*|var db = require\("@arangodb"\)\.db|var schema = .+'
+
+    operations = []
+    for line in body.splitlines():
+        line = line.strip().rstrip(';')
+        if re.fullmatch(ignore_regex, line):
+            continue
+
+        for operation, statement_regex in statement_regexes.items():
+            match = re.fullmatch(statement_regex, line)
+            if match:
+                break
+        else:
+            return None
+
+        options = {}
+        if match.groupdict().get('options'):
+            try:
+                options = json.loads(match.group('options'))
+            except json.JSONDecodeError:
+                return None
+            if set(options) - {'schema'}:
+                return None
+
+        operations.append({
+            'operation': operation,
+            'name': match.group('name'),
+            'options': options,
+            'edge': match.groupdict().get('type') == 'edge',
+        })
+
+    return operations
+
+
+def coalesce_migrations(functions):
+    """
+    Combine (migration id, function) pairs into one function running them in order.
+    If one of them throws, the error is rethrown with the failing migration id.
+    """
+    migrations = ',\n'.join(
+        f'        [{json.dumps(id_)}, {function}]' for id_, function in functions
+    )
+    return (
+        'function () {\n'
+        '    var migrations = [\n'
+        f'{migrations}\n'
+        '    ]\n'
+        '    var result\n'
+        '    for (var i = 0; i < migrations.length; i++) {\n'
+        '        try {\n'
+        '            result = migrations[i][1]()\n'
+        '        } catch (error) {\n'
+        '            throw new Error("migration " + migrations[i][0] + " failed: " + error)\n'
+        '        }\n'
+        '    }\n'
+        '    return result\n'
+        '}'
     )
-    matches = re.fullmatch(functions_regex, script, re.DOTALL)
-    if matches and name in matches.groupdict():
-        return matches.group(name)
 
 
 def extract_schema(script):
     """Extract schema from script"""
-    schema_regex = r'var schema = (.+)'
-    match = re.search(schema_regex, script)
-    if match:
-        return json.loads(match.group(1))
+    return parse_migration(script)['schema']
+
+
+def history_entry(migration_id, direction, executors, environment, started, ended, **details):
+    """Build migration history entry, for run times given as Unix timestamps"""
+    return {
+        'migration_id': migration_id,
+        'direction': direction,
+        'executors': executors,
+        'environment': environment,
+        'started': datetime.fromtimestamp(started, timezone.utc).isoformat(),
+        'ended': datetime.fromtimestamp(ended, timezone.utc).isoformat(),
+        'duration': round(ended - started, 3),
+        **details,
+    }
+
+
+def schema_migration(schema, validation, comment=None):
+    """
+    Build schema migration script creating the collections of given schema
+    (and dropping them in reverse), with an optional comment line after the header
+    """
+    schema = {
+        'collections': schema.get('collections') or {},
+        'edge_collections': schema.get('edge_collections') or {}
+    }
+    forward_data = [f'var schema = {json.dumps(schema)}']
+    reverse_data = []
+
+    for name, props in schema['collections'].items():
+        options = get_options(props, validation)
+        forward_data.append(f'db._create("{name}", {json.dumps(options)})')
+        reverse_data.append(f'db._drop("{name}")')
+
+    for name, props in schema['edge_collections'].items():
+        options = get_options(props, validation)
+        forward_data.append(f'db._create("{name}", {json.dumps(options)}, "edge")')
+        reverse_data.append(f'db._drop("{name}")')
+
+    script = MIGRATION_TEMPLATE.replace(
+        '// add your forward migration here',
+        '\n    '.join(forward_data)
+    )
+
+    if reverse_data:
+        script = script.replace(
+            '// add your reverse migration here',
+            '\n    '.join(reverse_data)
+        )
+
+    if comment:
+        lines = script.split('\n')
+        lines.insert(2, f'// {comment}')
+        script = '\n'.join(lines)
+
+    return script
 
 
 def get_options(props, validation):
@@ -4,6 +4,7 @@ import pytest
 from arango.exceptions import *
 
 from migrado.db_client import MigrationClient
+from migrado.utils import batch_query, history_entry
 
 
 TLS = os.getenv('MIGRADO_TLS', False) in ['True', 'true', '1']
@@ -21,6 +22,13 @@ def test_migration_client(clean_arango):
     client_two = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
 
 
+def test_migration_client_pool_size():
+
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL, pool_size=64)
+    assert client.db_client._http._pool_maxsize == 64
+    assert client.db_client._http._pool_connections == 64
+
+
 def test_read_write_state(clean_arango):
 
     client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
@@ -33,6 +41,14 @@ def test_read_write_state(clean_arango):
 
     assert success
     assert current == '0001'
+    assert client.read_applied() == []
+
+    client.write_state('0001', ['0003', '0004'])
+    assert client.read_state() == '0001'
+    assert client.read_applied() == ['0003', '0004']
+
+    client.write_state('0004')
+    assert client.read_applied() == []
 
 
 def test_read_write_schema(clean_arango):
@@ -49,6 +65,97 @@ def test_read_write_schema(clean_arango):
     assert current == {"test": "schema"}
 
 
+def test_read_metadata(clean_arango):
+
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+
+    assert client.db is client.db
+    assert client.read_metadata() == {}
+    assert not client.db.has_collection(COLL)
+
+    client.write_state('0002')
+    client.write_schema({'test': 'schema'})
+    assert client.state_coll is client.state_coll
+
+    metadata = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL).read_metadata()
+    assert metadata['state']['migration_id'] == '0002'
+    assert metadata['schema']['schema'] == {'test': 'schema'}
+    assert 'checkpoint' not in metadata
+
+
+def test_read_write_checkpoint(clean_arango):
+
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+
+    assert client.read_checkpoint() is None
+
+    ranges = [{'start': '', 'end': None, 'last_key': 'abc', 'processed': 1000, 'done': False}]
+    assert client.write_checkpoint('0002', 'forward', ranges)
+    checkpoint = client.read_checkpoint()
+
+    assert checkpoint['migration_id'] == '0002'
+    assert checkpoint['direction'] == 'forward'
+    assert checkpoint['ranges'] == ranges
+
+    client.clear_checkpoint()
+    assert client.read_checkpoint() is None
+
+
+def test_read_write_history(clean_arango):
+
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+
+    assert client.read_history() == []
+
+    client.write_history([history_entry('0001', 'forward', ['native'], 'test', 0, 1)])
+    client.write_history([
+        history_entry('0002', 'forward', ['transaction'], 'test', 10, 12),
+        history_entry('0003', 'forward', ['transaction'], 'test', 10, 12),
+    ])
+    client.write_history([history_entry('0002', 'forward', ['transaction', 'arangosh'], 'test', 20, 25)])
+    client.write_history([history_entry('0002', 'forward', ['transaction'], 'prod', 20, 21)])
+
+    history = client.read_history()
+    assert [(entry['migration_id'], entry['environment']) for entry in history] == [
+        ('0002', 'test'), ('0003', 'test'), ('0002', 'prod'), ('0001', 'test')
+    ]
+    assert history[0]['runs'] == 2
+    assert history[0]['duration'] == 5
+    assert history[0]['previous'] == 2
+    assert history[0]['max'] == 5
+    assert history[0]['executors'] == ['transaction', 'arangosh']
+    assert history[2]['previous'] is None
+
+    assert len(client.read_history(limit=1)) == 1
+
+
+def test_migration_lock(clean_arango):
+
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+
+    assert client.read_lock() == ('0000', None)
+
+    assert client.acquire_lock('one', 30) == 'one'
+    assert client.acquire_lock('two', 30) == 'one'
+    assert client.acquire_lock('one', 30) == 'one'
+    assert client.read_lock() == ('0000', 'one')
+
+    assert client.renew_lock('one', 30)
+    assert not client.renew_lock('two', 30)
+
+    client.write_state('0002')
+    client.release_lock('two')
+    assert client.read_lock() == ('0002', 'one')
+    client.release_lock('one')
+    assert client.read_lock() == ('0002', None)
+
+    # expired leases are taken over
+    assert client.acquire_lock('one', 0) == 'one'
+    assert client.read_lock() == ('0002', None)
+    assert client.acquire_lock('two', 30) == 'two'
+    assert not client.renew_lock('one', 30)
+
+
 def test_infer_schema(clean_arango):
 
     client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
@@ -74,6 +181,8 @@ def test_infer_schema(clean_arango):
     client.db.create_collection('things', schema=collection_schema)
     client.db.create_collection('stuff')
     client.db.create_collection('has_stuff', edge=True, schema=collection_schema)
+    client.write_state('0001')
+    client.write_history([history_entry('0001', 'forward', ['native'], 'test', 0, 1)])
 
     schema = client.infer_schema(validation=False)
 
@@ -104,6 +213,21 @@ def test_infer_schema(clean_arango):
     }
 
 
+def test_list_collections(clean_arango):
+
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+    client.db.create_collection('things')
+    client.db.create_collection('has_stuff', edge=True)
+
+    collections = {
+        collection['name']: collection for collection in client.list_collections(validation=True)
+    }
+
+    assert collections['things'] == {'name': 'things', 'type': 'document', 'system': False, 'schema': None}
+    assert collections['has_stuff']['type'] == 'edge'
+    assert all(collection['system'] for name, collection in collections.items() if name.startswith('_'))
+
+
 def test_run_transaction(clean_arango):
 
     client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
@@ -136,6 +260,172 @@ def test_run_transaction(clean_arango):
     assert not error
     assert client.read_state() == '9999'
 
+    things_function = '''
+    function forward() {
+        var db = require("@arangodb").db
+        db.things.insert({ _key: "thing" })
+    }
+    '''
+    client.db.create_collection('things')
+
+    # writes state and schema in the same transaction
+    error = client.run_transaction(things_function, ['things'], migration_id='0002', schema={'test': 'schema'})
+    assert not error
+    assert client.read_state() == '0002'
+    assert client.read_schema() == {'test': 'schema'}
+
+    # state is not written if the migration fails
+    error = client.run_transaction(things_function, ['things'], migration_id='0003')
+    assert error
+    assert client.read_state() == '0002'
+
+
+def test_run_transaction_job(clean_arango):
+
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+    client.db.create_collection('things')
+
+    things_function = '''
+    function forward() {
+        var db = require("@arangodb").db
+        db.things.insert({ _key: "thing" })
+    }
+    '''
+
+    error = client.run_transaction(things_function, ['things'], migration_id='0002', job=True)
+    assert not error
+    assert client.read_state() == '0002'
+    assert client.db.collection('things').has('thing')
+
+    error = client.run_transaction(things_function, ['things'], migration_id='0003', job=True)
+    assert isinstance(error, TransactionExecuteError)
+    assert client.read_state() == '0002'
+
+
+def test_run_stream_transaction(clean_arango):
+
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+    books = client.db.create_collection('books')
+    books.insert_many([{'_key': str(i), 'title': f'Book {i}'} for i in range(25)])
+
+    def forward(db):
+        for batch in db.batches('FOR book IN books RETURN book', batch_size=10):
+            db.collection('books').update_many([{**book, 'upper': book['title'].upper()} for book in batch])
+            db.commit()
+
+    assert client.run_stream_transaction(forward, ['books'], migration_id='0002') is None
+    assert client.read_state() == '0002'
+    assert all(book['upper'] == book['title'].upper() for book in books.all())
+
+    def failing(db):
+        db.aql.execute('FOR book IN books REMOVE book IN books')
+        raise ValueError('failed')
+
+    error = client.run_stream_transaction(failing, ['books'], migration_id='0003')
+    assert isinstance(error, ValueError)
+    assert books.count() == 25
+    assert client.read_state() == '0002'
+
+
+def test_wait_for_job():
+
+    class Job:
+        def __init__(self, polls):
+            self.polls = polls
+
+        def status(self):
+            self.polls -= 1
+            return 'pending' if self.polls > 0 else 'done'
+
+        def result(self):
+            return 'result'
+
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+    job = Job(4)
+    assert client.wait_for_job(job, poll_interval=0.001) == 'result'
+    assert job.polls == 0
+
+
+def test_run_transaction_job_lost():
+
+    class Job:
+        def status(self):
+            raise ArangoError('job not found')
+
+    class AsyncDatabase:
+        def begin_async_execution(self, return_result):
+            return self
+
+        def execute_transaction(self, script, **options):
+            return Job()
+
+    # a job polled through another coordinator is not found
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+    client._db = AsyncDatabase()
+    error = client.run_transaction('function () {}', ['things'], job=True)
+    assert isinstance(error, ArangoError)
+
+
+def test_run_batch(clean_arango):
+
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+    things = client.db.create_collection('things')
+    things.insert_many([{'_key': str(key)} for key in range(10, 15)])
+
+    _, query = batch_query('FOR thing IN things UPDATE thing WITH { done: true } IN things')
+
+    result = client.run_batch(query, '', 3)
+    assert result == {'count': 3, 'last_key': '12'}
+
+    result = client.run_batch(query, '12', 3)
+    assert result == {'count': 2, 'last_key': '14'}
+
+    result = client.run_batch(query, '14', 3)
+    assert result == {'count': 0, 'last_key': None}
+
+    assert all(thing['done'] for thing in things.all())
+
+    result = client.run_batch(query, '', 10, upper_key='12')
+    assert result == {'count': 3, 'last_key': '12'}
+
+
+def test_key_boundaries(clean_arango):
+
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+    things = client.db.create_collection('things')
+    things.insert_many([{'_key': str(key)} for key in range(10, 22)])
+
+    assert client.key_boundaries('things', 1) == []
+    assert client.key_boundaries('things', 3) == ['14', '18']
+    assert client.key_boundaries('things', 100) == [str(key) for key in range(10, 22)]
+
+
+def test_run_ddl(clean_arango):
+
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+    schema = {'rule': {'required': ['title']}, 'level': 'moderate', 'message': 'Test message'}
+
+    error = client.run_ddl([
+        {'operation': 'create', 'name': 'books', 'options': {}, 'edge': False},
+        {'operation': 'create', 'name': 'author_of', 'options': {'schema': schema}, 'edge': True},
+        {'operation': 'properties', 'name': 'books', 'options': {'schema': schema}, 'edge': False},
+    ])
+    assert not error
+    assert client.db.collection('author_of').properties()['edge']
+    assert client.db.collection('books').properties()['schema']['rule'] == schema['rule']
+
+    error = client.run_ddl([
+        {'operation': 'drop', 'name': 'books', 'options': {}, 'edge': False},
+        {'operation': 'drop', 'name': 'books', 'options': {}, 'edge': False},
+    ])
+    assert not error
+    assert not client.db.has_collection('books')
+
+    error = client.run_ddl([
+        {'operation': 'create', 'name': 'author_of', 'options': {}, 'edge': False},
+    ])
+    assert error
+
 
 def test_run_script(clean_arango):
 
@@ -159,3 +449,13 @@ def test_run_script(clean_arango):
     output = client.run_script(valid_function, 'arangosh')
     assert output == ''
     assert client.db.has_collection('things')
+
+    # scripts run in the same arangosh process until the client is closed
+    session = client.arangosh_session
+    output = client.run_script(valid_function, 'arangosh')
+    assert 'duplicate name' in output
+    assert client.arangosh_session is session
+
+    client.close()
+    assert client.arangosh_session is None
+    assert not session.alive
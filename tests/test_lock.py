@@ -0,0 +1,68 @@
+from migrado.lock import MigrationLock
+
+
+class LockClient:
+    """Stand-in for MigrationClient lock operations, with another runner holding the lock"""
+
+    def __init__(self, states, holder='other'):
+        self.states = states
+        self.holder = holder
+        self.renewed = 0
+
+    def connect(self):
+        return None
+
+    def read_lock(self):
+        state = self.states.pop(0) if len(self.states) > 1 else self.states[0]
+        return state, self.holder
+
+    def acquire_lock(self, owner, ttl):
+        self.holder = self.holder or owner
+        return self.holder
+
+    def renew_lock(self, owner, ttl, db=None):
+        self.renewed += 1
+        return self.holder == owner
+
+    def release_lock(self, owner):
+        if self.holder == owner:
+            self.holder = None
+
+
+def test_migration_lock_wait():
+    client = LockClient(['0041', '0042', '0043'])
+    lock = MigrationLock(client, poll_interval=0.01)
+    messages = []
+
+    assert not lock.wait('0043', messages.append)
+    assert messages == ['Waiting for migration lock held by other (state is at 0041)...']
+    assert client.holder == 'other'
+
+
+def test_migration_lock_acquire():
+    client = LockClient(['0041'], holder=None)
+    lock = MigrationLock(client, ttl=0.03)
+
+    assert lock.wait('0043')
+    assert client.holder == lock.owner
+    assert lock.heartbeat.is_alive()
+
+    lock.stopped.wait(0.05)
+    lock.release()
+    assert client.renewed >= 1
+    assert lock.heartbeat is None
+    assert client.holder is None
+
+
+
+def test_migration_lock_lost():
+    client = LockClient(['0041'], holder=None)
+    messages = []
+    lock = MigrationLock(client, ttl=0.03, echo=messages.append)
+
+    assert lock.wait('0043')
+    client.holder = 'other'
+    assert lock.lost.wait(1)
+    assert messages == ['Warning! Migration lock is no longer held by this runner.']
+    lock.release()
+    assert client.holder == 'other'
@@ -0,0 +1,60 @@
+import json
+import os
+
+from migrado.manifest import Manifest, VERSION
+from migrado.utils import parse_migration
+
+
+def test_manifest(tmp_path):
+    migration_path = tmp_path.joinpath('0001_initial.js')
+    migration_path.write_text('// write books\nfunction forward() {}\nfunction reverse() {}\n')
+
+    manifest = Manifest(tmp_path)
+    assert manifest.changed
+    assert manifest.entries == {}
+
+    migrations = manifest.load_all([migration_path])
+    assert migrations == {'0001': parse_migration(migration_path.read_text())}
+    assert manifest.save()
+    assert tmp_path.joinpath('.migrado', 'manifest.json').exists()
+
+    # unchanged files are not read again
+    manifest = Manifest(tmp_path)
+    assert not manifest.changed
+    entry = manifest.entries['0001_initial.js']
+    entry['migration']['write_collections'] = ['cached']
+    assert manifest.load(migration_path)['write_collections'] == ['cached']
+    assert not manifest.save()
+
+    # touched, but unchanged content is not parsed again
+    stat = migration_path.stat()
+    os.utime(migration_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert manifest.load(migration_path)['write_collections'] == ['cached']
+    assert manifest.changed
+
+    # changed content is parsed again
+    migration_path.write_text('// write authors\nfunction forward() {}\nfunction reverse() {}\n')
+    assert manifest.load(migration_path)['write_collections'] == ['authors']
+    checksums = manifest.checksums()
+    assert list(checksums) == ['0001_initial.js']
+
+    # changed content with unchanged size and mtime is only found when verifying
+    stat = migration_path.stat()
+    migration_path.write_text('// write editors\nfunction forward() {}\nfunction reverse() {}\n')
+    os.utime(migration_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert manifest.load(migration_path)['write_collections'] == ['authors']
+    assert manifest.load(migration_path, verify=True)['write_collections'] == ['editors']
+    assert manifest.checksums() != checksums
+
+    # removed files are dropped
+    assert manifest.load_all([]) == {}
+    assert manifest.entries == {}
+    manifest.save()
+    manifest_path = tmp_path.joinpath('.migrado', 'manifest.json')
+    assert json.loads(manifest_path.read_text()) == {'version': VERSION, 'migrations': {}}
+
+    # manifests from earlier versions are rebuilt
+    manifest_path.write_text(json.dumps({'migrations': {'0001_initial.js': {}}}))
+    manifest = Manifest(tmp_path)
+    assert manifest.changed
+    assert manifest.entries == {}
@@ -0,0 +1,39 @@
+from migrado.metrics import RunMetrics, format_labels
+from migrado.utils import history_entry
+
+
+def test_format_labels():
+    assert format_labels({}) == ''
+    assert format_labels({'db': 'test', 'le': '+Inf'}) == '{db="test",le="+Inf"}'
+    assert format_labels({'db': 'a"b\\c\nd'}) == '{db="a\\"b\\\\c\\nd"}'
+
+
+def test_run_metrics(tmp_path):
+    metrics = RunMetrics()
+    metrics.observe('test', history_entry('0001', 'forward', ['native'], None, 0.0, 0.2))
+    metrics.observe('test', history_entry('0002', 'forward', ['transaction', 'arangosh'], None, 0.0, 2.0))
+    metrics.observe('test', history_entry('0003', 'forward', ['batch'], None, 0.0, 4.0, documents=1000))
+    metrics.retry('test')
+    metrics.finish(True)
+
+    lines = metrics.render().splitlines()
+
+    assert '# TYPE migrado_migration_duration_seconds histogram' in lines
+    assert ('migrado_migration_duration_seconds_bucket'
+        '{db="test",direction="forward",executor="native",le="0.1"} 0') in lines
+    assert ('migrado_migration_duration_seconds_bucket'
+        '{db="test",direction="forward",executor="native",le="0.5"} 1') in lines
+    assert ('migrado_migration_duration_seconds_bucket'
+        '{db="test",direction="forward",executor="arangosh",le="+Inf"} 1') in lines
+    assert 'migrado_migration_duration_seconds_sum{db="test",direction="forward",executor="arangosh"} 2.0' in lines
+    assert 'migrado_migration_last_duration_seconds{db="test",migration_id="0003",direction="forward"} 4.0' in lines
+    assert 'migrado_migrations_total{db="test",executor="arangosh"} 1' in lines
+    assert 'migrado_retries_total{db="test"} 2' in lines
+    assert 'migrado_batch_documents_total{db="test",migration_id="0003",direction="forward"} 1000' in lines
+    assert 'migrado_batch_documents_per_second{db="test",migration_id="0003",direction="forward"} 250.0' in lines
+    assert 'migrado_run_success 1' in lines
+
+    path = tmp_path.joinpath('migrado.prom')
+    metrics.write(path)
+    assert path.read_text() == metrics.render()
+    assert not tmp_path.joinpath('migrado.prom.tmp').exists()
@@ -1,4 +1,6 @@
 from pathlib import Path
+import json
+import time
 
 import pytest
 
@@ -108,6 +110,186 @@ def test_migrado_inspect(runner, clean_arango):
         assert 'Latest migration on disk is 0001' in result.output
 
 
+def test_migrado_check(runner, clean_arango):
+    with runner.isolated_filesystem():
+
+        result = runner.invoke(migrado, ['init'])
+        assert result.exit_code == 0
+
+        result = runner.invoke(migrado, ['check'])
+        assert result.exit_code == 3
+        assert 'state is at 0000, latest migration is 0001 (behind)' in result.output
+
+        result = runner.invoke(migrado, ['run', '--no-interaction'])
+        assert result.exit_code == 0
+
+        # a current database is checked with a single state read, well within budget
+        start = time.perf_counter()
+        result = runner.invoke(migrado, ['check'])
+        elapsed = time.perf_counter() - start
+
+        assert result.exit_code == 0
+        assert '(current)' in result.output
+        assert elapsed < 1
+
+        # the manifest is used if there are no migration files
+        Path('migrations/0001_initial.js').unlink()
+        result = runner.invoke(migrado, ['check'])
+        assert result.exit_code == 0
+
+        client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+        client.write_state('0002')
+
+        result = runner.invoke(migrado, ['check'])
+        assert result.exit_code == 4
+        assert '(ahead)' in result.output
+
+
+def test_migrado_check_budget(runner):
+    with runner.isolated_filesystem():
+
+        result = runner.invoke(migrado, ['init'])
+        assert result.exit_code == 0
+
+        # an unreachable database fails at once, without retries
+        start = time.perf_counter()
+        result = runner.invoke(migrado, ['check', '--db', DB, '--port', '1', '--timeout', '1'])
+        elapsed = time.perf_counter() - start
+
+        assert result.exit_code == 1
+        assert 'Error!' in result.output
+        assert elapsed < 1
+
+
+def test_migrado_inspect_history(runner, clean_arango):
+    with runner.isolated_filesystem():
+
+        result = runner.invoke(migrado, ['init'])
+        assert result.exit_code == 0
+
+        result = runner.invoke(migrado, ['inspect', '--history'])
+        assert result.exit_code == 0
+        assert 'No migration history found.' in result.output
+
+        result = runner.invoke(migrado, ['run', '--history', '--environment', 'test'])
+        assert result.exit_code == 0
+
+        result = runner.invoke(migrado, ['run', '--target', '0001', '--state', '0000', '--history'])
+        assert result.exit_code == 0
+
+        result = runner.invoke(migrado, ['inspect', '--history'])
+        assert result.exit_code == 0
+        assert 'Slowest migrations:' in result.output
+        assert '0001 forward (test): ' in result.output
+        assert f'0001 forward ({HOST}:{PORT}): ' in result.output
+        assert 's, native (last of 1 at ' in result.output
+
+
+def test_migrado_squash(runner):
+    schema_path = Path('tests/test_schema.yml').resolve()
+    with runner.isolated_filesystem():
+
+        result = runner.invoke(migrado, ['init', '--schema', schema_path])
+        assert result.exit_code == 0
+
+        result = runner.invoke(migrado, ['make', '--name', 'data'])
+        assert result.exit_code == 0
+        Path('migrations/0002_data.js').write_text(
+            MIGRATION_TEMPLATE.replace('// add your forward migration here', 'db.books.insert({})')
+        )
+
+        result = runner.invoke(migrado, ['squash', '--upto', '0009'])
+        assert result.exit_code == 2
+        assert 'Migration 0009 not found' in result.output
+
+        result = runner.invoke(migrado, ['squash', '--upto', '0002'], input='n\n')
+        assert result.exit_code == 1
+        assert 'Migrations 0002 are not schema migrations' in result.output
+        assert Path('migrations/0002_data.js').exists()
+
+        result = runner.invoke(migrado, ['squash', '--upto', '0002'], input='y\n')
+        assert result.exit_code == 0
+        assert 'Migrations up to 0002 squashed' in result.output
+
+        assert sorted(path.name for path in Path('migrations').glob('*.js')) == ['0002_squashed.js']
+        assert Path('migrations/squashed/0001_initial.js').exists()
+        assert Path('migrations/squashed/0002_data.js').exists()
+
+        baseline = Path('migrations/0002_squashed.js').read_text()
+        assert '// squashed migrations up to 0002' in baseline
+        assert 'db._create("books", {})' in baseline
+
+        result = runner.invoke(migrado, ['make'])
+        assert result.exit_code == 0
+
+        # squashing again replaces the baseline
+        result = runner.invoke(migrado, ['squash', '--upto', '0003', '--no-interaction'])
+        assert result.exit_code == 0
+        assert sorted(path.name for path in Path('migrations').glob('*.js')) == ['0003_squashed.js']
+        assert not Path('migrations/squashed/0002_squashed.js').exists()
+        assert Path('migrations/squashed/0003.js').exists()
+
+
+def test_migrado_run_squashed(runner, clean_arango):
+    schema_path = Path('tests/test_schema.yml').resolve()
+    with runner.isolated_filesystem():
+
+        result = runner.invoke(migrado, ['init', '--schema', schema_path])
+        assert result.exit_code == 0
+        result = runner.invoke(migrado, ['make'])
+        assert result.exit_code == 0
+        result = runner.invoke(migrado, ['make'])
+        assert result.exit_code == 0
+
+        result = runner.invoke(migrado, ['run', '--target', '0001'])
+        assert result.exit_code == 0
+
+        result = runner.invoke(migrado, ['squash', '--upto', '0002'])
+        assert result.exit_code == 0
+
+        # state is within squashed migrations
+        result = runner.invoke(migrado, ['run'])
+        assert result.exit_code == 1
+        assert 'migrations up to 0002 have been squashed' in result.output
+
+        result = runner.invoke(migrado, ['run', '--path', 'migrations/squashed'])
+        assert result.exit_code == 0
+        assert 'State is now at 0002.' in result.output
+
+        result = runner.invoke(migrado, ['run'])
+        assert result.exit_code == 0
+        assert 'State is now at 0003.' in result.output
+
+        # fresh databases start from the baseline
+        result = runner.invoke(migrado, ['run', '--state', '0000', '--plan'])
+        assert result.exit_code == 0
+        assert '0002: native' in result.output
+
+
+def test_migrado_manifest(runner):
+    with runner.isolated_filesystem():
+
+        result = runner.invoke(migrado, ['init'])
+        assert result.exit_code == 0
+
+        result = runner.invoke(migrado, ['manifest', '--check'])
+        assert result.exit_code == 1
+        assert 'Manifest is out of date' in result.output
+
+        result = runner.invoke(migrado, ['manifest'])
+        assert result.exit_code == 0
+        assert '  0001_initial.js' in result.output
+        assert Path('migrations/.migrado/manifest.json').exists()
+
+        result = runner.invoke(migrado, ['manifest', '--check'])
+        assert result.exit_code == 0
+
+        Path('migrations/0001_initial.js').write_text('// changed')
+
+        result = runner.invoke(migrado, ['manifest', '--check'])
+        assert result.exit_code == 1
+
+
 def test_migrado_export(runner, clean_arango):
     schema_path = Path('tests/test_schema.yml').resolve()
     with runner.isolated_filesystem():
@@ -210,11 +392,253 @@ def test_migrado_run(runner, clean_arango):
         assert result.exit_code == 1
         assert 'Can\'t connect to host(s)' in result.output
 
+        # generated schema migrations do not need arangosh
+        result = runner.invoke(migrado, ['run', '--arangosh', '/bad/path'])
+        assert result.exit_code == 0
+        assert 'Running forward migration 0001 as native schema migration' in result.output
+        assert 'State is now at 0001.' in result.output
+
+        result = runner.invoke(migrado, ['make', '--name', 'index'])
+        assert result.exit_code == 0
+
+        migration_path = Path('migrations/0002_index.js')
+        migration_path.write_text(
+            migration_path.read_text()
+            .replace(
+                '// add your forward migration here',
+                'db.books.ensureIndex({ type: "persistent", fields: ["isbn"], name: "isbn" })'
+            )
+            .replace(
+                '// add your reverse migration here',
+                'db.books.dropIndex("isbn")'
+            )
+        )
+
         result = runner.invoke(migrado, ['run', '--arangosh', '/bad/path'])
         assert result.exit_code == 1
+        assert 'Running forward migration 0002 in transaction' not in result.output
         assert 'No such file or directory' in result.output
 
+        result = runner.invoke(migrado, ['run', '--plan', '--state', '0000'])
+        assert result.exit_code == 0
+        assert 'Plan for forward migration from 0000 to 0002' in result.output
+        assert '  0001: native' in result.output
+        assert '  0002: arangosh' in result.output
+
         result = runner.invoke(migrado, ['run', '--no-interaction'])
         assert result.exit_code == 0
-        assert 'State is now at 0001.' in result.output
+        assert 'State is now at 0002.' in result.output
         assert 'Done.' in result.output
+
+
+def test_migrado_run_trace(runner, clean_arango):
+    with runner.isolated_filesystem():
+
+        result = runner.invoke(migrado, ['init'])
+        assert result.exit_code == 0
+
+        result = runner.invoke(migrado, ['run', '--trace', 'trace.jsonl'])
+        assert result.exit_code == 0
+        assert 'Trace written to trace.jsonl' in result.output
+
+        spans = [json.loads(line) for line in Path('trace.jsonl').read_text().splitlines()]
+        names = [span['name'] for span in spans]
+        assert names[0] == 'run'
+        assert {'read', 'parse', 'http', 'migration', 'ddl'} <= set(names)
+        http = next(span for span in spans if span['name'] == 'http')
+        assert http['endpoint'].startswith('/_db/')
+        assert http['status'] < 400
+
+        result = runner.invoke(migrado, ['run', '--trace', 'trace.json', '--trace-format', 'chrome'])
+        assert result.exit_code == 0
+        assert json.loads(Path('trace.json').read_text())['traceEvents']
+
+
+def test_migrado_run_metrics(runner, clean_arango):
+    with runner.isolated_filesystem():
+
+        result = runner.invoke(migrado, ['init'])
+        assert result.exit_code == 0
+
+        result = runner.invoke(migrado, ['run', '--metrics', 'migrado.prom'])
+        assert result.exit_code == 0
+        assert 'Metrics written to migrado.prom.' in result.output
+
+        metrics = Path('migrado.prom').read_text().splitlines()
+        assert f'migrado_migrations_total{{db="{DB}",executor="native"}} 1' in metrics
+        assert 'migrado_run_success 1' in metrics
+
+        result = runner.invoke(migrado, ['run', '--host', 'nohost', '--metrics', 'migrado.prom'])
+        assert result.exit_code == 1
+        assert 'migrado_run_success 0' in Path('migrado.prom').read_text().splitlines()
+
+
+def test_migrado_run_lock(runner, clean_arango):
+    with runner.isolated_filesystem():
+
+        result = runner.invoke(migrado, ['init'])
+        assert result.exit_code == 0
+
+        result = runner.invoke(migrado, ['run', '--lock'])
+        assert result.exit_code == 0
+        assert 'State is now at 0001.' in result.output
+
+        client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+        assert client.read_lock() == ('0001', None)
+
+        # another runner holds the lock, and has reached the target
+        assert client.acquire_lock('other', 30) == 'other'
+
+        result = runner.invoke(migrado, ['run', '--lock'])
+        assert result.exit_code == 0
+        assert 'State is now at 0001.' in result.output
+        assert client.read_lock() == ('0001', 'other')
+
+
+def test_migrado_run_coalesce(runner, clean_arango):
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+    things = client.db.create_collection('things')
+    things.insert({'_key': 'thing', 'count': 0})
+
+    with runner.isolated_filesystem():
+
+        result = runner.invoke(migrado, ['init'])
+        assert result.exit_code == 0
+
+        for name in ['one', 'two', 'three']:
+            result = runner.invoke(migrado, ['make', '--name', name])
+            assert result.exit_code == 0
+
+        for migration_path in sorted(Path('migrations').glob('000[234]_*.js')):
+            migration_path.write_text(
+                '// write things\n' + migration_path.read_text()
+                .replace(
+                    '// add your forward migration here',
+                    'db._query(`FOR thing IN things UPDATE thing WITH { count: thing.count + 1 } IN things`)'
+                )
+            )
+
+        result = runner.invoke(migrado, ['run', '--coalesce', '--plan'])
+        assert result.exit_code == 0
+        assert '0001: native' in result.output
+        assert '0002: transaction (coalesced 0002-0004)' in result.output
+
+        result = runner.invoke(migrado, ['run', '--coalesce'])
+        assert result.exit_code == 0
+        assert 'Running forward migrations 0002-0004 in one transaction' in result.output
+        assert 'State is now at 0004.' in result.output
+        assert things.get('thing')['count'] == 3
+
+        result = runner.invoke(migrado, ['make', '--name', 'four'])
+        assert result.exit_code == 0
+        result = runner.invoke(migrado, ['make', '--name', 'five'])
+        assert result.exit_code == 0
+
+        Path('migrations/0005_four.js').write_text(
+            Path('migrations/0005_four.js').read_text()
+            .replace('// add your forward migration here', 'var nothing = true')
+        )
+        Path('migrations/0006_five.js').write_text(
+            Path('migrations/0006_five.js').read_text()
+            .replace('// add your forward migration here', 'throw "broken"')
+            .replace('forward() // default action', '// executor transaction')
+        )
+
+        result = runner.invoke(migrado, ['run', '--coalesce'])
+        assert result.exit_code == 1
+        assert 'Running forward migrations 0005-0006 in one transaction' in result.output
+        assert 'migration 0006 failed: broken' in result.output
+        assert 'State is now at 0005.' in result.output
+        assert client.read_state() == '0005'
+
+
+def test_migrado_run_databases(runner, clean_arango):
+    schema_path = Path('tests/test_schema.yml').resolve()
+    sys_db = clean_arango.db('_system')
+    for db_name in ['tenant_a', 'tenant_b']:
+        if sys_db.has_database(db_name):
+            sys_db.delete_database(db_name)
+        sys_db.create_database(db_name)
+
+    with runner.isolated_filesystem():
+
+        result = runner.invoke(migrado, ['init', '--schema', schema_path])
+        assert result.exit_code == 0
+
+        result = runner.invoke(migrado, ['run', '--db', 'tenant_*', '--concurrency', '2'])
+        assert result.exit_code == 0
+        assert 'Running migrations against 2 databases' in result.output
+        assert '[tenant_a] State is now at 0001.' in result.output
+        assert '[tenant_b] State is now at 0001.' in result.output
+        assert 'tenant_a: state is at 0001.' in result.output
+        assert 'tenant_b: state is at 0001.' in result.output
+
+        result = runner.invoke(migrado, ['run', '--db', 'tenant_a,missing'])
+        assert result.exit_code == 1
+        assert 'tenant_a: state is at 0001.' in result.output
+        assert 'missing: failed, state is at unknown.' in result.output
+        assert '1 of 2 databases failed.' in result.output
+
+        result = runner.invoke(migrado, ['run', '--db', 'nothing_*'])
+        assert result.exit_code == 2
+        assert 'No databases found matching nothing_*' in result.output
+
+    for db_name in ['tenant_a', 'tenant_b']:
+        sys_db.delete_database(db_name)
+
+
+def test_migrado_batch(runner, clean_arango):
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+    things = client.db.create_collection('things')
+    things.insert_many([{'_key': str(key)} for key in range(100, 125)])
+
+    with runner.isolated_filesystem():
+
+        result = runner.invoke(migrado, ['init'])
+        assert result.exit_code == 0
+
+        result = runner.invoke(migrado, ['make', '--name', 'new_field'])
+        assert result.exit_code == 0
+
+        migration_path = Path('migrations/0002_new_field.js')
+        migration_path.write_text(
+            migration_path.read_text()
+            .replace(
+                '// add your forward migration here',
+                'db._query(`FOR thing IN things UPDATE thing WITH { new_field: 1 } IN things`)'
+            )
+            .replace(
+                '// add your reverse migration here',
+                'db._query(`FOR thing IN things REPLACE thing WITH UNSET(thing, "new_field") IN things`)'
+            )
+        )
+
+        result = runner.invoke(migrado, ['batch', '--batch-size', '10'])
+        assert result.exit_code == 1
+        assert 'No batchable query found in forward migration 0001' in result.output
+
+        client.write_state('0001')
+        client.write_checkpoint('0002', 'forward', [
+            {'start': '', 'end': None, 'last_key': '109', 'processed': 10, 'done': False}
+        ])
+
+        result = runner.invoke(migrado, ['batch', '--batch-size', '10'])
+        assert result.exit_code == 0
+        assert 'Resuming forward migration 0002 from checkpoint' in result.output
+        assert 'Processed 25 documents.' in result.output
+        assert 'State is now at 0002.' in result.output
+        assert client.read_checkpoint() is None
+        assert [thing.get('new_field') for thing in things.all()].count(1) == 15
+
+        result = runner.invoke(migrado, ['batch', '--target', '0001', '--batch-size', '10'])
+        assert result.exit_code == 0
+        assert 'Running reverse migration 0002 in batches of 10' in result.output
+        assert 'State is now at 0001.' in result.output
+        assert not any('new_field' in thing for thing in things.all())
+
+        result = runner.invoke(migrado, ['batch', '--batch-size', '4', '--workers', '3'])
+        assert result.exit_code == 0
+        assert 'Worker 3: processed' in result.output
+        assert 'Processed 25 documents.' in result.output
+        assert 'State is now at 0002.' in result.output
+        assert all(thing.get('new_field') == 1 for thing in things.all())
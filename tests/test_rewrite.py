@@ -0,0 +1,175 @@
+import os
+
+import pytest
+from arango.exceptions import ArangoServerError
+from arango.request import Request
+from arango.response import Response
+
+from migrado.db_client import MigrationClient
+from migrado.rewrite import RewriteWriter, rewrite_names, run_rewrite, swap_back
+from migrado.utils import parse_python_migration
+
+
+TLS = os.getenv('MIGRADO_TLS', False) in ['True', 'true', '1']
+HOST = os.getenv('MIGRADO_HOST', 'localhost')
+PORT = int(os.getenv('MIGRADO_PORT', 8529))
+USERNAME = os.getenv('MIGRADO_USER', '')
+PASSWORD = os.getenv('MIGRADO_PASS', '')
+DB = os.getenv('MIGRADO_DB', 'test')
+COLL = os.getenv('MIGRADO_STATE_COLL', 'migrado')
+
+SCRIPT = '''# write books
+collection = 'books'
+
+
+def rewrite(document):
+    if document['title'] == 'drop':
+        return None
+    return {'_key': document['_key'], 'name': document['title'].upper()}
+'''
+
+
+def test_parse_rewrite_migration():
+    migration = parse_python_migration(SCRIPT)
+    assert migration['executor'] == 'rewrite'
+    assert migration['forward'].startswith('def rewrite(document):')
+    assert migration['reverse'] is None
+
+
+def test_rewrite_names():
+    assert rewrite_names('books', '0004') == (
+        'books_rewrite_0004', 'books_rewrite_0004_revs', 'books_original_0004'
+    )
+
+
+def test_run_rewrite(clean_arango):
+
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+    books = client.db.create_collection('books')
+    books.add_persistent_index(['name'], name='by_name')
+    books.insert_many([{'_key': str(i), 'title': f'Book {i}'} for i in range(45)])
+    books.insert({'_key': 'dropped', 'title': 'drop'})
+
+    messages = []
+    indexes = client.list_indexes()['books']
+    count = run_rewrite(client.db, SCRIPT, 'migration_0004', 'rewrite', 'books', '0004', indexes,
+        batch_size=10, workers=2, echo=messages.append)
+
+    assert count == 46
+    assert messages[0] == 'Pass 1: rewrote 46 documents, removed 0.'
+    assert messages[-2] == 'Final pass: rewrote 0 documents, removed 0.'
+    assert messages[-1] == 'Catch-up pass: rewrote 0 documents, removed 0.'
+
+    books = client.db.collection('books')
+    assert books.count() == 45
+    assert books.get('1')['name'] == 'BOOK 1'
+    assert 'title' not in books.get('1')
+    assert any(index.get('name') == 'by_name' for index in books.indexes())
+    assert client.db.collection('books_original_0004').count() == 46
+    assert not client.db.has_collection('books_rewrite_0004_revs')
+
+    swap_back(client.db, 'books', '0004')
+    assert client.db.collection('books').get('1')['title'] == 'Book 1'
+    assert client.db.has_collection('books_rewrite_0004')
+
+    # running the rewrite again starts over
+    client.db.collection('books').delete('2')
+    assert run_rewrite(client.db, SCRIPT, 'migration_0004', 'rewrite', 'books', '0004',
+        batch_size=10, workers=2, echo=messages.append) == 45
+    assert client.db.collection('books').count() == 44
+
+    # a rewrite interrupted after the swap only catches up from the original collection,
+    # leaving documents written to the rewritten collection since the swap as they are
+    client.db.create_collection('books_rewrite_0004_revs')
+    client.db.collection('books_original_0004').insert({'_key': 'late', 'title': 'Late'})
+    client.db.collection('books_original_0004').update({'_key': '1', 'title': 'Changed'})
+    client.db.collection('books').update({'_key': '1', 'name': 'NEWER'})
+    assert run_rewrite(client.db, SCRIPT, 'migration_0004', 'rewrite', 'books', '0004',
+        batch_size=10, workers=2, echo=messages.append) == 2
+    assert messages[-1] == 'Catch-up pass: rewrote 2 documents, removed 0.'
+    assert client.db.collection('books').get('late')['name'] == 'LATE'
+    assert client.db.collection('books').get('1')['name'] == 'NEWER'
+    assert not client.db.has_collection('books_rewrite_0004_revs')
+
+
+EDGE_SCRIPT = '''collection = 'written_by'
+
+
+def rewrite(document):
+    return {**document, 'role': 'author'}
+'''
+
+
+def test_run_rewrite_edges(clean_arango):
+
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+    written_by = client.db.create_collection('written_by', edge=True)
+    written_by.insert_many([
+        {'_key': str(i), '_from': f'books/{i}', '_to': 'authors/1'} for i in range(5)
+    ])
+
+    assert run_rewrite(client.db, EDGE_SCRIPT, 'migration_0005', 'rewrite', 'written_by', '0005',
+        batch_size=10, workers=2, echo=lambda message: None) == 5
+
+    # the rewritten collection is still an edge collection
+    written_by = client.db.collection('written_by')
+    assert written_by.properties()['edge']
+    edge = written_by.get('1')
+    assert (edge['_from'], edge['role']) == ('books/1', 'author')
+
+
+def document_error(code, message):
+    response = Response('POST', '/_api/document/books_rewrite_0004', {}, 409, 'Conflict', '')
+    response.error_code, response.error_message = code, message
+    return ArangoServerError(response, Request('post', '/_api/document/books_rewrite_0004'))
+
+
+class WriterCollection:
+    """Stand-in for python-arango collections, failing to write documents with given keys"""
+
+    def __init__(self, name, failing=()):
+        self.name = name
+        self.failing = failing
+        self.documents = {}
+
+    def collection(self, name):
+        return self
+
+    def insert_many(self, documents, overwrite=False, silent=False):
+        results = []
+        for document in documents:
+            if document['_key'] in self.failing:
+                results.append(document_error(1210, 'unique constraint violated'))
+            else:
+                self.documents[document['_key']] = document
+                results.append({'_key': document['_key'], '_rev': f'written{document["_key"]}'})
+        return True if silent else results
+
+    def delete_many(self, keys, silent=False):
+        results = []
+        for key in keys:
+            if key in self.documents:
+                results.append({'_key': self.documents.pop(key)['_key']})
+            else:
+                results.append(document_error(1202, 'document not found'))
+        return True if silent else results
+
+
+def test_rewrite_writer_errors():
+    shadow, revs = WriterCollection('books_rewrite_0004', failing=['2']), WriterCollection('revs')
+    writer = RewriteWriter(shadow, shadow.name, revs.name)
+    writer.revs = revs
+
+    documents = [{'_key': key, '_rev': f'rev{key}'} for key in ['1', '2', '3']]
+    with pytest.raises(ValueError, match='1 documents could not be written to books_rewrite_0004, such as 2'):
+        writer(documents, [{'_key': '1', 'name': 'A'}, {'_key': '2', 'name': 'B'}])
+
+    # the failed document is rewritten again in the next pass, dropped documents not found are fine
+    assert sorted(shadow.documents) == ['1']
+    assert revs.documents == {
+        '1': {'_key': '1', 'rev': 'rev1', 'written': 'written1'},
+        '3': {'_key': '3', 'rev': 'rev3', 'written': None},
+    }
+
+    writer.remove(['1', '3'])
+    assert shadow.documents == {} and revs.documents == {}
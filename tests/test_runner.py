@@ -0,0 +1,168 @@
+from threading import Event, Lock
+import time
+
+import click
+import pytest
+from arango.exceptions import ArangoError
+
+from migrado.runner import MigrationRunner
+from migrado.tracing import Tracer
+from migrado.utils import parse_migration
+
+
+class RunnerClient:
+    """Stand-in for MigrationClient transactions and state, recording migrations run"""
+
+    def __init__(self, state='0000', applied=(), failing=()):
+        self.state = state
+        self.applied = list(applied)
+        self.failing = failing
+        self.db_name = 'test'
+        self.tracer = Tracer(enabled=False)
+        self.lock = Lock()
+        self.started = []
+        self.running = 0
+        self.max_running = 0
+
+    def read_applied(self):
+        return self.applied
+
+    def write_state(self, migration_id, applied=None):
+        self.state, self.applied = migration_id, applied or []
+
+    def run_transaction(self, script, write_collections, *args):
+        with self.lock:
+            self.started.append(script)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+        return 'failed' if script in self.failing else None
+
+    def close(self):
+        pass
+
+
+def migration(id_, writes, depends=''):
+    return parse_migration(f'''
+    // write {writes}
+    {depends}
+    function forward() {{ "forward {id_}" }}
+    function reverse() {{ "reverse {id_}" }}
+    ''')
+
+
+MIGRATIONS = {
+    '0001': migration('0001', 'books'),
+    '0002': migration('0002', 'authors'),
+    '0003': migration('0003', 'reviews', '// depends 0001'),
+    '0004': migration('0004', 'books'),
+}
+
+
+def run(runner, client, state, target):
+    return list(runner.run(client, state, target, echo=lambda message: None))
+
+
+def test_run_parallel():
+    runner = MigrationRunner(MIGRATIONS, parallel=2)
+    client = RunnerClient()
+
+    assert run(runner, client, '0000', '0004')[-1] == '0004'
+    assert (client.state, client.applied) == ('0004', [])
+    assert client.max_running == 2
+    started = [script.split('"')[1] for script in client.started]
+    assert set(started[:2]) == {'forward 0001', 'forward 0002'}
+    assert started.index('forward 0001') < started.index('forward 0003')
+    assert started.index('forward 0001') < started.index('forward 0004')
+
+    client.started = []
+    assert run(runner, client, '0004', '0000')[-1] == '0000'
+    started = [script.split('"')[1] for script in client.started]
+    assert started.index('reverse 0004') < started.index('reverse 0001')
+    assert started.index('reverse 0003') < started.index('reverse 0001')
+    assert (client.state, client.applied) == ('0000', [])
+
+
+def test_run_parallel_failure():
+    runner = MigrationRunner(MIGRATIONS, parallel=4)
+    failing = ['function forward() { "forward 0001" }']
+    client = RunnerClient(failing=failing)
+
+    with pytest.raises(click.Abort):
+        run(runner, client, '0000', '0004')
+
+    # 0002 ran alongside the failed 0001, nothing was started after it
+    assert (client.state, client.applied) == ('0000', ['0002'])
+    assert len(client.started) == 2
+
+    # applied migrations are not run again, also without --parallel
+    runner = MigrationRunner(MIGRATIONS)
+    client.failing, client.started = [], []
+    run(runner, client, '0000', '0004')
+    assert (client.state, client.applied) == ('0004', [])
+    assert 'forward 0002' not in ''.join(client.started)
+
+    # migrations applied ahead of state are reversed too
+    client.write_state('0001', ['0003'])
+    client.started = []
+    run(runner, client, '0001', '0000')
+    assert [script.split('"')[1] for script in client.started] == ['reverse 0003', 'reverse 0001']
+    assert (client.state, client.applied) == ('0000', [])
+
+
+class LostLock:
+    """Stand-in for MigrationLock, lost while the first migration runs"""
+
+    def __init__(self, client):
+        self.lost = Event()
+        run_transaction = client.run_transaction
+
+        def lose(*args):
+            self.lost.set()
+            return run_transaction(*args)
+
+        client.run_transaction = lose
+
+
+@pytest.mark.parametrize('parallel', [None, 1])
+def test_run_lock_lost(parallel):
+    runner = MigrationRunner(MIGRATIONS, parallel=parallel)
+    client = RunnerClient()
+    lock = LostLock(client)
+    messages = []
+
+    with pytest.raises(click.Abort):
+        list(runner.run(client, '0000', '0004', messages.append, lock))
+
+    # the running migration finished, nothing was started after it
+    assert len(client.started) == 1
+    assert 'Error! Migration lock was lost, not starting more migrations.' in messages
+
+
+def test_run_parallel_no_fallback():
+    runner = MigrationRunner(MIGRATIONS, arangosh='arangosh', parallel=2)
+    failing = ['function forward() { "forward 0001" }']
+    client = RunnerClient(failing=failing)
+    scripts = []
+    client.run_script = lambda script, arangosh: scripts.append(script)
+
+    # a failed transaction is not run again with arangosh alongside other migrations
+    with pytest.raises(click.Abort):
+        run(runner, client, '0000', '0004')
+    assert (client.state, client.applied) == ('0000', ['0002'])
+    assert scripts == []
+
+
+def test_run_job_lost():
+    runner = MigrationRunner(MIGRATIONS, job=True)
+    client = RunnerClient()
+    scripts = []
+    client.run_script = lambda script, arangosh: scripts.append(script)
+    client.run_transaction = lambda *args: ArangoError('job not found')
+
+    # a job that could not be polled may have run, and is not run again with arangosh
+    with pytest.raises(click.Abort):
+        run(runner, client, '0000', '0001')
+    assert scripts == []
@@ -0,0 +1,164 @@
+import gzip
+import json
+import os
+
+import pytest
+
+from migrado.db_client import MigrationClient, add_index, collection_options
+from migrado.snapshot import find_snapshot, write_snapshot, restore_snapshot
+
+
+TLS = os.getenv('MIGRADO_TLS', False) in ['True', 'true', '1']
+HOST = os.getenv('MIGRADO_HOST', 'localhost')
+PORT = int(os.getenv('MIGRADO_PORT', 8529))
+USERNAME = os.getenv('MIGRADO_USER', '')
+PASSWORD = os.getenv('MIGRADO_PASS', '')
+DB = os.getenv('MIGRADO_DB', 'test')
+COLL = os.getenv('MIGRADO_STATE_COLL', 'migrado')
+
+
+def test_find_snapshot(tmp_path):
+    assert find_snapshot(tmp_path, '0003') is None
+
+    for id_ in ['0001', '0002', '0004']:
+        tmp_path.joinpath('snapshots', id_).mkdir(parents=True)
+        tmp_path.joinpath('snapshots', id_, 'manifest.json').write_text('{}')
+
+    # incomplete snapshots have no manifest
+    tmp_path.joinpath('snapshots', '0003').mkdir()
+
+    assert find_snapshot(tmp_path, '0003').name == '0002'
+    assert find_snapshot(tmp_path, '0004').name == '0004'
+    assert find_snapshot(tmp_path, '0000') is None
+
+
+def test_write_restore_snapshot(clean_arango, tmp_path):
+
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+    assert client.is_empty()
+
+    books = client.db.create_collection('books', key_generator='padded')
+    client.db.create_collection('author_of', edge=True)
+    books.add_persistent_index(['title'], unique=True)
+    books.insert_many([{'_key': str(i), 'title': f'Book {i}'} for i in range(25)])
+    client.db.collection('author_of').insert({'_from': 'authors/1', '_to': 'books/1'})
+    client.write_state('0002')
+    assert not client.is_empty()
+
+    path = tmp_path.joinpath('snapshots', '0002')
+    manifest = write_snapshot(client, path, '0002', workers=2)
+    assert manifest['migration_id'] == '0002'
+    assert {c['name']: c['count'] for c in manifest['collections']} == {'books': 25, 'author_of': 1}
+    assert not tmp_path.joinpath('snapshots', '0002.tmp').exists()
+
+    with gzip.open(path.joinpath('books.jsonl.gz'), 'rt') as file:
+        document = json.loads(file.readline())
+    assert '_rev' not in document and '_id' not in document
+
+    clean_arango.db('_system').delete_database(DB)
+    clean_arango.db('_system').create_database(DB)
+
+    client = MigrationClient(TLS, HOST, PORT, USERNAME, PASSWORD, DB, COLL)
+    assert restore_snapshot(client, path, workers=2, batch_size=10) == 26
+    assert client.read_state() == '0002'
+    assert client.db.collection('books').count() == 25
+    assert client.db.collection('author_of').properties()['type'] == 'edge'
+    assert client.db.collection('books').properties()['key_options']['key_generator'] == 'padded'
+    assert any(
+        index['fields'] == ['title'] and index['unique']
+        for index in client.db.collection('books').indexes()
+    )
+
+
+class IndexCollection:
+    """Stand-in for a python-arango 7.x collection, recording indexes added"""
+
+    name = 'books'
+
+    def __init__(self):
+        self.added = []
+
+    def add_persistent_index(self, **kwargs):
+        self.added.append(('persistent', kwargs))
+
+    def add_ttl_index(self, **kwargs):
+        self.added.append(('ttl', kwargs))
+
+
+def test_add_index():
+    collection = IndexCollection()
+    add_index(collection, {
+        'type': 'persistent', 'fields': ['title'], 'unique': True, 'sparse': False,
+        'name': 'title', 'estimates': True,
+    })
+    add_index(collection, {'type': 'ttl', 'fields': ['expires'], 'expireAfter': 60, 'name': 'expiry'})
+    assert collection.added == [
+        ('persistent', {'fields': ['title'], 'unique': True, 'sparse': False, 'name': 'title'}),
+        ('ttl', {'fields': ['expires'], 'expiry_time': 60, 'name': 'expiry'}),
+    ]
+
+    with pytest.raises(ValueError):
+        add_index(collection, {'type': 'zkd', 'fields': ['x', 'y']})
+
+
+def test_collection_options():
+    properties = {
+        'name': 'books', 'type': 'document', 'sync': False, 'schema': None,
+        'key_options': {
+            'key_generator': 'autoincrement', 'key_increment': 1, 'key_offset': 0,
+            'user_keys': False, 'key_last_value': 25,
+        },
+        'shard_count': 3, 'shard_fields': ['_key'], 'replication_factor': 2, 'shard_like': '',
+        'computedValues': [{'name': 'created', 'expression': 'RETURN DATE_NOW()'}],
+    }
+    assert collection_options(properties) == {
+        'sync': False, 'key_generator': 'autoincrement', 'key_increment': 1, 'key_offset': 0,
+        'shard_count': 3, 'shard_fields': ['_key'], 'replication_factor': 2,
+        'computedValues': [{'name': 'created', 'expression': 'RETURN DATE_NOW()'}],
+    }
+
+
+class RestoreDatabase:
+    """Stand-in for a python-arango database, failing to import documents"""
+
+    def __init__(self):
+        self.collections = []
+
+    def create_collection(self, name, edge=False, **options):
+        self.collections.append(name)
+
+    def delete_collection(self, name, ignore_missing=False):
+        self.collections.remove(name)
+
+    def collection(self, name):
+        return self
+
+    def import_bulk(self, documents, halt_on_error=None):
+        raise ValueError('unique constraint violated')
+
+
+class RestoreClient:
+
+    def __init__(self):
+        self.db = RestoreDatabase()
+
+    def connect(self):
+        return self.db
+
+
+def test_restore_snapshot_failure(tmp_path):
+    manifest = {'migration_id': '0002', 'schema': None, 'collections': [
+        {'name': name, 'type': 'document', 'schema': None, 'options': {}, 'indexes': [],
+            'count': 1, 'file': f'{name}.jsonl.gz'}
+        for name in ['books', 'authors']
+    ]}
+    tmp_path.joinpath('manifest.json').write_text(json.dumps(manifest))
+    for name in ['books', 'authors']:
+        with gzip.open(tmp_path.joinpath(f'{name}.jsonl.gz'), 'wt') as file:
+            file.write(json.dumps({'_key': '1'}) + '\n')
+
+    # collections created by a failed restore are dropped, leaving the database empty
+    client = RestoreClient()
+    with pytest.raises(ValueError):
+        restore_snapshot(client, tmp_path, workers=2)
+    assert client.db.collections == []
@@ -0,0 +1,106 @@
+from threading import Thread
+import time
+
+import pytest
+from arango.exceptions import AQLQueryExecuteError
+
+from migrado.batch import process_batches
+from migrado.throttle import RateController
+
+
+def test_rate_controller_target_latency():
+    throttle = RateController(batch_size=100, concurrency=2, target_latency=1.0)
+    assert throttle.adaptive
+
+    throttle.record(100, 0.5)
+    assert throttle.batch_size == 110
+
+    throttle.record(110, 2.0)
+    assert (throttle.batch_size, throttle.concurrency) == (55, 1)
+
+    throttle.record(0, 0.1, error=True)
+    assert (throttle.batch_size, throttle.errors) == (27, 1)
+
+    # fast batches grow batch size (up to four times the initial size) and concurrency
+    for _ in range(100):
+        throttle.record(100, 0.1)
+    assert (throttle.batch_size, throttle.concurrency) == (400, 2)
+
+
+def test_rate_controller_latency_inflation():
+    throttle = RateController(batch_size=100, adaptive=True)
+    throttle.record(100, 0.1)
+    throttle.record(110, 0.15)
+    assert throttle.batch_size == 120
+    throttle.record(120, 0.5)
+    assert throttle.batch_size == 60
+
+    # not adaptive, only paced
+    throttle = RateController(batch_size=100, max_rate=1000)
+    throttle.record(100, 10.0)
+    assert throttle.batch_size == 100
+
+
+def test_rate_controller_max_rate():
+    throttle = RateController(max_rate=1000)
+    started = time.monotonic()
+    for _ in range(5):
+        throttle.acquire(50)
+    # the first 50 operations are not delayed
+    assert 0.19 < time.monotonic() - started < 0.5
+
+
+def test_rate_controller_slot():
+    throttle = RateController(concurrency=2)
+    active = []
+
+    def work():
+        with throttle.slot():
+            active.append(throttle.active)
+            time.sleep(0.02)
+
+    threads = [Thread(target=work) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(active) == 2
+
+
+class BatchClient:
+    """Stand-in for MigrationClient batch queries over keys 0-99, failing as given"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.sizes = []
+
+    def run_batch(self, query, last_key, batch_size, max_transaction_size=None,
+            upper_key=None, db=None):
+        self.sizes.append(batch_size)
+        if self.failures:
+            self.failures -= 1
+            raise AQLQueryExecuteError.__new__(AQLQueryExecuteError)
+        start = int(last_key) + 1 if last_key else 0
+        keys = list(range(start, min(start + batch_size, 100)))
+        return {'count': len(keys), 'last_key': str(keys[-1]) if keys else last_key}
+
+
+def test_process_batches_throttle():
+    throttle = RateController(batch_size=40, target_latency=10)
+    client = BatchClient(failures=1)
+    batches = list(process_batches(client, 'query', throttle=throttle))
+
+    # the failed batch is retried with half the batch size, which then grows
+    assert client.sizes[:3] == [40, 20, 24]
+    assert sum(count for count, _ in batches) == 100
+    assert batches[-1][1] == '99'
+
+    client = BatchClient(failures=4)
+    with pytest.raises(AQLQueryExecuteError):
+        list(process_batches(client, 'query', throttle=RateController(target_latency=10)))
+
+    # without an adaptive throttle, failures are not retried
+    client = BatchClient(failures=1)
+    with pytest.raises(AQLQueryExecuteError):
+        list(process_batches(client, 'query', batch_size=40))
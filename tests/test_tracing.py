@@ -0,0 +1,54 @@
+import io
+import json
+
+import pytest
+
+from migrado.tracing import Tracer
+
+
+def test_tracer():
+    tracer = Tracer()
+
+    with tracer.span('run', target='0002') as span:
+        with tracer.span('http', method='POST') as http_span:
+            http_span['status'] = 201
+        span['done'] = True
+
+    with pytest.raises(ValueError):
+        with tracer.span('parse'):
+            raise ValueError()
+
+    http, run, parse = tracer.spans
+    assert run['name'] == 'run'
+    assert run['target'] == '0002'
+    assert run['done']
+    assert http == {**http, 'name': 'http', 'method': 'POST', 'status': 201}
+    assert run['start'] <= http['start']
+    assert run['duration'] >= http['duration']
+    assert parse['error'] == 'ValueError'
+
+    summary = tracer.summary()
+    assert summary['http'][0] == 1
+    assert summary['parse'][0] == 1
+
+    file = io.StringIO()
+    tracer.write(file)
+    lines = [json.loads(line) for line in file.getvalue().splitlines()]
+    assert [line['name'] for line in lines] == ['run', 'http', 'parse']
+
+    file = io.StringIO()
+    tracer.write(file, 'chrome')
+    events = json.loads(file.getvalue())['traceEvents']
+    assert [event['name'] for event in events] == ['run', 'http', 'parse']
+    assert events[0]['ph'] == 'X'
+    assert events[0]['args'] == {'target': '0002', 'done': True}
+    assert events[1]['ts'] >= events[0]['ts']
+
+
+def test_tracer_disabled():
+    tracer = Tracer(enabled=False)
+
+    with tracer.span('run') as span:
+        span['done'] = True
+
+    assert tracer.spans == []
@@ -0,0 +1,110 @@
+from collections import deque
+
+from migrado.throttle import RateController
+from migrado.transform import run_transform
+from migrado.utils import parse_python_migration
+
+
+SCRIPT = '''# write books
+import hashlib
+
+collection = 'books'
+
+
+def transform(document):
+    if document['title'] == 'skip':
+        return None
+    return {'_key': document['_key'], 'hash': hashlib.sha256(document['title'].encode()).hexdigest()}
+
+
+def reverse_transform(document):
+    return {'_key': document['_key'], 'hash': None}
+'''
+
+
+class TransformCursor:
+    """Stand-in for a streaming cursor, returning documents in batches"""
+
+    def __init__(self, documents, batch_size):
+        self.batches = deque(documents[i:i + batch_size] for i in range(0, len(documents), batch_size))
+        self.current = deque(self.batches.popleft() if self.batches else [])
+
+    def batch(self):
+        return self.current
+
+    def has_more(self):
+        return bool(self.batches)
+
+    def fetch(self):
+        self.current.extend(self.batches.popleft())
+
+    def close(self, ignore_missing=False):
+        pass
+
+
+class TransformDatabase:
+    """Stand-in for a database with one collection, recording bulk imports"""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.imports = []
+        self.aql = self
+
+    def execute(self, query, bind_vars=None, batch_size=None, **kwargs):
+        assert bind_vars == {'@collection': 'books'}
+        return TransformCursor(self.documents, batch_size)
+
+    def collection(self, name):
+        return self
+
+    def import_bulk(self, documents, on_duplicate=None, halt_on_error=None):
+        assert on_duplicate == 'update'
+        self.imports.append(documents)
+
+
+def test_parse_transform_migration():
+    migration = parse_python_migration(SCRIPT)
+    assert migration['executor'] == 'transform'
+    assert migration['forward'].startswith('def transform(document):')
+    assert migration['reverse'].startswith('def reverse_transform(document):')
+    assert migration['write_collections'] == ['books']
+
+    # the collection is written without a '# write' comment
+    migration = parse_python_migration(SCRIPT.replace('# write books\n', ''))
+    assert migration['write_collections'] == ['books']
+
+    # a helper named transform does not make an ordinary migration a transform
+    migration = parse_python_migration(SCRIPT.replace('def reverse_transform', 'def forward'))
+    assert migration['executor'] == 'python'
+    assert migration['forward'].startswith('def forward(document):')
+    migration = parse_python_migration(SCRIPT.replace("collection = 'books'", ''))
+    assert migration['executor'] == 'python'
+
+
+def test_run_transform():
+    documents = [{'_key': str(i), 'title': f'Book {i}'} for i in range(95)]
+    documents.append({'_key': '95', 'title': 'skip'})
+    db = TransformDatabase(documents)
+
+    read, written = run_transform(db, SCRIPT, 'migration_0002', 'transform', 'books',
+        batch_size=10, workers=2)
+
+    assert (read, written) == (96, 95)
+    assert len(db.imports) == 10
+    results = [document for batch in db.imports for document in batch]
+    # results are written in cursor order
+    assert [document['_key'] for document in results] == [str(i) for i in range(95)]
+    assert len(results[0]['hash']) == 64
+
+    db.imports = []
+    assert run_transform(db, SCRIPT, 'migration_0002', 'reverse_transform', 'books', workers=1) == (96, 96)
+
+
+def test_run_transform_throttle():
+    documents = [{'_key': str(i), 'title': f'Book {i}'} for i in range(50)]
+    db = TransformDatabase(documents)
+    throttle = RateController(10, 4, max_rate=100000, adaptive=True)
+
+    assert run_transform(db, SCRIPT, 'migration_0002', 'transform', 'books',
+        batch_size=10, workers=2, throttle=throttle) == (50, 50)
+    assert throttle.best is not None
@@ -1,10 +1,12 @@
 from pathlib import Path
 from unittest.mock import MagicMock, patch
+import time
 
 import pytest
 import click
 import json
 
+from migrado.constants import MIGRATION_TEMPLATE
 from migrado.utils import *
 
 
@@ -73,6 +75,21 @@ def test_check_password(runner):
         assert prompt.called
 
 
+def test_split_databases():
+    assert split_databases('test') == ['test']
+    assert split_databases('one, two,,tenant_*') == ['one', 'two', 'tenant_*']
+
+
+def test_match_databases():
+    databases = ['_system', 'tenant_b', 'tenant_a', 'other']
+
+    assert match_databases(['tenant_*'], databases) == ['tenant_a', 'tenant_b']
+    assert match_databases(['other', 'tenant_?', 'other'], databases) == ['other', 'tenant_a', 'tenant_b']
+    assert match_databases(['*'], databases) == ['other', 'tenant_a', 'tenant_b']
+    assert match_databases(['_system', 'missing'], databases) == ['_system', 'missing']
+    assert match_databases(['nothing_*'], databases) == []
+
+
 def test_select_migrations():
     migration_ids = ['0001', '0002', '0003']
 
@@ -113,6 +130,224 @@ def test_parse_write_collections():
     assert write_collections == []
 
 
+def test_classify_migration():
+    ddl_function = '''function forward() {
+        var db = require("@arangodb").db
+        db._create("books", {})
+    }'''
+    index_function = '''function forward() {
+        var db = require("@arangodb").db
+        db.books.ensureIndex({ type: "persistent", fields: ["isbn"] })
+    }'''
+    data_function = '''function forward() {
+        var db = require("@arangodb").db
+        db._query(`FOR book IN books UPDATE book WITH { read: false } IN books`)
+    }'''
+
+    assert classify_migration(ddl_function) == ('native', False)
+    assert classify_migration(index_function) == ('arangosh', False)
+    assert classify_migration(data_function) == ('transaction', False)
+
+    # only calls changing collections, indexes and the like are DDL
+    for ddl in ['db._create("books")', 'db._createEdgeCollection("author_of")', 'db._drop("books")',
+            'db.books.ensureIndex({ type: "ttl" })', 'db.books.ensurePersistentIndex(["isbn"])',
+            'db.books.dropIndex("isbn")', 'db.books.properties({ waitForSync: true })',
+            'db.books.rename("novels")', 'db.books.drop()']:
+        assert classify_migration(f'function forward() {{ print(1); {ddl} }}') == ('arangosh', False), ddl
+
+    for data in ['db._createStatement({ query: "FOR b IN books RETURN b" }).execute()',
+            'var sync = db.books.properties().waitForSync', 'db.books.properties( )',
+            'db._query("FOR b IN books RETURN b")']:
+        assert classify_migration(f'function forward() {{ {data} }}') == ('transaction', False), data
+
+    script = f'''
+    // executor arangosh
+    {data_function}
+    '''
+    assert parse_executor(script) == 'arangosh'
+    assert classify_migration(data_function, 'arangosh') == ('arangosh', True)
+
+    assert parse_executor('// executor something') is None
+    assert parse_executor(data_function) is None
+
+
+def test_parse_migration():
+    forward_function = \
+    '''function forward() {
+        var db = require("@arangodb").db
+        var schema = {"collections": {"books": null}, "edge_collections": {}}
+        var braces = "}}} function reverse() {"
+        var template = `
+            }
+        `
+        /* } */
+        // }
+        if (innerBlock) { nested({ deeply: { reverse: true } }) }
+        var stripped = braces.replace(/\\{/g, "").split(/[}\\/]+/)
+        var ratio = stripped.length / 2 / 1
+    }'''
+
+    reverse_function = \
+    '''function reverse() {
+        var db = require("@arangodb").db
+        db._drop("books")
+    }'''
+
+    script = f'''
+    // write books
+    // executor arangosh
+    {forward_function}
+    /* // write not_this_one */
+    var ignored = "// write nor_this_one"
+    {reverse_function}
+    forward()
+    '''
+
+    assert parse_migration(script) == {
+        'forward': forward_function,
+        'reverse': reverse_function,
+        'write_collections': ['books'],
+        'schema': {'collections': {'books': None}, 'edge_collections': {}},
+        'executor': 'arangosh',
+        'depends': [],
+    }
+
+    assert parse_migration('') == {
+        'forward': None,
+        'reverse': None,
+        'write_collections': [],
+        'schema': None,
+        'executor': None,
+        'depends': [],
+    }
+
+
+def test_parse_migration_errors():
+    with pytest.raises(ValueError, match='Function forward is never closed'):
+        parse_migration('function forward() {\n  if (true) {\n}\nfunction reverse() {}\n')
+
+    # a trailing semicolon is allowed after the schema, other invalid JSON is reported by file
+    assert parse_migration('var schema = {"collections": {}};')['schema'] == {'collections': {}}
+    with pytest.raises(click.UsageError, match='Migration 0001_initial.js could not be parsed'):
+        parse_migration_file('0001_initial.js', 'var schema = {collections: {}}')
+
+
+def test_parse_migration_depends():
+    script = """
+    // depends 0001
+    // depends 0003, 0004
+    // write books
+    function forward() {}
+    """
+    assert parse_migration(script)['depends'] == ['0001', '0003', '0004']
+    assert parse_migration('// depends on nothing')['depends'] == []
+
+
+def test_dependency_graph():
+    ids = ['0001', '0002', '0003', '0004', '0005']
+    depends = {'0001': [], '0002': [], '0003': ['0001'], '0004': [], '0005': []}
+    writes = {
+        '0001': {'books'},
+        '0002': {'authors'},
+        '0003': {'reviews'},
+        '0004': None,
+        '0005': {'books', 'authors'},
+    }
+    assert dependency_graph(ids, depends, writes) == {
+        '0001': set(),
+        '0002': set(),
+        '0003': {'0001'},
+        '0004': {'0001', '0002', '0003'},
+        '0005': {'0001', '0002', '0004'},
+    }
+
+    # dependencies outside the given migrations are ignored
+    assert dependency_graph(['0003'], depends, writes) == {'0003': set()}
+
+
+def test_applied_state():
+    ids = ['0001', '0002', '0003', '0004']
+    assert applied_state(ids, set()) == ('0000', [])
+    assert applied_state(ids, {'0001', '0002'}) == ('0002', [])
+    assert applied_state(ids, {'0001', '0003', '0004'}) == ('0001', ['0003', '0004'])
+    assert applied_state(ids, set(ids)) == ('0004', [])
+
+
+def test_parse_python_migration():
+    script = """# write books
+# depends 0001
+import json
+
+SEED = "# write not_this_one"
+
+
+def forward(db):
+    db.collection('books').insert({'title': json.dumps(SEED)})
+
+
+def reverse(db):
+    db.collection('books').truncate()
+"""
+    migration = parse_python_migration(script)
+    assert migration['forward'].startswith('def forward(db):')
+    assert migration['reverse'] == "def reverse(db):\n    db.collection('books').truncate()"
+    assert migration['write_collections'] == ['books']
+    assert migration['depends'] == ['0001']
+    assert migration['executor'] == 'python'
+    assert parse_migration_file('0002_seed.py', script) == migration
+
+    module = load_python_migration(migration['source'], 'migration_0002')
+    assert callable(module.forward) and callable(module.reverse)
+
+    # errors are shown when the migration is loaded
+    migration = parse_python_migration('def forward(db):\n  pass\n pass\n')
+    assert migration['forward'] is None
+    with pytest.raises(SyntaxError):
+        load_python_migration(migration['source'], 'migration_0003')
+
+
+def test_find_migrations(tmp_path):
+    for name in ['0002_seed.py', '0001_initial.js', '0003_notes.txt', 'README.md']:
+        tmp_path.joinpath(name).write_text('')
+    assert [path.name for path in find_migrations(tmp_path)] == ['0001_initial.js', '0002_seed.py']
+
+
+def test_parse_migration_scaling():
+    seed = '        {"_key": "%d", "name": "seed {%d}", "tags": ["a", "b"]},\n'
+
+    def script(size):
+        seeds = ''.join(seed % (i, i) for i in range(size))
+        return f'''// write seeds
+        function forward() {{
+            var db = require("@arangodb").db
+            var seeds = [
+        {seeds}    ]
+            db.seeds.insert(seeds)
+        }}
+
+        function reverse() {{
+            var db = require("@arangodb").db
+            db._query(`FOR seed IN seeds REMOVE seed IN seeds`)
+        }}
+        '''
+
+    def parse_time(script):
+        timings = []
+        for _ in range(3):
+            start = time.perf_counter()
+            migration = parse_migration(script)
+            timings.append(time.perf_counter() - start)
+        assert migration['forward'].endswith('db.seeds.insert(seeds)\n        }')
+        assert migration['reverse'].startswith('function reverse()')
+        return min(timings)
+
+    small, large = script(2000), script(32000)
+    assert len(large) > 15 * len(small)
+
+    # linear scaling: 16x the input should take nowhere near 16x16 the time
+    assert parse_time(large) < 40 * parse_time(small)
+
+
 def test_extract_migration():
     forward_function = \
     '''function forward() {
@@ -154,6 +389,93 @@ def test_extract_migration():
     assert nothing_migration is None
 
 
+def test_extract_query():
+    function = \
+    '''function forward() {
+        var db = require("@arangodb").db
+        db._query(`
+            FOR thing IN things
+                UPDATE thing WITH { new_field: "some value" } IN things
+        `)
+    }'''
+
+    query = extract_query(function)
+    assert query.startswith('FOR thing IN things')
+    assert query.endswith('IN things')
+
+    function = '''function forward() { db._query("FOR thing IN things REMOVE thing IN things") }'''
+    assert extract_query(function) == 'FOR thing IN things REMOVE thing IN things'
+
+    assert extract_query('function forward() {}') is None
+    assert extract_query(None) is None
+
+
+def test_batch_query():
+    coll, query = batch_query('FOR thing IN things UPDATE thing WITH { new_field: 1 } IN things')
+
+    assert coll == 'things'
+    assert 'FILTER thing._key > @last_key' in query
+    assert 'LIMIT @batch_size' in query
+    assert 'FOR thing IN batch UPDATE thing WITH { new_field: 1 } IN things' in query
+    assert query.endswith('RETURN { count: LENGTH(batch), last_key: LAST(batch)._key }')
+
+    coll, query = batch_query('RETURN 1')
+    assert coll is None
+    assert query is None
+
+
+def test_parse_ddl():
+    function = \
+    '''function forward() {
+        var db = require("@arangodb").db
+        var schema = {"collections": {"books": null}}
+        db._create("books", {"schema": {"rule": {"required": ["title"]}, "level": "moderate"}})
+        db._create("author_of", {}, "edge")
+        db._create("authors", {}, "document")
+        db.authors.properties({})
+        db._drop("old_books")
+    }'''
+
+    assert parse_ddl(function) == [
+        {
+            'operation': 'create',
+            'name': 'books',
+            'options': {'schema': {'rule': {'required': ['title']}, 'level': 'moderate'}},
+            'edge': False
+        },
+        {'operation': 'create', 'name': 'author_of', 'options': {}, 'edge': True},
+        {'operation': 'create', 'name': 'authors', 'options': {}, 'edge': False},
+        {'operation': 'properties', 'name': 'authors', 'options': {}, 'edge': False},
+        {'operation': 'drop', 'name': 'old_books', 'options': {}, 'edge': False},
+    ]
+
+    assert parse_ddl(MIGRATION_TEMPLATE[MIGRATION_TEMPLATE.index('function reverse'):]) == []
+
+    function = '''function forward() {
+        db._create("books", {"waitForSync": true})
+    }'''
+    assert parse_ddl(function) is None
+
+    function = '''function forward() {
+        db.books.ensureIndex({type: "persistent", fields: ["isbn"]})
+    }'''
+    assert parse_ddl(function) is None
+
+    assert parse_ddl(None) is None
+
+
+def test_coalesce_migrations():
+    function = coalesce_migrations([
+        ('0002', 'function forward() { first() }'),
+        ('0003', 'function forward() { second() }'),
+    ])
+
+    assert function.startswith('function () {')
+    assert '["0002", function forward() { first() }],' in function
+    assert '["0003", function forward() { second() }]\n' in function
+    assert '"migration " + migrations[i][0] + " failed: "' in function
+
+
 def test_extract_schema():
     test_schema = '{"test": "schema"}'
 
@@ -176,6 +498,52 @@ def test_extract_schema():
     assert schema is None
 
 
+def test_history_entry():
+    entry = history_entry('0002', 'forward', ['transaction', 'arangosh'], 'prod', 0, 1.2345, documents=10)
+
+    assert entry == {
+        'migration_id': '0002',
+        'direction': 'forward',
+        'executors': ['transaction', 'arangosh'],
+        'environment': 'prod',
+        'started': '1970-01-01T00:00:00+00:00',
+        'ended': '1970-01-01T00:00:01.234500+00:00',
+        'duration': 1.234,
+        'documents': 10,
+    }
+
+
+def test_find_baseline():
+    assert find_baseline([Path('0003_squashed.js'), Path('0004_data.js')]) == '0003'
+    assert find_baseline([Path('0001_initial.js'), Path('0002_squashed.js')]) is None
+    assert find_baseline([]) is None
+
+
+def test_schema_migration():
+    schema = {
+        'collections': {'books': None},
+        'edge_collections': {'author_of': None},
+    }
+    script = schema_migration(schema, None, 'squashed migrations up to 0003')
+
+    assert script.startswith('#!/usr/bin/arangosh --javascript.execute\n// migrado migration v0.6\n'
+        '// squashed migrations up to 0003\n')
+    migration = parse_migration(script)
+    assert migration['schema'] == schema
+    assert parse_ddl(migration['forward']) == [
+        {'operation': 'create', 'name': 'books', 'options': {}, 'edge': False},
+        {'operation': 'create', 'name': 'author_of', 'options': {}, 'edge': True},
+    ]
+    assert parse_ddl(migration['reverse']) == [
+        {'operation': 'drop', 'name': 'books', 'options': {}, 'edge': False},
+        {'operation': 'drop', 'name': 'author_of', 'options': {}, 'edge': False},
+    ]
+
+    script = schema_migration({}, None)
+    assert '// add your reverse migration here' in script
+    assert parse_migration(script)['schema'] == {'collections': {}, 'edge_collections': {}}
+
+
 def test_get_options():
     props = {}
     options = get_options(props, validation=None)